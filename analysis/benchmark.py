@@ -0,0 +1,214 @@
+####################################################################
+# This script benchmarks the ehrQL definitions (measures_*.py and
+#   define_dataset_*.py) against dummy tables of increasing size,
+#   recording wall time, CPU time and peak memory, and flags
+#   regressions against a saved baseline. CPU time and peak memory
+#   are only measured for a locally installed ehrQL (--ehrql ehrql);
+#   with docker (the default, opensafely exec) they would be those of
+#   the docker client, so only wall time is recorded and compared.
+#   Also reported is an estimate (not a measurement) of the rows
+#   read from each table: its rows times the number of intervals
+#
+# Dummy tables for each population size are read from
+#   output/dummy_tables/<population size>/ (one CSV per table), and
+#   can be created with generate_synthetic_data.py (or by passing
+#   --generate-missing)
+#
+# Usage (from the project root):
+#   python analysis/benchmark.py
+#   python analysis/benchmark.py --population-sizes 10000 --intervals 12
+#   python analysis/benchmark.py --save-baseline
+#
+# Author: Andrea Schaffer
+#   Bennett Institute for Applied Data Science
+#   University of Oxford, 2024
+#####################################################################
+
+
+import csv
+import glob
+import json
+import os
+import sys
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+
+from ehrql_local import DEFAULT_EHRQL, ehrql_command, run_command, tables_used
+
+
+OUTPUT_DIR = "output/benchmark"
+BASELINE_PATH = os.path.join(OUTPUT_DIR, "baseline.json")
+RESULTS_PATH = os.path.join(OUTPUT_DIR, "results.json")
+
+# Smallest increases flagged as regressions, so that noise in very
+#   short runs isn't reported
+MIN_INCREASE = {"wall_seconds": 1.0, "peak_rss_mb": 10.0}
+
+# measures_definitions.py only defines functions used by the measures files
+DEFAULT_DEFINITIONS = sorted(
+    path
+    for path in glob.glob("analysis/measures_*.py") + glob.glob("analysis/define_dataset_*.py")
+    if path != "analysis/measures_definitions.py"
+)
+
+
+# Number of rows in each dummy table #
+def count_table_rows(dummy_tables):
+    rows = {}
+    for path in glob.glob(os.path.join(dummy_tables, "*.csv")):
+        with open(path, newline="") as f:
+            rows[os.path.basename(path)[:-4]] = sum(1 for _ in f) - 1
+    return rows
+
+
+# Benchmark one definition for one population size and no. intervals #
+def benchmark(definition, population_size, intervals, start_date, ehrql, dummy_tables):
+    name = os.path.basename(definition)[:-3]
+    is_measures = name.startswith("measures_")
+
+    run_name = f"{name}_{population_size}" + (f"_{intervals}" if is_measures else "")
+    runs_dir = os.path.join(OUTPUT_DIR, "runs")
+    os.makedirs(runs_dir, exist_ok=True)
+
+    user_args = ["--start-date", start_date, "--intervals", str(intervals)] if is_measures else []
+    command = ehrql_command(
+        ehrql,
+        definition,
+        output=os.path.join(runs_dir, f"{run_name}.csv"),
+        dummy_tables=dummy_tables,
+        user_args=user_args,
+    )
+    result = run_command(command, log_path=os.path.join(runs_dir, f"{run_name}.log"))
+
+    # Each interval is evaluated as a separate query, so each table used
+    #   is estimated to be read once per interval
+    table_rows = count_table_rows(dummy_tables)
+    scans = intervals if is_measures else 1
+    estimated_rows = {
+        table: table_rows[table] * scans
+        for table in sorted(tables_used(definition))
+        if table in table_rows
+    }
+
+    return {
+        "definition": definition,
+        "population_size": population_size,
+        "intervals": intervals if is_measures else None,
+        "returncode": result.returncode,
+        "wall_seconds": round(result.wall_seconds, 3),
+        "cpu_seconds": None if result.cpu_seconds is None else round(result.cpu_seconds, 3),
+        "peak_rss_mb": None if result.peak_rss_mb is None else round(result.peak_rss_mb, 1),
+        "estimated_rows": estimated_rows,
+    }
+
+
+def _key(result):
+    return (result["definition"], result["population_size"], result["intervals"])
+
+
+# Compare results with the baseline, returning regressions where
+#   wall time or peak memory increased by more than the tolerance #
+def find_regressions(results, baseline, tolerance):
+    baseline = {_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        previous = baseline.get(_key(result))
+        if previous is None or result["returncode"] != 0:
+            continue
+        for metric, min_increase in MIN_INCREASE.items():
+            # Not measured in docker
+            if result.get(metric) is None or previous.get(metric) is None:
+                continue
+            increase = result[metric] - previous[metric]
+            if increase > max(previous[metric] * tolerance, min_increase):
+                regressions.append({
+                    "definition": result["definition"],
+                    "population_size": result["population_size"],
+                    "intervals": result["intervals"],
+                    "metric": metric,
+                    "baseline": previous[metric],
+                    "result": result[metric],
+                })
+    return regressions
+
+
+def write_summary(results, path):
+    columns = ["definition", "population_size", "intervals", "returncode",
+               "wall_seconds", "cpu_seconds", "peak_rss_mb"]
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns + ["estimated_rows"])
+        writer.writeheader()
+        for result in results:
+            writer.writerow({
+                **{column: result[column] for column in columns},
+                "estimated_rows": sum(result["estimated_rows"].values()),
+            })
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--definitions", nargs="+", default=DEFAULT_DEFINITIONS)
+    parser.add_argument("--population-sizes", nargs="+", type=int, default=[10000, 100000, 1000000])
+    parser.add_argument("--intervals", nargs="+", type=int, default=[12, 54, 120])
+    parser.add_argument("--start-date", type=str, default="2018-01-01")
+    parser.add_argument("--dummy-tables-dir", type=str, default="output/dummy_tables")
+    parser.add_argument("--ehrql", type=str, default=DEFAULT_EHRQL)
+    parser.add_argument("--baseline", type=str, default=BASELINE_PATH)
+    parser.add_argument("--tolerance", type=float, default=0.2,
+        help="Proportional increase over the baseline flagged as a regression")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--generate-missing", action="store_true",
+        help="Generate synthetic dummy tables (generate_synthetic_data.py) for missing sizes")
+
+    args = parser.parse_args()
+
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+    results = []
+    for population_size in args.population_sizes:
+        dummy_tables = os.path.join(args.dummy_tables_dir, str(population_size))
+        if not os.path.isdir(dummy_tables) and args.generate_missing:
+            from generate_synthetic_data import generate
+            generate(dummy_tables, population_size)
+        if not os.path.isdir(dummy_tables):
+            print(f"Skipping population size {population_size}: no dummy tables in {dummy_tables}")
+            continue
+
+        for definition in args.definitions:
+            is_measures = os.path.basename(definition).startswith("measures_")
+            for intervals in args.intervals if is_measures else [None]:
+                result = benchmark(
+                    definition, population_size, intervals, args.start_date,
+                    args.ehrql, dummy_tables,
+                )
+                results.append(result)
+                usage = f"{result['wall_seconds']}s"
+                if result["peak_rss_mb"] is not None:
+                    usage += f", {result['peak_rss_mb']}MB"
+                print(
+                    f"{definition} n={population_size} intervals={intervals}: {usage}"
+                    + ("" if result["returncode"] == 0 else " (FAILED)")
+                )
+
+    run = {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "results": results,
+    }
+    with open(RESULTS_PATH, "w") as f:
+        json.dump(run, f, indent=2)
+    write_summary(results, os.path.join(OUTPUT_DIR, "summary.csv"))
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(run, f, indent=2)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(
+                "REGRESSION: {definition} n={population_size} intervals={intervals} "
+                "{metric} {baseline} -> {result}".format(**regression)
+            )
+        if regressions:
+            sys.exit(1)
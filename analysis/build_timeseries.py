@@ -0,0 +1,253 @@
+#################################################################
+# This script reshapes the measures files created by
+# split_measures.py into wide time series
+# (output/timeseries/ts_*.csv), i.e.
+# one row per month (and group), with counts of people
+# prescribed opioids and population denominators as columns
+#
+# Measures files are read in chunks, so the measures files are
+# never held in memory, only the (much smaller) time series. With
+# --parquet, the typed Parquet files written by split_measures.py
+# --parquet are read instead of the CSVs, without parsing any text.
+# Either way, months are dates, counts are integers and care home
+# is a boolean
+#
+# Author: Andrea Schaffer
+#   Bennett Institute for Applied Data Science
+#   University of Oxford, 2024
+#####################################################################
+
+import os
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import count_rows_in, count_rows_out, stage
+
+
+CHUNK_SIZE = 500_000
+
+# Stand-in for missing group values in pivots
+MISSING = "__missing__"
+
+# Admin route labels
+ROUTE_LABELS = {
+    "par_opioid": "Parenteral",
+    "buc_opioid": "Buccal",
+    "oral_opioid": "Oral",
+    "trans_opioid": "Transdermal",
+    "rec_opioid": "Rectal",
+    "oth_opioid": "Other",
+    "inh_opioid": "Inhaled",
+}
+
+
+# Parquet measures file in chunks. Dictionary-encoded columns are
+#   decoded to strings, as they're combined with each other #
+def read_parquet_chunks(path, chunk_size):
+    import pyarrow as pa
+    import pyarrow.parquet
+
+    for batch in pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=chunk_size):
+        yield batch.to_pandas(
+            date_as_object=False,
+            types_mapper={pa.int64(): pd.Int64Dtype(), pa.bool_(): pd.BooleanDtype()}.get,
+        ).astype({
+            column.name: object for column in batch.schema if pa.types.is_dictionary(column.type)
+        })
+
+
+# CSV measures file in chunks, with the same types as the Parquet file #
+def read_csv_chunks(path, chunk_size):
+    for chunk in pd.read_csv(path, chunksize=chunk_size, dtype=str):
+        chunk = chunk.astype({"numerator": "Int64", "denominator": "Int64"})
+        for column in ["interval_start", "interval_end"]:
+            chunk[column] = pd.to_datetime(chunk[column], format="%Y-%m-%d")
+        if "carehome" in chunk:
+            # ehrQL writes booleans as T/F
+            chunk["carehome"] = chunk["carehome"].map({"T": True, "F": False}).astype("boolean")
+        yield chunk
+
+
+# Measures file in chunks, with the interval start as the month #
+def read_chunks(measures_dir, name, chunk_size=CHUNK_SIZE, parquet=False):
+    path = os.path.join(measures_dir, f"measures_{name}")
+    if parquet:
+        chunks = read_parquet_chunks(path + ".parquet", chunk_size)
+    else:
+        chunks = read_csv_chunks(path + ".csv", chunk_size)
+    for chunk in chunks:
+        count_rows_in(len(chunk))
+        yield chunk.rename(columns={"interval_start": "month"})
+
+
+# COVID period (pre-COVID, lockdown, recovery) of each month #
+def add_period(data):
+    return data.assign(period=np.where(
+        data["month"] < "2020-03-01",
+        "Pre-COVID",
+        np.where(data["month"] >= "2021-04-01", "Recovery", "Lockdown"),
+    ))
+
+
+# Numerators and denominators of each measure as columns, built up
+#   one chunk at a time (equivalent to tidyr's pivot_wider) #
+class WideTimeSeries:
+
+    def __init__(self, index):
+        self.index = index
+        self.wide = None
+
+    def add(self, data):
+        if data.empty:
+            return
+        piece = (
+            data[self.index + ["measure", "numerator", "denominator"]]
+            .fillna({column: MISSING for column in self.index})
+            .set_index(self.index + ["measure"])
+            .unstack("measure")
+        )
+        self.wide = piece if self.wide is None else self.wide.combine_first(piece)
+
+    def result(self, columns):
+        wide = self.wide.copy()
+        wide.columns = [f"{value}_{measure}" for value, measure in wide.columns]
+        wide = wide.reset_index().replace({column: {MISSING: np.nan} for column in self.index})
+        wide = wide.rename(columns=columns)[self.index + list(columns.values())]
+        return wide.astype({column: "Int64" for column in columns.values()})
+
+
+def write_timeseries(data, timeseries_dir, name):
+    count_rows_out(len(data))
+    data.to_csv(os.path.join(timeseries_dir, f"{name}.csv"), index=False, na_rep="NA")
+
+
+## Overall counts, with and without cancer
+def build_overall(measures_dir, timeseries_dir, parquet=False):
+    overall = WideTimeSeries(["month"])
+    overall_noca = WideTimeSeries(["month"])
+
+    for chunk in read_chunks(measures_dir, "overall", parquet=parquet):
+        nocancer = chunk["measure"].str.contains("_nocancer")
+        overall.add(chunk[~nocancer])
+        noca_chunk = chunk[nocancer]
+        overall_noca.add(noca_chunk.assign(measure=noca_chunk["measure"].str.replace("_nocancer", "")))
+
+    columns = {
+        "numerator_opioid_any": "opioid_any",
+        "numerator_opioid_new": "opioid_new",
+        "numerator_hi_opioid_any": "hi_opioid_any",
+        "denominator_opioid_any": "pop_total",
+        "denominator_opioid_new": "pop_naive",
+    }
+    for name, wide in [("ts_overall", overall), ("ts_overall_nocancer", overall_noca)]:
+        data = add_period(wide.result(columns))
+        data = data[["month", "period"] + list(columns.values())]
+        write_timeseries(data, timeseries_dir, name)
+
+
+## By demographics - prevalent and new prescribing
+def build_demo(measures_dir, timeseries_dir, parquet=False):
+    group_columns = ["age_group", "sex", "region", "imd", "ethnicity6"]
+
+    demo = {}
+    for name, prefix, columns in [
+        ("demo_prev", "opioid_any_", {"numerator_opioid_any": "opioid_any",
+                                      "denominator_opioid_any": "pop_total"}),
+        ("demo_new", "opioid_new_", {"numerator_opioid_new": "opioid_new",
+                                     "denominator_opioid_new": "pop_naive"}),
+    ]:
+        wide = WideTimeSeries(["month", "cat", "var"])
+        for chunk in read_chunks(measures_dir, name, parquet=parquet):
+            # Each measure has one group column, the others are missing
+            chunk["cat"] = chunk[group_columns[0]]
+            for column in group_columns[1:]:
+                chunk["cat"] = chunk["cat"].fillna(chunk[column])
+            chunk["var"] = chunk["measure"].str.replace(prefix, "")
+            chunk["measure"] = chunk["measure"].str[:10]
+            wide.add(chunk)
+        demo[name] = wide.result(columns)
+
+    data = demo["demo_new"].merge(demo["demo_prev"], on=["month", "cat", "var"])
+    data = add_period(data)
+    data = data[["month", "cat", "var", "opioid_new", "pop_naive", "period", "opioid_any", "pop_total"]]
+    data = data.sort_values(["month", "var", "cat"], kind="stable", na_position="last")
+    write_timeseries(data, timeseries_dir, "ts_demo")
+
+
+## By admin route
+def build_type(measures_dir, timeseries_dir, parquet=False):
+    header = True
+    with open(os.path.join(timeseries_dir, "ts_type.csv"), "w", newline="") as f:
+        for chunk in read_chunks(measures_dir, "type", parquet=parquet):
+            chunk = add_period(chunk[~chunk["measure"].str.contains("_nocancer")])
+            chunk = chunk.assign(measure=chunk["measure"].map(ROUTE_LABELS)).rename(
+                columns={"numerator": "opioid_any", "denominator": "pop_total"}
+            )
+            chunk = chunk[["measure", "opioid_any", "pop_total", "month", "period"]]
+            chunk.to_csv(f, index=False, header=header, na_rep="NA")
+            count_rows_out(len(chunk))
+            header = False
+
+
+## In care home, and by age and care home (sensitivity analysis)
+def build_carehome(measures_dir, timeseries_dir, parquet=False):
+    carehome = WideTimeSeries(["month"])
+    carehome_sens = []
+
+    for chunk in read_chunks(measures_dir, "carehome", parquet=parquet):
+        sens = chunk["measure"].str.contains("carehome_age")
+        carehome.add(chunk[~sens])
+
+        sens_chunk = add_period(chunk[sens]).rename(
+            columns={"numerator": "opioid_any", "denominator": "pop_total"}
+        )
+        sens_chunk["carehome"] = np.where(sens_chunk["carehome"].fillna(False), "Yes", "No")
+        carehome_sens.append(
+            sens_chunk[["opioid_any", "pop_total", "age_group", "carehome", "month", "period"]]
+        )
+
+    columns = {
+        "numerator_opioid_any": "opioid_any",
+        "numerator_hi_opioid_any": "hi_opioid_any",
+        "numerator_opioid_new": "opioid_new",
+        "numerator_oral_opioid": "oral_opioid_any",
+        "numerator_trans_opioid": "trans_opioid_any",
+        "numerator_par_opioid": "par_opioid_any",
+        "denominator_opioid_any": "pop_total",
+        "denominator_opioid_new": "pop_naive",
+    }
+    data = add_period(carehome.result(columns))
+    data = data[["month", "period"] + list(columns.values())]
+    write_timeseries(data, timeseries_dir, "ts_carehome")
+
+    data = pd.concat(carehome_sens).sort_values(
+        ["month", "age_group", "carehome"], kind="stable", na_position="last"
+    )
+    write_timeseries(data, timeseries_dir, "ts_carehome_sens")
+
+
+TIMESERIES = {
+    "overall": build_overall,
+    "demo": build_demo,
+    "type": build_type,
+    "carehome": build_carehome,
+}
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--measures-dir", type=str, default="output/measures")
+    parser.add_argument("--output-dir", type=str, default="output/timeseries")
+    parser.add_argument("--timeseries", nargs="+", choices=list(TIMESERIES), default=list(TIMESERIES))
+    parser.add_argument("--parquet", action="store_true",
+        help="Read the Parquet measures files (split_measures.py --parquet) rather than the CSVs")
+
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    for name in args.timeseries:
+        with stage(f"build_timeseries/{name}"):
+            TIMESERIES[name](args.measures_dir, args.output_dir, parquet=args.parquet)
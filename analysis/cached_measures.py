@@ -0,0 +1,404 @@
+####################################################################
+# This script caches measures results on disk, one entry per
+#   measure and interval, so that only the measures and intervals
+#   that have changed are recomputed, e.g. adding one measure to
+#   measures_overall.py only runs ehrQL for that measure
+#
+# Each entry is keyed by a hash of the measure's numerator,
+#   denominator and group_by expressions (so renaming a measure, or
+#   editing another measure, does not invalidate it), the codelist
+#   versions in codelists/codelists.json, the interval and the data:
+#   a hash of the --dummy-tables files, or otherwise a --data-version
+#   (e.g. the date of the data extract), which is required when
+#   running against the backend so that results from one extract are
+#   never used for another. The least recently used entries are
+#   removed when the cache is larger than --max-size-mb
+#
+# Computing the keys loads the measures definition, so needs ehrQL
+#   to be importable (i.e. a locally installed ehrQL)
+#
+# Usage (from the project root):
+#   python analysis/cached_measures.py run analysis/measures_overall.py \
+#     --start-date 2018-01-01 --intervals 54 --data-version 2024-05-01 --max-size-mb 500
+#   python analysis/cached_measures.py stats
+#   python analysis/cached_measures.py evict --max-size-mb 100
+#   python analysis/cached_measures.py purge
+#
+# Author: Andrea Schaffer
+#   Bennett Institute for Applied Data Science
+#   University of Oxford, 2024
+#####################################################################
+
+
+import dataclasses
+import hashlib
+import json
+import os
+import runpy
+import shlex
+import sys
+import time
+from argparse import ArgumentParser
+
+from ehrql_local import (
+    DEFAULT_EHRQL,
+    ANALYSIS_DIR,
+    add_months,
+    ehrql_command,
+    months_between,
+    run_command,
+    uses_docker)
+from instrumentation import record_run, stage
+from run_measures import default_output, read_csv, sort_measures_rows, write_csv_atomic
+
+
+CACHE_DIR = "output/measures/cache"
+
+# Bump to invalidate all existing entries, e.g. if the key changes
+CACHE_VERSION = 2
+
+BASE_COLUMNS = ["measure", "interval_start", "interval_end", "ratio", "numerator", "denominator"]
+
+
+class MeasuresCache:
+    """Measures results for one measure and interval, stored as one
+    CSV per entry in <directory>/<key[:2]>/<key>.csv.
+
+    Reading an entry updates its modification time, which is used as
+    the last use time for least recently used eviction.
+    """
+
+    def __init__(self, directory=CACHE_DIR):
+        self.directory = directory
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.csv")
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            header, rows = read_csv(path)
+        except FileNotFoundError:
+            return None
+        os.utime(path)
+        return [dict(zip(header, row)) for row in rows]
+
+    def put(self, key, header, rows):
+        write_csv_atomic(self.path(key), header, [[row[column] for column in header] for row in rows])
+
+    # (path, size in bytes, last used time) of each entry #
+    def entries(self):
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".csv"):
+                    stat = os.stat(os.path.join(root, name))
+                    entries.append((os.path.join(root, name), stat.st_size, stat.st_mtime))
+        return entries
+
+    def stats(self):
+        entries = self.entries()
+        return {
+            "entries": len(entries),
+            "size_mb": sum(size for _, size, _ in entries) / 1024 / 1024,
+            "oldest": min((used for _, _, used in entries), default=None),
+            "newest": max((used for _, _, used in entries), default=None),
+        }
+
+    # Remove least recently used entries until the cache is no larger
+    #   than max_size_mb. Returns the no. entries removed #
+    def evict(self, max_size_mb):
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        size = sum(size for _, size, _ in entries)
+        removed = 0
+        for path, entry_size, _ in entries:
+            if size <= max_size_mb * 1024 * 1024:
+                break
+            os.remove(path)
+            size -= entry_size
+            removed += 1
+        return removed
+
+    # Remove all entries (or those not used in the last older_than_days) #
+    def purge(self, older_than_days=None):
+        cutoff = None if older_than_days is None else time.time() - older_than_days * 24 * 60 * 60
+        removed = 0
+        for path, _, used in self.entries():
+            if cutoff is None or used < cutoff:
+                os.remove(path)
+                removed += 1
+        return removed
+
+
+# Hash of an ehrQL query model node. Nodes are hashed from the hashes
+#   of their fields, so subexpressions shared between measures are
+#   only hashed once, and sets (e.g. codelists) are sorted so that the
+#   hash is the same in every Python process #
+def node_hash(node, memo):
+    if id(node) in memo:
+        return memo[id(node)][0]
+
+    if isinstance(node, type):
+        content = ["type", f"{node.__module__}.{node.__qualname__}"]
+    elif dataclasses.is_dataclass(node):
+        content = [type(node).__name__] + [
+            [field.name, node_hash(getattr(node, field.name), memo)]
+            for field in dataclasses.fields(node)
+        ]
+    elif isinstance(node, (set, frozenset)):
+        content = ["set"] + sorted(node_hash(value, memo) for value in node)
+    elif isinstance(node, dict):
+        content = ["dict"] + sorted(
+            [node_hash(key, memo), node_hash(value, memo)] for key, value in node.items()
+        )
+    elif isinstance(node, (list, tuple)):
+        content = ["list"] + [node_hash(value, memo) for value in node]
+    elif node is None or isinstance(node, (str, int, float, bool)):
+        content = [type(node).__name__, node]
+    elif hasattr(node, "__dict__"):
+        content = [type(node).__name__, node_hash(vars(node), memo)]
+    else:
+        content = [type(node).__name__, repr(node)]
+
+    digest = hashlib.sha256(json.dumps(content).encode("utf8")).hexdigest()
+    # Keep a reference to the node, so that its id isn't reused
+    memo[id(node)] = (digest, node)
+    return digest
+
+
+# Versions of the codelists, from codelists/codelists.json #
+def codelist_versions(codelists_path="codelists/codelists.json"):
+    with open(codelists_path) as f:
+        files = json.load(f)["files"]
+    return {name: details["sha"] for name, details in sorted(files.items())}
+
+
+def _qm_node(series):
+    return getattr(series, "_qm_node", series)
+
+
+# Hash of a measure's expressions, which doesn't depend on its name #
+def measure_hash(measure, memo):
+    return node_hash([
+        _qm_node(measure.numerator),
+        _qm_node(measure.denominator),
+        [[name, _qm_node(series)] for name, series in measure.group_by.items()],
+    ], memo)
+
+
+# Hash of the dummy tables' file names and contents #
+def dummy_tables_hash(dummy_tables):
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(dummy_tables)):
+        path = os.path.join(dummy_tables, name)
+        if not os.path.isfile(path):
+            continue
+        digest.update(name.encode("utf8"))
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+# Identity of the data results are computed from: the dummy tables'
+#   contents, or the data version when running against the backend #
+def data_identity(data_version=None, dummy_tables=None):
+    if dummy_tables is not None:
+        return {"dummy_tables": dummy_tables_hash(dummy_tables), "data_version": data_version}
+    if not data_version:
+        raise RuntimeError(
+            "A --data-version (e.g. the extract date) is needed to cache results from the "
+            "backend, so that results from other extracts aren't used"
+        )
+    return {"data_version": data_version}
+
+
+def cache_key(expression_hash, codelists, interval_start, interval_end, data):
+    content = {
+        "version": CACHE_VERSION,
+        "measure": expression_hash,
+        "codelists": codelists,
+        "interval": [interval_start, interval_end],
+        "data": data,
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode("utf8")).hexdigest()
+
+
+# Load the measures defined by a measures definition #
+def load_measures(definition, start_date, intervals):
+    from ehrql import Measures
+
+    argv, path = sys.argv, list(sys.path)
+    sys.argv = [definition, "--start-date", start_date, "--intervals", str(intervals)]
+    sys.path.insert(0, ANALYSIS_DIR)
+    try:
+        namespace = runpy.run_path(definition)
+    finally:
+        sys.argv, sys.path[:] = argv, path
+
+    measures = [value for value in namespace.values() if isinstance(value, Measures)]
+    if len(measures) != 1:
+        raise ValueError(f"{definition} should define one Measures object")
+    return list(measures[0])
+
+
+# Run a measures definition, only computing the measures and intervals
+#   not in the cache, and combine the cached and new results into the
+#   output. Returns (no. rows, no. cached entries used, no. entries
+#   computed) #
+def run_cached(definition, start_date, intervals, output=None, cache=None, data_version=None,
+               ehrql=DEFAULT_EHRQL, dummy_tables=None, max_memory_mb=None):
+    output = output or default_output(definition)
+    cache = cache or MeasuresCache()
+    codelists = codelist_versions()
+    data = data_identity(data_version, dummy_tables)
+
+    memo = {}
+    keys = {}
+    for measure in load_measures(definition, start_date, intervals):
+        expression_hash = measure_hash(measure, memo)
+        for interval_start, interval_end in measure.intervals:
+            keys[measure.name, interval_start.isoformat()] = cache_key(
+                expression_hash, codelists,
+                interval_start.isoformat(), interval_end.isoformat(), data,
+            )
+
+    results = {entry: cache.get(key) for entry, key in keys.items()}
+    missing = [entry for entry, rows in results.items() if rows is None]
+    n_cached = len(results) - len(missing)
+
+    if missing:
+        # Run the missing measures for all intervals from the first to
+        #   the last missing interval
+        names = list(dict.fromkeys(name for name, _ in missing))
+        first = min(interval_start for _, interval_start in missing)
+        n_intervals = months_between(first, max(interval_start for _, interval_start in missing)) + 1
+
+        new_output = output + ".new"
+        command = ehrql_command(
+            ehrql,
+            definition,
+            output=new_output,
+            dummy_tables=dummy_tables,
+            user_args=[
+                "--start-date", first,
+                "--intervals", str(n_intervals),
+                "--measures", ",".join(names),
+            ],
+        )
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+        log_path = output[:-4] + ".log"
+        result = run_command(command, log_path=log_path, max_memory_mb=max_memory_mb)
+        if result.returncode != 0:
+            record_run("cached_measures/ehrql", result, definition=definition)
+            raise RuntimeError(f"ehrQL failed running {definition} (see {log_path})")
+
+        header, rows = read_csv(new_output)
+        os.remove(new_output)
+        record_run("cached_measures/ehrql", result, rows_out=len(rows), definition=definition,
+                   measures=len(names), intervals=n_intervals)
+
+        new_results = {
+            (name, add_months(first, offset)): []
+            for name in names
+            for offset in range(n_intervals)
+        }
+        for row in rows:
+            row = dict(zip(header, row))
+            new_results[row["measure"], row["interval_start"]].append(row)
+
+        for entry, entry_rows in new_results.items():
+            if entry in keys:
+                cache.put(keys[entry], header, entry_rows)
+                results[entry] = entry_rows
+
+    # Columns as in ehrQL's output - group_by columns in the order they
+    #   first appear in the measures
+    columns = list(BASE_COLUMNS)
+    for entry_rows in results.values():
+        for row in entry_rows:
+            columns.extend(column for column in row if column not in columns)
+
+    rows = [
+        [name if column == "measure" else row.get(column, "") for column in columns]
+        for (name, _), entry_rows in results.items()
+        for row in entry_rows
+    ]
+    write_csv_atomic(output, columns, sort_measures_rows(columns, rows))
+
+    return len(rows), n_cached, len(missing)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--cache-dir", type=str, default=CACHE_DIR)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Run a measures definition using the cache")
+    run_parser.add_argument("definition", type=str)
+    run_parser.add_argument("--start-date", type=str, default="2018-01-01")
+    run_parser.add_argument("--intervals", type=int, default=54)
+    run_parser.add_argument("--output", type=str,
+        help="Default output/measures/<definition>.csv")
+    run_parser.add_argument("--data-version", type=str,
+        help="Version of the data (e.g. extract date); cached results for other versions aren't "
+             "used. Required unless running against --dummy-tables")
+    run_parser.add_argument("--max-size-mb", type=float,
+        help="Evict least recently used entries to keep the cache below this size")
+    run_parser.add_argument("--max-memory-mb", type=int,
+        help="Address space limit for the ehrQL job (needs a locally installed "
+             "ehrQL, e.g. --ehrql ehrql)")
+    run_parser.add_argument("--ehrql", type=str, default=DEFAULT_EHRQL)
+    run_parser.add_argument("--dummy-tables", type=str)
+
+    subparsers.add_parser("stats", help="Report the size of the cache")
+
+    evict_parser = subparsers.add_parser("evict", help="Remove least recently used entries")
+    evict_parser.add_argument("--max-size-mb", type=float, required=True)
+
+    purge_parser = subparsers.add_parser("purge", help="Remove all entries")
+    purge_parser.add_argument("--older-than-days", type=float,
+        help="Only remove entries not used in this many days")
+
+    args = parser.parse_args()
+
+    if args.command == "run" and args.max_memory_mb and uses_docker(shlex.split(args.ehrql)):
+        run_parser.error("--max-memory-mb needs a locally installed ehrQL (e.g. --ehrql ehrql)")
+
+    cache = MeasuresCache(args.cache_dir)
+
+    if args.command == "run":
+        try:
+            with stage("cached_measures/run", definition=args.definition) as s:
+                n_rows, n_cached, n_computed = run_cached(
+                    args.definition,
+                    args.start_date,
+                    args.intervals,
+                    output=args.output,
+                    cache=cache,
+                    data_version=args.data_version,
+                    ehrql=args.ehrql,
+                    dummy_tables=args.dummy_tables,
+                    max_memory_mb=args.max_memory_mb,
+                )
+                s.rows_out = n_rows
+                s.attributes.update(cached=n_cached, computed=n_computed)
+        except RuntimeError as e:
+            sys.exit(str(e))
+        print(f"Wrote {n_rows} rows ({n_cached} measure-intervals from the cache, {n_computed} computed)")
+        if args.max_size_mb is not None:
+            print(f"Evicted {cache.evict(args.max_size_mb)} entries")
+
+    elif args.command == "stats":
+        stats = cache.stats()
+        print(f"{stats['entries']} entries, {stats['size_mb']:.1f}MB")
+        if stats["entries"]:
+            for label in ["oldest", "newest"]:
+                used = time.strftime("%Y-%m-%d %H:%M", time.localtime(stats[label]))
+                print(f"{label.capitalize()} last used: {used}")
+
+    elif args.command == "evict":
+        print(f"Evicted {cache.evict(args.max_size_mb)} entries")
+
+    elif args.command == "purge":
+        print(f"Removed {cache.purge(args.older_than_days)} entries")
@@ -0,0 +1,48 @@
+###################################################
+# This script defines care home residence, based on
+#   PRIMIS long-term residential care codes or a TPP
+#   address matched to a care home, shared by the
+#   measures and dataset definitions
+#
+# The date of each person's first PRIMIS code doesn't
+#   depend on the index date, so is defined once and
+#   compared with the index date of each interval rather
+#   than searching clinical events again for each one
+#
+# Author: Andrea Schaffer
+#   Bennett Institute for Applied Data Science
+#   University of Oxford, 2024
+#####################################################################
+
+
+from ehrql import case, when
+from ehrql.tables.tpp import (
+    addresses,
+    clinical_events)
+
+import codelists
+
+
+# Date of first PRIMIS care home code #
+first_primis_date = clinical_events.where(
+        clinical_events.snomedct_code.is_in(codelists.carehome_primis_codes)
+    ).date.minimum_for_patient()
+
+
+# PRIMIS care home code on or before index date #
+def make_carehome_primis(index_date):
+    return first_primis_date.is_on_or_before(index_date)
+
+
+# Address on index date matched to a care home #
+def make_carehome_tpp(index_date):
+    return addresses.for_patient_on(index_date).care_home_is_potential_match
+
+
+# In care home based on primis codes/TPP address match #
+def make_carehome(index_date):
+    return case(
+        when(make_carehome_primis(index_date)).then(True),
+        when(make_carehome_tpp(index_date)).then(True),
+        otherwise=False
+    )
@@ -0,0 +1,257 @@
+####################################################################
+# This script compiles all of the codelists used in this project
+#   into a single binary file (codelists/codelists_compiled.bin)
+#   that is quicker to load than parsing the CSVs.
+#
+# Each codelist is stored as a sorted array of integer codes, with
+#   an array of category indices for categorised codelists, plus the
+#   size, modification time and sha256 checksum of each source CSV so
+#   that a stale bundle (i.e. a CSV updated after the bundle was
+#   built) is detected. Loading the bundle only checks the sizes and
+#   modification times; the CSVs are only read and hashed if those
+#   have changed (e.g. after a fresh checkout).
+#
+# Usage (from the project root, after updating codelists):
+#   python analysis/codelist_bundle.py
+# which also reports how many duplicate codes were removed from
+#   each combined codelist
+#
+# Author: Andrea Schaffer
+#   Bennett Institute for Applied Data Science
+#   University of Oxford, 2024
+#####################################################################
+
+
+import csv
+import hashlib
+import json
+import os
+import struct
+import sys
+from array import array
+
+from codeset import CodeSet
+
+
+BUNDLE_PATH = "codelists/codelists_compiled.bin"
+
+MAGIC = b"OPCL"
+VERSION = 1
+
+# Codelist name -> (CSV file, code column, category column)
+CODELIST_SOURCES = {
+    "carehome_primis_codes": ("codelists/primis-covid19-vacc-uptake-longres.csv", "code", None),
+    "oth_ca_codes": ("codelists/opensafely-cancer-excluding-lung-and-haematological-snomed.csv", "id", None),
+    "lung_ca_codes": ("codelists/opensafely-lung-cancer-snomed.csv", "id", None),
+    "haem_ca_codes": ("codelists/opensafely-haematological-cancer-snomed.csv", "id", None),
+    "hi_opioid_codes": ("codelists/opensafely-high-dose-long-acting-opioids-openprescribing-dmd.csv", "code", None),
+    "buc_opioid_codes": ("codelists/opensafely-opioid-containing-medicines-buccal-nasal-and-oromucosal-excluding-drugs-for-substance-misuse-dmd.csv", "code", None),
+    "inh_opioid_codes": ("codelists/opensafely-opioid-containing-medicines-inhalation-excluding-drugs-for-substance-misuse-dmd.csv", "code", None),
+    "oral_opioid_codes": ("codelists/opensafely-opioid-containing-medicines-oral-excluding-drugs-for-substance-misuse-dmd.csv", "code", None),
+    "par_opioid_codes": ("codelists/opensafely-opioid-containing-medicines-parenteral-excluding-drugs-for-substance-misuse-dmd.csv", "code", None),
+    "rec_opioid_codes": ("codelists/opensafely-opioid-containing-medicines-rectal-excluding-drugs-for-substance-misuse-dmd.csv", "code", None),
+    "trans_opioid_codes": ("codelists/opensafely-opioid-containing-medicines-transdermal-excluding-drugs-for-substance-misuse-dmd.csv", "code", None),
+    "ethnicity_codes_16": ("codelists/opensafely-ethnicity-snomed-0removed.csv", "snomedcode", "Grouping_16"),
+    "ethnicity_codes_6": ("codelists/opensafely-ethnicity-snomed-0removed.csv", "snomedcode", "Grouping_6"),
+}
+
+# Combined codelists and the codelists they are the union of
+COMBINED_CODELISTS = {
+    "cancer_codes": ["oth_ca_codes", "lung_ca_codes", "haem_ca_codes"],
+    "oth_opioid_codes": ["buc_opioid_codes", "inh_opioid_codes", "rec_opioid_codes"],
+    "opioid_codes": [
+        "buc_opioid_codes",
+        "inh_opioid_codes",
+        "oral_opioid_codes",
+        "par_opioid_codes",
+        "rec_opioid_codes",
+        "trans_opioid_codes",
+    ],
+}
+
+# Route of administration of each opioid codelist, compiled into a
+#   single code -> route table
+OPIOID_ROUTES = {
+    "buc": "buc_opioid_codes",
+    "inh": "inh_opioid_codes",
+    "oral": "oral_opioid_codes",
+    "par": "par_opioid_codes",
+    "rec": "rec_opioid_codes",
+    "trans": "trans_opioid_codes",
+}
+
+
+# Checksums of the source CSVs #
+def source_checksums():
+    checksums = {}
+    for path, _, _ in CODELIST_SOURCES.values():
+        with open(path, "rb") as f:
+            checksums[path] = hashlib.sha256(f.read()).hexdigest()
+    return checksums
+
+
+# Sizes and modification times of the source CSVs #
+def source_stats():
+    stats = {}
+    for path, _, _ in CODELIST_SOURCES.values():
+        stat = os.stat(path)
+        stats[path] = [stat.st_size, stat.st_mtime_ns]
+    return stats
+
+
+# Read one codelist from its CSV as {code: category} #
+def read_source(name):
+    path, column, category_column = CODELIST_SOURCES[name]
+    codes = {}
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            code = row[column].strip()
+            if not code:
+                continue
+            if not code.isdigit():
+                raise ValueError(f"{path}: code {code!r} is not numeric so cannot be compiled")
+            codes[int(code)] = row[category_column] if category_column else None
+    return codes
+
+
+def _to_bytes(values, typecode):
+    values = array(typecode, values)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_bytes(data, typecode):
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+# Number of codes in each combined codelist before and after
+#   removing duplicate codes #
+def union_report():
+    report = {}
+    for name, parts in COMBINED_CODELISTS.items():
+        codes = [code for part in parts for code in read_source(part)]
+        report[name] = {
+            "codes": len(codes),
+            "unique_codes": len(set(codes)),
+            "duplicates_removed": len(codes) - len(set(codes)),
+        }
+    return report
+
+
+# Compile all codelists into the bundle #
+def build_bundle(path=BUNDLE_PATH):
+    codelists = {name: read_source(name) for name in CODELIST_SOURCES}
+
+    codelists["opioid_route_codes"] = {
+        code: route
+        for route, name in OPIOID_ROUTES.items()
+        for code in codelists[name]
+    }
+
+    entries = {}
+    blocks = []
+    offset = 0
+    for name, codes in codelists.items():
+        sorted_codes = sorted(codes)
+        entry = {"offset": offset, "length": len(sorted_codes), "categories": None}
+        blocks.append(_to_bytes(sorted_codes, "Q"))
+        offset += 8 * len(sorted_codes)
+
+        if any(category is not None for category in codes.values()):
+            categories = sorted(set(codes.values()))
+            index = {category: i for i, category in enumerate(categories)}
+            entry["categories"] = categories
+            entry["category_offset"] = offset
+            blocks.append(_to_bytes([index[codes[code]] for code in sorted_codes], "H"))
+            offset += 2 * len(sorted_codes)
+
+        entries[name] = entry
+
+    header = json.dumps(
+        {"checksums": source_checksums(), "stats": source_stats(), "codelists": entries},
+        sort_keys=True,
+    ).encode("utf8")
+
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<II", VERSION, len(header)))
+        f.write(header)
+        for block in blocks:
+            f.write(block)
+
+
+class CodelistBundle:
+    """Compiled codelists, decoded on first access to each codelist.
+
+    Plain codelists are returned as a CodeSet and categorised
+    codelists as a {code: category} dict, as with codelist_from_csv.
+    """
+
+    def __init__(self, data):
+        if data[:4] != MAGIC:
+            raise ValueError("Not a compiled codelist bundle")
+        version, header_length = struct.unpack("<II", data[4:12])
+        if version != VERSION:
+            raise ValueError(f"Unsupported codelist bundle version: {version}")
+        header = json.loads(data[12:12 + header_length].decode("utf8"))
+        self.checksums = header["checksums"]
+        self.stats = header.get("stats", {})
+        self.entries = header["codelists"]
+        self._data = memoryview(data)[12 + header_length:]
+        self._decoded = {}
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __getitem__(self, name):
+        if name not in self._decoded:
+            self._decoded[name] = self._decode(self.entries[name])
+        return self._decoded[name]
+
+    def _decode(self, entry):
+        start, length = entry["offset"], entry["length"]
+        codes = [str(code) for code in _from_bytes(self._data[start:start + 8 * length], "Q")]
+        if entry["categories"] is None:
+            return CodeSet.from_sorted(codes)
+
+        start = entry["category_offset"]
+        categories = entry["categories"]
+        index = _from_bytes(self._data[start:start + 2 * length], "H")
+        return {code: categories[i] for code, i in zip(codes, index)}
+
+    # Unchanged sizes and modification times mean the CSVs haven't
+    #   changed; otherwise, compare their contents #
+    def is_stale(self):
+        try:
+            if self.stats == source_stats():
+                return False
+            return self.checksums != source_checksums()
+        except FileNotFoundError:
+            return True
+
+
+# Load the bundle, or return None if it is missing or out of date #
+def load_bundle(path=BUNDLE_PATH):
+    try:
+        with open(path, "rb") as f:
+            bundle = CodelistBundle(f.read())
+    except (FileNotFoundError, ValueError):
+        return None
+    if bundle.is_stale():
+        return None
+    return bundle
+
+
+if __name__ == "__main__":
+    build_bundle()
+
+    for name, counts in union_report().items():
+        print(
+            f"{name}: {counts['codes']} codes, {counts['unique_codes']} unique "
+            f"({counts['duplicates_removed']} duplicates removed)"
+        )
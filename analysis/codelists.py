@@ -1,8 +1,12 @@
 ####################################################################
-# This script fetches all of the codelists identified in 
+# This script fetches all of the codelists identified in
 # codelists.txt from OpenCodelists.
 #
-# Author: Andrea Schaffer 
+# Codelists are loaded lazily (on first use) from the compiled
+# bundle built by codelist_bundle.py, falling back to parsing the
+# CSVs if the bundle is missing or older than the CSVs.
+#
+# Author: Andrea Schaffer
 #   Bennett Institute for Applied Data Science
 #   University of Oxford, 2024
 #####################################################################
@@ -13,113 +17,91 @@
 ## Import code building blocks from cohort extractor package
 from ehrql import codelist_from_csv
 
- 
+from codelist_bundle import (
+    CODELIST_SOURCES,
+    COMBINED_CODELISTS,
+    OPIOID_ROUTES,
+    load_bundle)
+from codeset import CodeSet
+
+
 # --- CODELISTS ---
 
-## Care home - use primis based on Schultze et al report (10.12688/wellcomeopenres.16737.1)
-carehome_primis_codes = codelist_from_csv(
-  "codelists/primis-covid19-vacc-uptake-longres.csv", 
-  column = "code",
-)
-
-## Cancer 
-
-###  Cancer - excluding lung/haem
-oth_ca_codes = codelist_from_csv(
-  "codelists/opensafely-cancer-excluding-lung-and-haematological-snomed.csv",
-  column = "id"
-)
-
-### Cancer - lung
-lung_ca_codes = codelist_from_csv(
-  "codelists/opensafely-lung-cancer-snomed.csv",
-  column = "id"
-)
-
-### Cancer - haematological
-haem_ca_codes = codelist_from_csv(
-  "codelists/opensafely-haematological-cancer-snomed.csv",
-  column = "id"
-)
-
-### All cancer combined
-cancer_codes = (
-  oth_ca_codes +
-  lung_ca_codes +
-  haem_ca_codes
-)
-
-## Medication DM&D
-### High dose, long-acting opioids 
-hi_opioid_codes = codelist_from_csv(
-  "codelists/opensafely-high-dose-long-acting-opioids-openprescribing-dmd.csv",
-  column = "code",
-)
-
-### Buccal opioids
-buc_opioid_codes = codelist_from_csv(
-  "codelists/opensafely-opioid-containing-medicines-buccal-nasal-and-oromucosal-excluding-drugs-for-substance-misuse-dmd.csv",
-  column = "code",
-)
-
-### Inhaled opioids
-inh_opioid_codes = codelist_from_csv(
-  "codelists/opensafely-opioid-containing-medicines-inhalation-excluding-drugs-for-substance-misuse-dmd.csv",
-  column = "code",
-)
-
-### Oral opioids
-oral_opioid_codes = codelist_from_csv(
-  "codelists/opensafely-opioid-containing-medicines-oral-excluding-drugs-for-substance-misuse-dmd.csv",
-  column = "code",
-)
-
-### Parenteral opioids
-par_opioid_codes = codelist_from_csv(
-  "codelists/opensafely-opioid-containing-medicines-parenteral-excluding-drugs-for-substance-misuse-dmd.csv",
-  column = "code",
-)
-
-### Rectal opioids
-rec_opioid_codes = codelist_from_csv(
-  "codelists/opensafely-opioid-containing-medicines-rectal-excluding-drugs-for-substance-misuse-dmd.csv",
-  column = "code",
-)
-
-### Transdermal opioids
-trans_opioid_codes = codelist_from_csv(
-  "codelists/opensafely-opioid-containing-medicines-transdermal-excluding-drugs-for-substance-misuse-dmd.csv",
-  column = "code",
-)
-
-
-### Other opioid
-oth_opioid_codes = (
-  buc_opioid_codes +
-  inh_opioid_codes +
-  rec_opioid_codes
-)
-
-### Any opioid
-opioid_codes = (
-  buc_opioid_codes +
-  inh_opioid_codes +
-  oral_opioid_codes +
-  par_opioid_codes +
-  rec_opioid_codes +
-  trans_opioid_codes
-)
-
-## Ethnicity
-ethnicity_codes_16 = codelist_from_csv(
-    "codelists/opensafely-ethnicity-snomed-0removed.csv",
-    column="snomedcode",
-    category_column="Grouping_16",
-)
-
-## Ethnicity
-ethnicity_codes_6 = codelist_from_csv(
-    "codelists/opensafely-ethnicity-snomed-0removed.csv",
-    column="snomedcode",
-    category_column="Grouping_6",
-)
+## Codelists read from CSV (see CODELIST_SOURCES in codelist_bundle.py)
+##   Care home - use primis based on Schultze et al report (10.12688/wellcomeopenres.16737.1)
+##     carehome_primis_codes
+##   Cancer - excluding lung/haem, lung, haematological
+##     oth_ca_codes, lung_ca_codes, haem_ca_codes
+##   Medication DM&D - high dose, long-acting opioids
+##     hi_opioid_codes
+##   Medication DM&D - buccal, inhaled, oral, parenteral, rectal, transdermal opioids
+##     buc_opioid_codes, inh_opioid_codes, oral_opioid_codes,
+##     par_opioid_codes, rec_opioid_codes, trans_opioid_codes
+##   Ethnicity - 16 and 6 categories
+##     ethnicity_codes_16, ethnicity_codes_6
+
+_bundle = None
+_bundle_loaded = False
+
+
+def _get_bundle():
+    global _bundle, _bundle_loaded
+    if not _bundle_loaded:
+        _bundle = load_bundle()
+        _bundle_loaded = True
+    return _bundle
+
+
+def _load(name):
+    bundle = _get_bundle()
+    if bundle is not None and name in bundle:
+        return bundle[name]
+
+    path, column, category_column = CODELIST_SOURCES[name]
+    if category_column is None:
+        return CodeSet(codelist_from_csv(path, column=column))
+    return codelist_from_csv(path, column=column, category_column=category_column)
+
+
+## Combined codelists (see COMBINED_CODELISTS in codelist_bundle.py)
+##   All cancer combined - cancer_codes
+##   Other opioid - oth_opioid_codes
+##   Any opioid - opioid_codes
+## Built as deduplicated unions, so codes in more than one codelist
+##   (e.g. cancer codes also in the lung cancer codelist) appear once
+def _combined(name):
+    return CodeSet.union(*[_get(part) for part in COMBINED_CODELISTS[name]])
+
+
+def _opioid_route_codes():
+    ### Route of administration for any opioid (dm+d code -> route)
+    bundle = _get_bundle()
+    if bundle is not None and "opioid_route_codes" in bundle:
+        return bundle["opioid_route_codes"]
+    return {
+      code: route
+      for route, name in OPIOID_ROUTES.items()
+      for code in _get(name)
+    }
+
+
+_COMBINED = {
+    **{name: lambda name=name: _combined(name) for name in COMBINED_CODELISTS},
+    "opioid_route_codes": _opioid_route_codes,
+}
+
+
+def _get(name):
+    if name not in globals():
+        if name in CODELIST_SOURCES:
+            globals()[name] = _load(name)
+        else:
+            globals()[name] = _COMBINED[name]()
+    return globals()[name]
+
+
+# Codelists are attributes of this module, e.g. codelists.opioid_codes
+def __getattr__(name):
+    if name in CODELIST_SOURCES or name in _COMBINED:
+        return _get(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
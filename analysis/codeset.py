@@ -0,0 +1,65 @@
+####################################################################
+# This script defines a codelist type that keeps codes sorted and
+#   deduplicated, so that combined codelists (e.g. all cancer codes)
+#   don't contain the same code more than once and the is_in
+#   filters built from them are as small as possible
+#
+# Author: Andrea Schaffer
+#   Bennett Institute for Applied Data Science
+#   University of Oxford, 2024
+#####################################################################
+
+
+from heapq import merge
+
+
+# Sort numeric codes (SNOMED CT, dm+d) in numeric order #
+def _code_order(code):
+    return (len(code), code)
+
+
+class CodeSet(list):
+    """Sorted, deduplicated list of codes with set operations.
+
+    Can be used anywhere a list of codes can (e.g. is_in). Combine
+    codelists with | (union), & (intersection) and - (difference)
+    rather than + so that no duplicates are introduced.
+    """
+
+    def __init__(self, codes=()):
+        super().__init__(sorted(set(codes), key=_code_order))
+
+    @classmethod
+    def from_sorted(cls, codes):
+        """Build from codes that are already sorted and deduplicated."""
+        codeset = cls()
+        list.extend(codeset, codes)
+        return codeset
+
+    @classmethod
+    def union(cls, *codelists):
+        codelists = [c if isinstance(c, CodeSet) else CodeSet(c) for c in codelists]
+        codes = []
+        for code in merge(*codelists, key=_code_order):
+            if not codes or codes[-1] != code:
+                codes.append(code)
+        return cls.from_sorted(codes)
+
+    def __or__(self, other):
+        return CodeSet.union(self, other)
+
+    def __ror__(self, other):
+        return CodeSet.union(other, self)
+
+    def __and__(self, other):
+        other = set(other)
+        return CodeSet.from_sorted(code for code in self if code in other)
+
+    __rand__ = __and__
+
+    def __sub__(self, other):
+        other = set(other)
+        return CodeSet.from_sorted(code for code in self if code not in other)
+
+    def __rsub__(self, other):
+        return CodeSet(other) - self
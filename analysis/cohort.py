@@ -0,0 +1,63 @@
+###################################################
+# This script defines the study population - adults
+#   alive and registered with a practice on the index
+#   date - shared by the measures and dataset definitions
+#
+# The population is built from a single base expression,
+#   with variants (e.g. aged 60+) derived by combining it
+#   with extra conditions, so every measure and interval
+#   uses the same registration/death/sex conditions and
+#   ehrQL only evaluates them once per interval
+#
+# Author: Andrea Schaffer
+#   Bennett Institute for Applied Data Science
+#   University of Oxford, 2024
+#####################################################################
+
+
+from ehrql.tables.tpp import (
+    patients,
+    practice_registrations)
+
+
+# Registrations spanning the whole period from start_date to end_date
+#   (the same spells as practice_registrations.for_patient_on() for a
+#   single date), i.e. starting on or before start_date and ending on
+#   or after end_date, or not ended #
+def registration_spells(start_date, end_date):
+    return practice_registrations.where(
+        practice_registrations.start_date.is_on_or_before(start_date)
+    ).except_where(
+        practice_registrations.end_date.is_before(end_date)
+    )
+
+
+# Registered with a practice on date. Unlike
+#   for_patient_on(date).exists_for_patient(), this doesn't sort
+#   registrations to pick one, which isn't needed to check that one exists #
+def is_registered_on(date):
+    return registration_spells(date, date).exists_for_patient()
+
+
+# Alive and registered with a practice on index date #
+def make_registered(index_date):
+    return (
+        (patients.date_of_death.is_after(index_date) | patients.date_of_death.is_null())
+        & is_registered_on(index_date)
+    )
+
+
+# Base population - alive and registered on index date, aged under
+#   110 and with known sex #
+def make_population(index_date):
+    return (
+        (patients.age_on(index_date) < 110)
+        & ((patients.sex == "male") | (patients.sex == "female"))
+        & make_registered(index_date)
+    )
+
+
+# Total denominator - people in the base population aged min_age
+#   or over on index date #
+def make_denominator(index_date, min_age=18):
+    return make_population(index_date) & (patients.age_on(index_date) >= min_age)
@@ -33,50 +33,56 @@ def make_dataset_opioids(index_date, end_date):
             clinical_events.date.is_on_or_between(index_date - years(5), index_date)
         ).exists_for_patient()
 
-    # Function to define no. people with opioid prescription 
-    def has_med_event(codelist):
-        return medications.where(medications.dmd_code.is_in(codelist)
-            ).where(
-                medications.date.is_on_or_between(index_date, end_date)
-            ).exists_for_patient()
+    # Opioid prescriptions from one year before index date to end date -
+    # covers both the interval and the lookback for opioid naive
+    opioid_window = medications.where(
+            medications.dmd_code.is_in(codelists.opioid_codes)
+        ).where(
+            medications.date.is_on_or_between(index_date - years(1), end_date)
+        )
+
+    # Opioid prescriptions in the interval - filtered once, with
+    # each flag below derived from these rows via the route lookup
+    opioid_rx = opioid_window.where(
+            opioid_window.date.is_on_or_after(index_date)
+        )
+
+    route = opioid_rx.dmd_code.to_category(codelists.opioid_route_codes)
+
+    # Function to define no. people with opioid prescription by route
+    def has_route(*routes):
+        return opioid_rx.where(route.is_in(list(routes))).exists_for_patient()
 
     # Overall
-    dataset.opioid_any = has_med_event(codelists.opioid_codes) # Any opioid
+    dataset.opioid_any = opioid_rx.exists_for_patient() # Any opioid
 
     # By admin route
-    dataset.oral_opioid_any = has_med_event(codelists.oral_opioid_codes)  # Oral opioid
-    dataset.buc_opioid_any = has_med_event(codelists.buc_opioid_codes)  # Buccal opioid
-    dataset.inh_opioid_any = has_med_event(codelists.inh_opioid_codes)  # Inhaled opioid
-    dataset.rec_opioid_any = has_med_event(codelists.rec_opioid_codes)  # Rectal opioid
-    dataset.par_opioid_any = has_med_event(codelists.par_opioid_codes)  # Parenteral opioid
-    dataset.trans_opioid_any = has_med_event(codelists.trans_opioid_codes)  # Transdermal opioid
-    dataset.oth_opioid_any = has_med_event(codelists.oth_opioid_codes)  # Other admin route opioid
+    dataset.oral_opioid_any = has_route("oral")  # Oral opioid
+    dataset.buc_opioid_any = has_route("buc")  # Buccal opioid
+    dataset.inh_opioid_any = has_route("inh")  # Inhaled opioid
+    dataset.rec_opioid_any = has_route("rec")  # Rectal opioid
+    dataset.par_opioid_any = has_route("par")  # Parenteral opioid
+    dataset.trans_opioid_any = has_route("trans")  # Transdermal opioid
+    dataset.oth_opioid_any = has_route("buc", "inh", "rec")  # Other admin route opioid
 
     # By strength/type
-    dataset.hi_opioid_any = has_med_event(codelists.hi_opioid_codes)  # High dose / long-acting opioid
+    dataset.hi_opioid_any = opioid_rx.where(
+            opioid_rx.dmd_code.is_in(codelists.hi_opioid_codes)
+        ).exists_for_patient()  # High dose / long-acting opioid
 
     # No. people with a new opioid prescription (1 year lookback) 
     # Note: for any opioids only 
 
-    # Date of last prescription before index date
-    last_rx = medications.where(
-        medications.dmd_code.is_in(codelists.opioid_codes)
-        ).where(
-            medications.date.is_before(index_date)
-        ).sort_by(
-            medications.date
-        ).last_for_patient().date
-
-    # Is opioid naive using one year lookback (for denominator)
-    dataset.opioid_naive = (
-        last_rx.is_before(index_date - years(1)) | last_rx.is_null()
-        )
+    # Is opioid naive using one year lookback (for denominator),
+    # i.e. no prescription in the year before index date. Equivalent to
+    # the last prescription being over a year before index date (or none),
+    # but only looks at one year of history and needs no sort
+    dataset.opioid_naive = ~opioid_window.where(
+            opioid_window.date.is_before(index_date)
+        ).exists_for_patient()
 
     # Number of people with new prescriptions (among naive only)
-    dataset.opioid_new = medications.where(medications.dmd_code.is_in(codelists.opioid_codes)
-            ).where(
-                medications.date.is_on_or_between(index_date, end_date)
-            ).where(dataset.opioid_naive).exists_for_patient()
+    dataset.opioid_new = dataset.opioid_any & dataset.opioid_naive
         
     
     return dataset
@@ -9,9 +9,9 @@
 
 from ehrql import Dataset
 
-from ehrql.tables.tpp import (
-    patients, 
-    practice_registrations)
+from ehrql.tables.tpp import patients
+
+from cohort import make_registered
 
 dataset = Dataset()
 
@@ -20,10 +20,7 @@ dataset.sex = patients.sex
 dataset.age = patients.age_on("2022-04-01")
 
 # Define population #
-dataset.define_population(
-    (patients.date_of_death.is_after("2022-04-01") | patients.date_of_death.is_null())
-    & (practice_registrations.for_patient_on("2022-04-01").exists_for_patient())
-)
+dataset.define_population(make_registered("2022-04-01"))
 
 
 ##############################################
@@ -18,18 +18,15 @@ from ehrql.tables.tpp import (
 
 import codelists
 
+from carehome import make_carehome
+from cohort import make_denominator
 from dataset_definition import make_dataset_opioids
+from measures_definitions import make_age_stand
 
 dataset = make_dataset_opioids(index_date="2022-04-01", end_date="2022-06-30")
 
 # Define population #
-dataset.define_population(
-    (patients.age_on("2022-04-01") >= 18) 
-    & (patients.age_on("2022-04-01") < 110)
-    & ((patients.sex == "male") | (patients.sex == "female"))
-    & (patients.date_of_death.is_after("2022-04-01") | patients.date_of_death.is_null())
-    & (practice_registrations.for_patient_on("2022-04-01").exists_for_patient())
-)
+dataset.define_population(make_denominator("2022-04-01"))
 
 # Demographics #
 
@@ -48,24 +45,7 @@ dataset.age_group = case(
 )
 
 # Age for standardisation
-dataset.age_stand = case(
-        when(age < 25).then("18-24"),
-        when(age < 30).then("25-29"),
-        when(age < 35).then("30-34"),
-        when(age < 40).then("35-39"),
-        when(age < 45).then("40-44"),
-        when(age < 50).then("45-49"),
-        when(age < 55).then("50-54"),
-        when(age < 60).then("55-59"),
-        when(age < 65).then("60-64"),
-        when(age < 70).then("65-69"),
-        when(age < 75).then("70-74"),
-        when(age < 80).then("75-79"),
-        when(age < 85).then("80-84"),
-        when(age < 90).then("85-89"),
-        when(age >= 90).then("90+"),
-        otherwise="missing",
-)
+dataset.age_stand = make_age_stand("2022-04-01")
 
 # Sex
 dataset.sex = patients.sex 
@@ -137,19 +117,7 @@ dataset.ethnicity6 = case(
 dataset.region = practice_registrations.for_patient_on("2022-04-01").practice_nuts1_region_name
 
 # In care home based on primis codes/TPP address match
-carehome_primis = clinical_events.where(
-        clinical_events.snomedct_code.is_in(codelists.carehome_primis_codes)
-    ).where(
-        clinical_events.date.is_on_or_before("2022-04-01")
-    ).exists_for_patient() 
-
-carehome_tpp = addresses.for_patient_on("2022-04-01").care_home_is_potential_match 
-
-dataset.carehome = case(
-    when(carehome_primis).then(True),
-    when(carehome_tpp).then(True),
-    otherwise=False
-)
+dataset.carehome = make_carehome("2022-04-01")
 
 
 ##############################################
@@ -0,0 +1,179 @@
+#################################################################
+# This script applies rounding and redaction to the time series
+# created by build_timeseries.py, creating the
+# output/timeseries/ts_*_rounded.csv files for release:
+# - counts <= 10 are redacted and other counts are rounded
+#   to the nearest 7 (as rounding() in custom_functions.R)
+# - numerators are also redacted where their denominator is
+#   redacted, or where the denominator minus the numerator
+#   (i.e. people not prescribed) is <= 10
+# - rates are recalculated from the rounded counts, or (for rates
+#   that can't be, i.e. standardised rates, which standardise.py
+#   --round-strata calculates from rounded stratum counts) redacted
+#   where their numerator is
+#
+# Author: Andrea Schaffer
+#   Bennett Institute for Applied Data Science
+#   University of Oxford, 2024
+#####################################################################
+
+import os
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import count_rows_in, count_rows_out, stage
+
+
+REDACTION_THRESHOLD = 10
+ROUNDING_BASE = 7
+
+# Time series to round, with the columns kept as they are, the
+#   (numerator, denominator) pairs of counts, any rows to exclude,
+#   rates recalculated from the rounded counts (numerator, denominator,
+#   per), and other columns redacted where a numerator is
+ROUNDED_TIMESERIES = {
+    "ts_overall": {
+        "keep": ["month", "period"],
+        "pairs": [
+            ("opioid_any", "pop_total"),
+            ("hi_opioid_any", "pop_total"),
+            ("opioid_new", "pop_naive"),
+        ],
+    },
+    "ts_overall_nocancer": {
+        "keep": ["month", "period"],
+        "pairs": [
+            ("opioid_any", "pop_total"),
+            ("hi_opioid_any", "pop_total"),
+            ("opioid_new", "pop_naive"),
+        ],
+    },
+    "ts_demo": {
+        "keep": ["month", "period", "var", "cat"],
+        "pairs": [
+            ("opioid_any", "pop_total"),
+            ("opioid_new", "pop_naive"),
+        ],
+    },
+    "ts_type": {
+        "keep": ["measure", "month", "period"],
+        "pairs": [
+            ("opioid_any", "pop_total"),
+        ],
+        # Too few people prescribed by these routes to report separately
+        "exclude": {"measure": ["Buccal", "Inhaled", "Rectal"]},
+    },
+    "ts_carehome": {
+        "keep": ["month", "period"],
+        "pairs": [
+            ("opioid_any", "pop_total"),
+            ("hi_opioid_any", "pop_total"),
+            ("opioid_new", "pop_naive"),
+            ("trans_opioid_any", "pop_total"),
+            ("par_opioid_any", "pop_total"),
+            ("oral_opioid_any", "pop_total"),
+        ],
+    },
+    "ts_carehome_sens": {
+        "keep": ["month", "period", "age_group", "carehome"],
+        "pairs": [
+            ("opioid_any", "pop_total"),
+        ],
+    },
+    # Standardised rates (standardise.py --round-strata), per 1,000
+    "ts_stand": {
+        "keep": ["measure", "interval_start"],
+        "pairs": [
+            ("numerator", "denominator"),
+        ],
+        "rates": {"crude_rate": ("numerator", "denominator", 1000)},
+        "redact_with": {"numerator": ["std_rate", "std_lci", "std_uci"]},
+    },
+}
+
+
+# Redact counts <= threshold and round other counts to the nearest
+#   base (half to even, as R's round()). Redacted counts are NaN #
+def round_counts(counts, threshold=REDACTION_THRESHOLD, base=ROUNDING_BASE):
+    counts = np.asarray(counts, dtype="float64")
+    return np.where(counts > threshold, np.round(counts / base) * base, np.nan)
+
+
+# Redact rounded numerators where the rounded denominator is redacted,
+#   or where the count of people not in the numerator is <= threshold #
+def suppress_numerator(numerator, denominator, rounded_numerator, rounded_denominator,
+                       threshold=REDACTION_THRESHOLD):
+    numerator = np.asarray(numerator, dtype="float64")
+    denominator = np.asarray(denominator, dtype="float64")
+    suppress = np.isnan(rounded_denominator) | (denominator - numerator <= threshold)
+    return np.where(suppress, np.nan, rounded_numerator)
+
+
+# Rounded and redacted counts ({column: array}), numerators then
+#   denominators, for (numerator, denominator) pairs of columns #
+def disclosure_control(data, pairs, threshold=REDACTION_THRESHOLD, base=ROUNDING_BASE):
+    counts = {
+        column: data[column].to_numpy(dtype="float64", na_value=np.nan)
+        for pair in pairs
+        for column in pair
+    }
+
+    rounded_denominators = {
+        denominator: round_counts(counts[denominator], threshold, base)
+        for _, denominator in pairs
+    }
+    rounded_numerators = {
+        numerator: suppress_numerator(
+            counts[numerator],
+            counts[denominator],
+            round_counts(counts[numerator], threshold, base),
+            rounded_denominators[denominator],
+            threshold,
+        )
+        for numerator, denominator in pairs
+    }
+    return {**rounded_numerators, **rounded_denominators}
+
+
+def round_timeseries(timeseries_dir, name):
+    spec = ROUNDED_TIMESERIES[name]
+    data = pd.read_csv(
+        os.path.join(timeseries_dir, f"{name}.csv"),
+        dtype={column: str for column in spec["keep"]},
+    )
+    count_rows_in(len(data))
+    for column, values in spec.get("exclude", {}).items():
+        data = data[~data[column].isin(values)]
+
+    rounded = disclosure_control(data, spec["pairs"])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rates = {
+            rate: rounded[numerator] / rounded[denominator] * per
+            for rate, (numerator, denominator, per) in spec.get("rates", {}).items()
+        }
+    redacted = {
+        column: np.where(np.isnan(rounded[numerator]), np.nan, data[column].to_numpy(dtype="float64"))
+        for numerator, columns in spec.get("redact_with", {}).items()
+        for column in columns
+    }
+    data = data[spec["keep"]].assign(**{
+        f"{column}_round": pd.array(values, dtype="Int64")
+        for column, values in rounded.items()
+    }, **rates, **redacted)
+    data.to_csv(os.path.join(timeseries_dir, f"{name}_rounded.csv"), index=False, na_rep="NA")
+    count_rows_out(len(data))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--timeseries-dir", type=str, default="output/timeseries")
+    parser.add_argument("--timeseries", nargs="+", choices=list(ROUNDED_TIMESERIES),
+        default=list(ROUNDED_TIMESERIES))
+
+    args = parser.parse_args()
+
+    for name in args.timeseries:
+        with stage(f"disclosure_control/{name}"):
+            round_timeseries(args.timeseries_dir, name)
@@ -0,0 +1,175 @@
+####################################################################
+# This script defines functions for running ehrQL definitions
+#   locally (outside of the OpenSAFELY job runner), e.g. for
+#   benchmarking, against dummy tables
+#
+# ehrQL is run with "opensafely exec ehrql:v1" by default; pass
+#   e.g. --ehrql ehrql to use a locally installed ehrQL instead.
+#   CPU time and peak memory are those of the ehrQL process, so are
+#   only measured for a locally installed ehrQL. With docker (e.g.
+#   opensafely exec), they would be those of the docker client rather
+#   than the container that runs ehrQL, so they aren't reported
+#   (they're None). Likewise, a memory limit can only be set for a
+#   locally installed ehrQL. It limits address space (RLIMIT_AS),
+#   not resident memory, so it should allow some headroom
+#
+# Author: Andrea Schaffer
+#   Bennett Institute for Applied Data Science
+#   University of Oxford, 2024
+#####################################################################
+
+
+import hashlib
+import os
+import re
+import shlex
+import subprocess
+import time
+from dataclasses import dataclass
+
+
+DEFAULT_EHRQL = "opensafely exec ehrql:v1"
+
+ANALYSIS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+# ehrQL command to generate a dataset or measures #
+def ehrql_command(ehrql, definition, output, dummy_tables=None, user_args=()):
+    if os.path.basename(definition).startswith("measures_"):
+        subcommand = "generate-measures"
+    else:
+        subcommand = "generate-dataset"
+
+    command = shlex.split(ehrql) + [subcommand, definition, "--output", output]
+    if dummy_tables is not None:
+        command += ["--dummy-tables", dummy_tables]
+    if user_args:
+        command += ["--", *user_args]
+    return command
+
+
+# Whether a command runs in docker (directly or with opensafely exec) #
+def uses_docker(command):
+    return os.path.basename(command[0]) in {"docker", "opensafely"}
+
+
+@dataclass
+class RunResult:
+    returncode: int
+    wall_seconds: float
+    # None for commands run in docker
+    cpu_seconds: float = None
+    peak_rss_mb: float = None
+
+
+# Wall time, and peak memory where measured, for progress messages #
+def format_usage(result):
+    usage = f"{result.wall_seconds:.1f}s"
+    if result.peak_rss_mb is not None:
+        usage += f", {result.peak_rss_mb:.0f}MB"
+    return usage
+
+
+# Limit the address space (virtual memory, not RSS) of the current
+#   process (used in a child process before starting ehrQL) #
+def _limit_memory(max_memory_mb):
+    def limit():
+        import resource
+
+        limit_bytes = max_memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit_bytes, limit_bytes))
+    return limit
+
+
+# Run a command, recording wall time, CPU time and peak memory,
+#   optionally limiting its address space to max_memory_mb. The limit
+#   is set in the child with preexec_fn, which isn't safe if other
+#   threads are running, so call this from one thread only (e.g. one
+#   per process in a process pool) #
+def run_command(command, log_path=None, max_memory_mb=None):
+    if max_memory_mb and uses_docker(command):
+        raise ValueError(
+            "A memory limit can't be set for ehrQL run in docker; "
+            "use a locally installed ehrQL (e.g. --ehrql ehrql)"
+        )
+    log = open(log_path, "w") if log_path else subprocess.DEVNULL
+    preexec_fn = _limit_memory(max_memory_mb) if max_memory_mb else None
+    try:
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            command, stdout=log, stderr=subprocess.STDOUT, preexec_fn=preexec_fn
+        )
+        _, status, rusage = os.wait4(process.pid, 0)
+        wall_seconds = time.perf_counter() - start
+    finally:
+        if log_path:
+            log.close()
+
+    # Let Popen know the process has been reaped
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    if uses_docker(command):
+        return RunResult(returncode=process.returncode, wall_seconds=wall_seconds)
+    return RunResult(
+        returncode=process.returncode,
+        wall_seconds=wall_seconds,
+        cpu_seconds=rusage.ru_utime + rusage.ru_stime,
+        # ru_maxrss is in kilobytes on Linux
+        peak_rss_mb=rusage.ru_maxrss / 1024,
+    )
+
+
+# A definition and the local modules it imports (recursively) #
+def local_modules(definition, _seen=None):
+    seen = {} if _seen is None else _seen
+    path = os.path.abspath(definition)
+    if path in seen:
+        return seen
+
+    with open(path) as f:
+        seen[path] = f.read()
+
+    for module in re.findall(r"^(?:from|import) (\w+)", seen[path], flags=re.MULTILINE):
+        module_path = os.path.join(ANALYSIS_DIR, f"{module}.py")
+        if os.path.exists(module_path):
+            local_modules(module_path, seen)
+
+    return seen
+
+
+# Tables from ehrql.tables.tpp used by a definition, including
+#   those used by the local modules it imports #
+def tables_used(definition):
+    tables = set()
+    for source in local_modules(definition).values():
+        for match in re.finditer(r"from ehrql\.tables\.tpp import \(?([\w\s,]+)\)?", source):
+            tables.update(name.strip() for name in match.group(1).split(",") if name.strip())
+    return tables
+
+
+# Hash of a definition, the local modules it imports and the codelists,
+#   which changes whenever the definition's results might #
+def definition_hash(definition, codelists_path="codelists/codelists.json"):
+    digest = hashlib.sha256()
+    for path, source in sorted(local_modules(definition).items()):
+        digest.update(os.path.basename(path).encode("utf8"))
+        digest.update(source.encode("utf8"))
+    with open(codelists_path, "rb") as f:
+        digest.update(f.read())
+    return digest.hexdigest()
+
+
+# First day of the month n months after a YYYY-MM-DD date #
+def add_months(date, n):
+    year, month, day = (int(part) for part in date.split("-"))
+    if day != 1:
+        raise ValueError(f"Measures intervals must start on the first of the month, not {date}")
+    month_index = year * 12 + month - 1 + n
+    return f"{month_index // 12:04d}-{month_index % 12 + 1:02d}-01"
+
+
+# No. months from one YYYY-MM-DD date to another #
+def months_between(start, end):
+    start_year, start_month, _ = (int(part) for part in start.split("-"))
+    end_year, end_month, _ = (int(part) for part in end.split("-"))
+    return (end_year - start_year) * 12 + end_month - start_month
@@ -0,0 +1,334 @@
+####################################################################
+# This script generates synthetic TPP-like data (patients,
+#   practice_registrations, addresses, clinical_events and
+#   medications) as ehrQL dummy tables, for performance testing
+#   the ehrQL definitions locally at realistic scale
+#
+# Unlike ehrQL's own dummy data, opioid prescribing is heavily
+#   skewed: most patients have no opioids, and a minority of
+#   long-term users (e.g. transdermal fentanyl, repeat codeine)
+#   have hundreds of issues. Codes are taken from the codelists
+#   used in the study. Generation is seeded and vectorised.
+#
+# Usage (from the project root):
+#   python analysis/generate_synthetic_data.py --population-size 100000
+#
+# Author: Andrea Schaffer
+#   Bennett Institute for Applied Data Science
+#   University of Oxford, 2024
+#####################################################################
+
+
+import os
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas as pd
+
+from codelist_bundle import read_source
+
+
+START_DATE = np.datetime64("2016-01-01")
+END_DATE = np.datetime64("2024-12-31")
+
+REGIONS = np.array([
+    "North East", "North West", "Yorkshire and The Humber", "East Midlands",
+    "West Midlands", "East", "London", "South East", "South West",
+])
+
+# Route of opioid prescriptions for short-term and long-term users
+ROUTE_CODELISTS = [
+    "oral_opioid_codes", "trans_opioid_codes", "par_opioid_codes",
+    "buc_opioid_codes", "rec_opioid_codes", "inh_opioid_codes",
+]
+SHORT_TERM_ROUTE_WEIGHTS = [0.90, 0.01, 0.05, 0.02, 0.01, 0.01]
+LONG_TERM_ROUTE_WEIGHTS = [0.70, 0.25, 0.02, 0.02, 0.005, 0.005]
+
+
+def _codes(name):
+    return np.array([str(code) for code in read_source(name)])
+
+
+def _dates(days):
+    return np.datetime_as_string(START_DATE + days.astype("timedelta64[D]"), unit="D")
+
+
+def _random_days(rng, size):
+    return rng.integers(0, (END_DATE - START_DATE).astype(int) + 1, size=size)
+
+
+def _first_of_month(dates):
+    return dates.astype("datetime64[M]").astype("datetime64[D]")
+
+
+def generate_patients(rng, n):
+    patient_id = np.arange(1, n + 1)
+
+    # Age on START_DATE, roughly following the adult-heavy age
+    #   distribution of the registered population
+    age = np.clip(rng.normal(42, 23, size=n), 0, 105).astype(int)
+    date_of_birth = _first_of_month(
+        START_DATE - (age * 365.25 + rng.integers(0, 365, size=n)).astype("timedelta64[D]")
+    )
+
+    sex = rng.choice(
+        np.array(["male", "female", "intersex", "unknown"]),
+        size=n,
+        p=[0.49, 0.49, 0.01, 0.01],
+    )
+
+    # Probability of dying in the study period increases with age
+    p_death = np.clip(0.002 * np.exp(age / 15), 0, 0.9)
+    dies = rng.random(n) < p_death
+    date_of_death = np.where(
+        dies, _dates(_random_days(rng, n)), ""
+    )
+
+    return pd.DataFrame({
+        "patient_id": patient_id,
+        "date_of_birth": np.datetime_as_string(date_of_birth, unit="D"),
+        "sex": sex,
+        "date_of_death": date_of_death,
+    }), age
+
+
+def generate_registrations(rng, n, n_practices):
+    patient_id = np.arange(1, n + 1)
+
+    # Registered before or during the study period; most are still registered
+    start = START_DATE - rng.integers(-3 * 365, 30 * 365, size=n).astype("timedelta64[D]")
+    deregistered = rng.random(n) < 0.15
+    end = start + rng.integers(30, 20 * 365, size=n).astype("timedelta64[D]")
+
+    practice = rng.integers(1, n_practices + 1, size=n)
+    practice_region = rng.choice(REGIONS, size=n_practices + 1)
+
+    return pd.DataFrame({
+        "patient_id": patient_id,
+        "start_date": np.datetime_as_string(start, unit="D"),
+        "end_date": np.where(deregistered, np.datetime_as_string(end, unit="D"), ""),
+        "practice_pseudo_id": practice,
+        "practice_stp": np.char.add("E540000", (practice % 42).astype(str)),
+        "practice_nuts1_region_name": practice_region[practice],
+        "practice_systmone_go_live_date": "2000-01-01",
+    })
+
+
+def generate_addresses(rng, n, carehome):
+    patient_id = np.arange(1, n + 1)
+    start = START_DATE - rng.integers(0, 20 * 365, size=n).astype("timedelta64[D]")
+
+    # Care home residents move into a care home part way through the
+    #   study period, so have a second address from that date
+    carehome_start = START_DATE + _random_days(rng, n).astype("timedelta64[D]")
+    carehome_id = np.flatnonzero(carehome) + 1
+    nursing = rng.random(len(carehome_id)) < 0.5
+
+    patient_id = np.concatenate([patient_id, carehome_id])
+    n_addresses = len(patient_id)
+    start = np.concatenate([start, carehome_start[carehome]])
+    end = np.concatenate([
+        np.where(carehome, np.datetime_as_string(carehome_start, unit="D"), ""),
+        np.full(len(carehome_id), ""),
+    ])
+    is_carehome = np.arange(n_addresses) >= n
+    requires_nursing = np.concatenate([np.zeros(n, dtype=bool), nursing])
+
+    return pd.DataFrame({
+        "patient_id": patient_id,
+        "address_id": np.arange(1, n_addresses + 1),
+        "start_date": np.datetime_as_string(start, unit="D"),
+        "end_date": end,
+        "address_type": 1,
+        "rural_urban_classification": rng.integers(1, 9, size=n_addresses),
+        "imd_rounded": (rng.integers(0, 32845, size=n_addresses) // 100) * 100,
+        "msoa_code": np.char.add("E0200", (rng.integers(0, 7000, size=n_addresses)).astype(str)),
+        "has_postcode": "T",
+        "care_home_is_potential_match": np.where(is_carehome, "T", "F"),
+        "care_home_requires_nursing": np.where(is_carehome & requires_nursing, "T", "F"),
+        "care_home_does_not_require_nursing": np.where(is_carehome & ~requires_nursing, "T", "F"),
+    }).sort_values(["patient_id", "start_date"], kind="stable"), carehome_start
+
+
+def generate_clinical_events(rng, n, carehome, carehome_start, cancer_prevalence):
+    ethnicity_codes = _codes("ethnicity_codes_6")
+    cancer_codes = np.concatenate([
+        _codes("oth_ca_codes"), _codes("lung_ca_codes"), _codes("haem_ca_codes"),
+    ])
+    primis_codes = _codes("carehome_primis_codes")
+
+    # Ethnicity recorded for most patients, cancer for some, and a
+    #   PRIMIS long-term residential care code for half of care home residents
+    has_ethnicity = rng.random(n) < 0.85
+    has_cancer = rng.random(n) < cancer_prevalence
+    has_primis = carehome & (rng.random(n) < 0.5)
+
+    parts = []
+    for mask, codes, days in [
+        (has_ethnicity, ethnicity_codes, _random_days(rng, n) - 20 * 365),
+        (has_cancer, cancer_codes, _random_days(rng, n)),
+        (has_primis, primis_codes, (carehome_start - START_DATE).astype(int)),
+    ]:
+        patient_id = np.flatnonzero(mask) + 1
+        parts.append(pd.DataFrame({
+            "patient_id": patient_id,
+            "date": _dates(days[mask]),
+            "snomedct_code": rng.choice(codes, size=len(patient_id)),
+        }))
+
+    events = pd.concat(parts, ignore_index=True)
+    events["ctv3_code"] = ""
+    events["numeric_value"] = ""
+    events["consultation_id"] = np.arange(1, len(events) + 1)
+    return events
+
+
+def generate_medications(rng, n, age, carehome, prescribed_fraction, long_term_fraction,
+                         tail_index, max_issues, other_medications):
+    route_codes = [_codes(name) for name in ROUTE_CODELISTS]
+    hi_codes = _codes("hi_opioid_codes")
+
+    # No. opioid issues per patient: none for most; a few for short-term
+    #   users; a heavy (Pareto) tail of hundreds for long-term users,
+    #   who are more likely to be older or in a care home
+    p_prescribed = np.clip(prescribed_fraction * (0.5 + age / 50) * np.where(carehome, 2, 1), 0, 1)
+    prescribed = rng.random(n) < p_prescribed
+    long_term = prescribed & (rng.random(n) < long_term_fraction * (1 + carehome))
+
+    # Long-term issues are capped at as many four-weekly issues as fit in
+    #   the period
+    n_days = (END_DATE - START_DATE).astype(int) + 1
+    issues = np.where(prescribed, rng.poisson(2, size=n) + 1, 0)
+    long_term_issues = np.minimum((rng.pareto(tail_index, size=n) + 1) * 24, max_issues)
+    long_term_issues = np.minimum(long_term_issues, n_days // 28).astype(int)
+    issues = np.where(long_term, long_term_issues, issues)
+
+    patient_id = np.repeat(np.arange(1, n + 1), issues)
+    is_long_term = np.repeat(long_term, issues)
+    total = len(patient_id)
+
+    # Long-term users have (roughly) four-weekly repeat issues from a start
+    #   date chosen so that they all fit in the period, allowing for up to
+    #   three days either side; short-term users have issues at random dates
+    first_issue = rng.integers(3, n_days - 3 - np.maximum(issues - 1, 0) * 28)
+    first_issue = np.repeat(first_issue, issues)
+    issue_number = np.arange(total) - np.repeat(np.cumsum(issues) - issues, issues)
+    days = np.where(
+        is_long_term,
+        first_issue + issue_number * 28 + rng.integers(-3, 4, size=total),
+        _random_days(rng, total),
+    )
+
+    # Route (and code within route); long-term users mostly on the same code
+    route = np.where(
+        is_long_term,
+        rng.choice(len(ROUTE_CODELISTS), size=total, p=LONG_TERM_ROUTE_WEIGHTS),
+        rng.choice(len(ROUTE_CODELISTS), size=total, p=SHORT_TERM_ROUTE_WEIGHTS),
+    )
+    dmd_code = np.empty(total, dtype=object)
+    for i, codes in enumerate(route_codes):
+        mask = route == i
+        dmd_code[mask] = rng.choice(codes, size=mask.sum())
+    high_dose = is_long_term & (rng.random(total) < 0.2)
+    dmd_code[high_dose] = rng.choice(hi_codes, size=high_dose.sum())
+
+    opioids = pd.DataFrame({
+        "patient_id": patient_id,
+        "date": _dates(days),
+        "dmd_code": dmd_code,
+    })
+
+    # Non-opioid prescribing, which the opioid filters have to scan past
+    other_issues = rng.poisson(other_medications, size=n)
+    other = pd.DataFrame({
+        "patient_id": np.repeat(np.arange(1, n + 1), other_issues),
+        "date": _dates(_random_days(rng, other_issues.sum())),
+        "dmd_code": np.char.add("3", rng.integers(10**14, 10**15, size=other_issues.sum()).astype(str)),
+    })
+
+    medications = pd.concat([opioids, other], ignore_index=True)
+    medications["multilex_code"] = ""
+    medications["consultation_id"] = np.arange(1, len(medications) + 1)
+    return medications
+
+
+def generate(output_dir, population_size, seed=1, n_practices=None, carehome_prevalence=0.01,
+             cancer_prevalence=0.05, prescribed_fraction=0.15, long_term_fraction=0.1,
+             tail_index=1.5, max_issues=500, other_medications=10):
+    rng = np.random.default_rng(seed)
+    n = population_size
+    n_practices = n_practices or max(1, n // 8000)
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    def write(table, name):
+        table.to_csv(os.path.join(output_dir, f"{name}.csv"), index=False)
+        return len(table)
+
+    rows = {}
+
+    patients, age = generate_patients(rng, n)
+    rows["patients"] = write(patients, "patients")
+
+    rows["practice_registrations"] = write(generate_registrations(rng, n, n_practices), "practice_registrations")
+
+    # Care home residence is concentrated in the oldest patients
+    p_carehome = np.clip(carehome_prevalence * np.exp((age - 80) / 8), 0, 0.5)
+    carehome = rng.random(n) < p_carehome
+    addresses, carehome_start = generate_addresses(rng, n, carehome)
+    rows["addresses"] = write(addresses, "addresses")
+
+    rows["clinical_events"] = write(
+        generate_clinical_events(rng, n, carehome, carehome_start, cancer_prevalence),
+        "clinical_events",
+    )
+
+    rows["medications"] = write(
+        generate_medications(
+            rng, n, age, carehome, prescribed_fraction, long_term_fraction,
+            tail_index, max_issues, other_medications,
+        ),
+        "medications",
+    )
+
+    return rows
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--population-size", type=int, default=10000)
+    parser.add_argument("--output", type=str,
+        help="Directory for the tables (default output/dummy_tables/<population size>)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--carehome-prevalence", type=float, default=0.01,
+        help="Approximate care home prevalence at age 80")
+    parser.add_argument("--cancer-prevalence", type=float, default=0.05)
+    parser.add_argument("--prescribed-fraction", type=float, default=0.15,
+        help="Approximate fraction of patients with any opioid prescription")
+    parser.add_argument("--long-term-fraction", type=float, default=0.1,
+        help="Fraction of patients with opioids who are long-term users")
+    parser.add_argument("--tail-index", type=float, default=1.5,
+        help="Pareto tail index of the no. issues for long-term users (smaller = heavier tail)")
+    parser.add_argument("--max-issues", type=int, default=500)
+    parser.add_argument("--other-medications", type=float, default=10,
+        help="Mean no. non-opioid prescriptions per patient")
+
+    args = parser.parse_args()
+
+    output_dir = args.output or os.path.join("output", "dummy_tables", str(args.population_size))
+
+    rows = generate(
+        output_dir,
+        args.population_size,
+        seed=args.seed,
+        carehome_prevalence=args.carehome_prevalence,
+        cancer_prevalence=args.cancer_prevalence,
+        prescribed_fraction=args.prescribed_fraction,
+        long_term_fraction=args.long_term_fraction,
+        tail_index=args.tail_index,
+        max_issues=args.max_issues,
+        other_medications=args.other_medications,
+    )
+
+    for table, n_rows in rows.items():
+        print(f"{table}: {n_rows} rows")
@@ -0,0 +1,381 @@
+####################################################################
+# This script defines profiling hooks for the pipeline actions,
+#   recording the wall time, CPU time (including child processes,
+#   e.g. ehrQL jobs), peak memory and rows in and out of each stage
+#   as JSON lines in a trace file, and summarises and compares traces
+#
+# Tracing is off unless the OPIOIDS_TRACE environment variable is set
+#   to the trace file, so the actions run as before in the job runner.
+#   Each stage appends one line when it finishes; use a new trace
+#   file for each run to be compared. Peak memory is the high-water
+#   mark of the process (or its largest child process) at the end of
+#   the stage, so it includes earlier stages in the same action. On
+#   Windows (which has no resource module), only wall time is recorded
+#
+# ehrQL evaluates all the measures in a definition together, so the
+#   time taken to evaluate each measure is recorded by running them
+#   one at a time (the measures subcommand)
+#
+# Usage (from the project root):
+#   OPIOIDS_TRACE=output/trace/run.jsonl python analysis/build_timeseries.py
+#   python analysis/instrumentation.py summary output/trace/run.jsonl \
+#     --output output/trace/run.csv
+#   python analysis/instrumentation.py diff output/trace/baseline.csv output/trace/run.csv
+#   python analysis/instrumentation.py measures analysis/measures_overall.py \
+#     --intervals 3 --ehrql ehrql --dummy-tables output/dummy_tables/10000
+#
+# Author: Andrea Schaffer
+#   Bennett Institute for Applied Data Science
+#   University of Oxford, 2024
+#####################################################################
+
+
+import csv
+import json
+import os
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+
+TRACE_ENV = "OPIOIDS_TRACE"
+
+METRICS = ["wall_seconds", "cpu_seconds", "peak_rss_mb", "rows_in", "rows_out"]
+
+SUMMARY_COLUMNS = ["stage", "count", "errors"] + METRICS
+
+_local = threading.local()
+_write_lock = threading.Lock()
+
+
+def trace_path():
+    return os.environ.get(TRACE_ENV) or None
+
+
+class Stage:
+    """Rows in and out of a stage, and any other attributes recorded in
+    its trace event, set by the code in the stage (directly, or with
+    count_rows_in() and count_rows_out()).
+    """
+
+    def __init__(self, name, rows_in=None, rows_out=None, **attributes):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = rows_out
+        self.attributes = attributes
+
+    def add_rows_in(self, n):
+        self.rows_in = (self.rows_in or 0) + int(n)
+
+    def add_rows_out(self, n):
+        self.rows_out = (self.rows_out or 0) + int(n)
+
+
+# Wall time, CPU time of the process and its (finished) children, and
+#   their peak memory (None without the resource module) #
+def _snapshot():
+    snapshot = {"wall": time.perf_counter(), "cpu": None, "peak_rss_mb": None}
+    try:
+        import resource
+    except ImportError:
+        return snapshot
+
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    snapshot["cpu"] = own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+    # ru_maxrss is in kilobytes on Linux
+    snapshot["peak_rss_mb"] = max(own.ru_maxrss, children.ru_maxrss) / 1024
+    return snapshot
+
+
+def _active_stages():
+    if not hasattr(_local, "stages"):
+        _local.stages = []
+    return _local.stages
+
+
+# Append an event to the trace file #
+def write_event(name, path=None, **fields):
+    path = path or trace_path()
+    if path is None:
+        return
+    event = {
+        "stage": name,
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+        "pid": os.getpid(),
+        **fields,
+    }
+    line = json.dumps(event, default=str) + "\n"
+    with _write_lock:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "a") as f:
+            f.write(line)
+
+
+# Trace a stage of an action, e.g.
+#     with stage("split_measures") as s:
+#         ...
+#         s.rows_out = n
+#   which records nothing unless tracing is on #
+@contextmanager
+def stage(name, rows_in=None, rows_out=None, **attributes):
+    record = Stage(name, rows_in, rows_out, **attributes)
+    path = trace_path()
+    if path is None:
+        yield record
+        return
+
+    stages = _active_stages()
+    stages.append(record)
+    start = _snapshot()
+    status = "error"
+    try:
+        yield record
+        status = "ok"
+    finally:
+        stages.pop()
+        end = _snapshot()
+        write_event(
+            record.name,
+            path,
+            status=status,
+            wall_seconds=round(end["wall"] - start["wall"], 6),
+            cpu_seconds=None if end["cpu"] is None else round(end["cpu"] - start["cpu"], 6),
+            peak_rss_mb=None if end["peak_rss_mb"] is None else round(end["peak_rss_mb"], 1),
+            rows_in=record.rows_in,
+            rows_out=record.rows_out,
+            **record.attributes,
+        )
+
+
+# Add rows to the innermost active stage (in this thread), if any #
+def count_rows_in(n):
+    stages = _active_stages()
+    if stages:
+        stages[-1].add_rows_in(n)
+
+
+def count_rows_out(n):
+    stages = _active_stages()
+    if stages:
+        stages[-1].add_rows_out(n)
+
+
+# Trace a command already run with ehrql_local.run_command(), using
+#   the child process's own time and memory (not measured in docker) #
+def record_run(name, result, rows_in=None, rows_out=None, **attributes):
+    write_event(
+        name,
+        status="ok" if result.returncode == 0 else "error",
+        wall_seconds=round(result.wall_seconds, 6),
+        cpu_seconds=None if result.cpu_seconds is None else round(result.cpu_seconds, 6),
+        peak_rss_mb=None if result.peak_rss_mb is None else round(result.peak_rss_mb, 1),
+        rows_in=rows_in,
+        rows_out=rows_out,
+        **attributes,
+    )
+
+
+def read_trace(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+# Totals of each stage in a trace: times and rows are summed over the
+#   stage's events, peak memory is the largest. Stages are in the order
+#   they first finished #
+def summarise(events):
+    summary = {}
+    for event in events:
+        row = summary.setdefault(event["stage"], {
+            "stage": event["stage"],
+            "count": 0,
+            "errors": 0,
+            **{metric: None for metric in METRICS},
+        })
+        row["count"] += 1
+        row["errors"] += event.get("status") == "error"
+        for metric in METRICS:
+            value = event.get(metric)
+            if value is None:
+                continue
+            if row[metric] is None:
+                row[metric] = value
+            elif metric == "peak_rss_mb":
+                row[metric] = max(row[metric], value)
+            else:
+                row[metric] += value
+
+    for row in summary.values():
+        for metric in ["wall_seconds", "cpu_seconds"]:
+            if row[metric] is not None:
+                row[metric] = round(row[metric], 3)
+    return list(summary.values())
+
+
+def write_summary(summary, path):
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=SUMMARY_COLUMNS)
+        writer.writeheader()
+        writer.writerows(summary)
+
+
+def read_summary(path):
+    with open(path, newline="") as f:
+        rows = list(csv.DictReader(f))
+    for row in rows:
+        for column in SUMMARY_COLUMNS[1:]:
+            row[column] = float(row[column]) if row[column] != "" else None
+    return rows
+
+
+# Compare two summaries, returning the changes in each stage's metrics,
+#   flagging increases in time or memory by more than the tolerance
+#   and any change in the rows in or out #
+def diff_summaries(baseline, summary, tolerance):
+    from benchmark import MIN_INCREASE as BENCHMARK_MIN_INCREASE
+
+    # Smallest increases flagged as regressions, so that noise in very
+    #   short stages isn't reported: those of benchmark.py, with CPU time
+    #   as wall time
+    min_increase = {
+        **BENCHMARK_MIN_INCREASE,
+        "cpu_seconds": BENCHMARK_MIN_INCREASE["wall_seconds"],
+    }
+
+    baseline = {row["stage"]: row for row in baseline}
+    current = {row["stage"]: row for row in summary}
+
+    changes = []
+    for stage_name in list(baseline) + [name for name in current if name not in baseline]:
+        before = baseline.get(stage_name, {})
+        after = current.get(stage_name, {})
+        for metric in METRICS:
+            old, new = before.get(metric), after.get(metric)
+            if old is None and new is None:
+                continue
+            if old is None or new is None:
+                flagged = True
+            elif metric in min_increase:
+                flagged = new - old > max(old * tolerance, min_increase[metric])
+            else:
+                flagged = new != old
+            changes.append({
+                "stage": stage_name,
+                "metric": metric,
+                "baseline": old,
+                "result": new,
+                "change": None if old is None or new is None else round(new - old, 3),
+                "flagged": flagged,
+            })
+    return changes
+
+
+## Evaluation time of each measure
+
+# Run each measure in a measures definition on its own, tracing the
+#   ehrQL job that evaluates it #
+def profile_measures(definition, start_date, intervals, ehrql, dummy_tables=None,
+                     output_dir="output/trace/measures"):
+    from cached_measures import load_measures
+    from ehrql_local import ehrql_command, run_command
+
+    name = os.path.basename(definition)[:-3]
+    os.makedirs(output_dir, exist_ok=True)
+
+    results = []
+    for measure in load_measures(definition, start_date, intervals):
+        output = os.path.join(output_dir, f"{name}__{measure.name}.csv")
+        command = ehrql_command(
+            ehrql,
+            definition,
+            output=output,
+            dummy_tables=dummy_tables,
+            user_args=[
+                "--start-date", start_date,
+                "--intervals", str(intervals),
+                "--measures", measure.name,
+            ],
+        )
+        result = run_command(command, log_path=output[:-4] + ".log")
+
+        rows_out = None
+        if result.returncode == 0:
+            with open(output, newline="") as f:
+                rows_out = sum(1 for _ in f) - 1
+        record_run(
+            f"evaluate_measure/{name}/{measure.name}", result,
+            rows_out=rows_out, definition=definition, intervals=intervals,
+        )
+        results.append((measure.name, result, rows_out))
+    return results
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    summary_parser = subparsers.add_parser("summary", help="Summarise a trace by stage")
+    summary_parser.add_argument("trace", type=str)
+    summary_parser.add_argument("--output", type=str,
+        help="CSV to write the summary to; by default, the trace with a .csv extension")
+
+    diff_parser = subparsers.add_parser("diff", help="Compare two trace summaries")
+    diff_parser.add_argument("baseline", type=str)
+    diff_parser.add_argument("summary", type=str)
+    diff_parser.add_argument("--tolerance", type=float, default=0.2,
+        help="Proportional increase over the baseline flagged as a regression")
+    diff_parser.add_argument("--output", type=str, help="CSV to write all changes to")
+
+    measures_parser = subparsers.add_parser("measures",
+        help="Trace the evaluation of each measure in a definition, one at a time")
+    measures_parser.add_argument("definition", type=str)
+    measures_parser.add_argument("--start-date", type=str, default="2018-01-01")
+    measures_parser.add_argument("--intervals", type=int, default=54)
+    measures_parser.add_argument("--ehrql", type=str,
+        help="ehrQL command; by default, that of ehrql_local.py (opensafely exec)")
+    measures_parser.add_argument("--dummy-tables", type=str)
+    measures_parser.add_argument("--output-dir", type=str, default="output/trace/measures")
+    measures_parser.add_argument("--trace", type=str,
+        help=f"Trace file; by default, ${TRACE_ENV} or output/trace/measures.jsonl")
+
+    args = parser.parse_args()
+
+    if args.command == "summary":
+        summary = summarise(read_trace(args.trace))
+        output = args.output or os.path.splitext(args.trace)[0] + ".csv"
+        write_summary(summary, output)
+        for row in summary:
+            memory = "" if row["peak_rss_mb"] is None else f"{row['peak_rss_mb']}MB, "
+            print(
+                f"{row['stage']}: {row['count']} run(s), {row['wall_seconds']}s, "
+                f"{memory}rows {row['rows_in']} -> {row['rows_out']}"
+            )
+
+    elif args.command == "diff":
+        changes = diff_summaries(read_summary(args.baseline), read_summary(args.summary),
+                                 args.tolerance)
+        if args.output:
+            with open(args.output, "w", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=list(changes[0]) if changes else ["stage"])
+                writer.writeheader()
+                writer.writerows(changes)
+        flagged = [change for change in changes if change["flagged"]]
+        for change in flagged:
+            print("CHANGED: {stage} {metric} {baseline} -> {result}".format(**change))
+        if flagged:
+            sys.exit(1)
+
+    elif args.command == "measures":
+        from ehrql_local import DEFAULT_EHRQL, format_usage
+
+        os.environ[TRACE_ENV] = args.trace or trace_path() or "output/trace/measures.jsonl"
+        for name, result, rows_out in profile_measures(
+            args.definition, args.start_date, args.intervals, args.ehrql or DEFAULT_EHRQL,
+            args.dummy_tables, args.output_dir,
+        ):
+            status = "done" if result.returncode == 0 else "FAILED"
+            print(f"{name}: {status} in {format_usage(result)}, {rows_out} rows")
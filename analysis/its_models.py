@@ -0,0 +1,984 @@
+#################################################################
+# This script fits the negative binomial interrupted time series
+# models of opioid prescribing (as in 4a/4b/4c/5_*.R), from the
+# rounded time series (output/released_outputs/final/ts_*_rounded.csv):
+# - overall, in care homes and in people without cancer, with
+#   Newey-West (lag 2) 95% CIs
+# - by subgroup (age, sex, IMD, region, ethnicity), with 95% CIs
+#   clustered by subgroup (as sandwich::vcovPL)
+#
+# The ITS variables (as in 2_time_series_prep.R) are built once per
+# time series, and all models are fitted together by batched IRLS,
+# split across processes. Coefficients, CIs and predicted values all
+# come from a single fit of each model; subgroup comparisons with each
+# reference level are contrasts of one fit, rather than a refit per
+# reference level
+#
+# Author: Andrea Schaffer
+#   Bennett Institute for Applied Data Science
+#   University of Oxford, 2024
+#####################################################################
+
+import hashlib
+import os
+import warnings
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import special, stats
+
+from instrumentation import count_rows_out, stage
+
+
+COVID_START = "2020-03-01"
+RECOVERY_START = "2021-04-01"
+
+# Months of the first lockdown, modelled separately
+COVID_MONTHS = {
+    "mar20": "2020-03-01",
+    "apr20": "2020-04-01",
+    "may20": "2020-05-01",
+}
+
+# Lag of Newey-West standard errors for the overall models
+NEWEY_WEST_LAG = 2
+
+# Models fitted together in each batch
+BATCH_SIZE = 64
+
+MAX_ITERATIONS = 50
+TOLERANCE = 1e-8
+
+# Block bootstrap replicates of each model, and the convergence
+#   tolerance of their fits (percentile CIs don't need the precision
+#   of the reported estimates)
+BOOTSTRAP_REPLICATES = 1000
+BOOTSTRAP_TOLERANCE = 1e-6
+
+# Warn if fewer than this share of a model's replicates converge, as
+#   the CIs then only reflect the samples that could be fitted
+MIN_CONVERGED = 0.9
+
+# Models of a single time series (4a/4b/4c_*.R): the time series and
+#   any rows to select, the outcome and population, whether the model
+#   includes the Mar/Apr/May 2020 dummies, and the labels of the
+#   predicted values
+SERIES_MODELS = {
+    "ts_coef_prev": {
+        "timeseries": "ts_overall", "outcome": "opioid_any", "population": "pop_total",
+        "covid_months": True, "label": "Any opioid prescribing", "var": "Overall",
+    },
+    "ts_coef_new": {
+        "timeseries": "ts_overall", "outcome": "opioid_new", "population": "pop_naive",
+        "covid_months": False, "label": "New opioid prescribing", "var": "Overall",
+    },
+    "ts_coef_hi": {
+        "timeseries": "ts_overall", "outcome": "hi_opioid_any", "population": "pop_total",
+        "covid_months": False, "label": "High dose long-acting opioid prescribing", "var": "Overall",
+    },
+    "ts_coef_parent": {
+        "timeseries": "ts_type", "where": {"measure": "Parenteral"},
+        "outcome": "opioid_any", "population": "pop_total",
+        "covid_months": True, "label": "Parenteral opioid prescribing", "var": "Overall",
+    },
+    "ts_coef_carehome_prev": {
+        "timeseries": "ts_carehome", "outcome": "opioid_any", "population": "pop_total",
+        "covid_months": True, "label": "Any opioid prescribing", "var": "Care home",
+    },
+    "ts_coef_care_new": {
+        "timeseries": "ts_carehome", "outcome": "opioid_new", "population": "pop_naive",
+        "covid_months": True, "label": "New opioid prescribing", "var": "Care home",
+    },
+    "ts_coef_carehome_hi": {
+        "timeseries": "ts_carehome", "outcome": "hi_opioid_any", "population": "pop_total",
+        "covid_months": False, "label": "High dose long-acting opioid prescribing", "var": "Care home",
+    },
+    "ts_coef_carehome_parent": {
+        "timeseries": "ts_carehome", "outcome": "par_opioid_any", "population": "pop_total",
+        "covid_months": True, "label": "Parenteral opioid prescribing", "var": "Care home",
+    },
+    "ts_coef_nocancer_prev": {
+        "timeseries": "ts_overall_nocancer", "outcome": "opioid_any", "population": "pop_total",
+        "covid_months": True, "label": "Any opioid prescribing", "var": "Overall",
+    },
+    "ts_coef_nocancer_new": {
+        "timeseries": "ts_overall_nocancer", "outcome": "opioid_new", "population": "pop_naive",
+        "covid_months": False, "label": "New opioid prescribing", "var": "Overall",
+    },
+    "ts_coef_nocancer_hi": {
+        "timeseries": "ts_overall_nocancer", "outcome": "hi_opioid_any", "population": "pop_total",
+        "covid_months": False, "label": "High dose long-acting opioid prescribing", "var": "Overall",
+    },
+}
+
+# Predicted values files, and the models they combine
+SERIES_PREDICTIONS = {
+    "ts_predicted_all": ["ts_coef_prev", "ts_coef_new", "ts_coef_hi", "ts_coef_parent"],
+    "ts_predicted_carehome": ["ts_coef_carehome_prev", "ts_coef_care_new",
+                              "ts_coef_carehome_hi", "ts_coef_carehome_parent"],
+    "ts_predicted_nocancer": ["ts_coef_nocancer_prev", "ts_coef_nocancer_new",
+                              "ts_coef_nocancer_hi"],
+}
+
+# Models by subgroup (5_subgroup_time_series_models.R): the label, the
+#   subgroups in the order reported, whether missing subgroups are
+#   excluded, and whether the Mar/Apr/May 2020 dummies vary by subgroup
+SUBGROUP_MODELS = {
+    "age": {
+        "label": "Age",
+        "levels": ["18-29", "30-39", "40-49", "50-59", "60-69", "70-79", "80-89", "90+"],
+        "exclude_missing": False,
+        "covid_months_by_group": True,
+    },
+    "sex": {
+        "label": "Sex",
+        "levels": ["female", "male"],
+        "exclude_missing": True,
+        "covid_months_by_group": False,
+    },
+    "imd": {
+        "label": "IMD decile",
+        "levels": ["1 (most deprived)", "2", "3", "4", "5", "6", "7", "8", "9",
+                   "10 (least deprived)"],
+        "exclude_missing": True,
+        "covid_months_by_group": False,
+    },
+    "region": {
+        "label": "Region",
+        "levels": ["East", "North East", "North West", "London", "Yorkshire and The Humber",
+                   "East Midlands", "West Midlands", "South West", "South East"],
+        "exclude_missing": True,
+        "covid_months_by_group": False,
+    },
+    "eth6": {
+        "label": "Ethnicity",
+        "levels": ["White", "Black", "South Asian", "Mixed", "Other", "Unknown"],
+        "exclude_missing": True,
+        "covid_months_by_group": False,
+    },
+}
+
+# Outcomes of the subgroup models
+SUBGROUP_OUTCOMES = {
+    "Prevalent": ("opioid_any", "pop_total"),
+    "Incident": ("opioid_new", "pop_naive"),
+}
+
+# Period effects reported from the subgroup models
+STEP_LABELS = {"step": "Lockdown", "step2": "Recovery"}
+
+
+## ITS variables
+
+# Months of an interval layout (start date and number of monthly
+#   intervals, as --start-date and --intervals of the measures) #
+def layout_months(start_date, intervals):
+    return pd.date_range(start_date, periods=intervals, freq="MS").strftime("%Y-%m-%d")
+
+
+# Position of each month in the interval layout from start_date,
+#   checking that every month is in the layout if its number of
+#   intervals is given #
+def month_positions(months, start_date, intervals=None):
+    months = pd.to_datetime(pd.Series(months))
+    start = pd.Timestamp(start_date)
+    positions = ((months.dt.year - start.year) * 12 + months.dt.month - start.month).to_numpy()
+    if intervals is not None and len(positions) and (positions.min() < 0 or positions.max() >= intervals):
+        raise ValueError(
+            f"Months {months.min():%Y-%m} to {months.max():%Y-%m} aren't all in the "
+            f"{intervals} intervals from {start:%Y-%m} (--start-date and --intervals)"
+        )
+    return positions
+
+
+# Interval layout covering the months of a time series #
+def interval_layout(months):
+    start_date = min(months)
+    return start_date, int(month_positions(months, start_date).max()) + 1
+
+
+# ITS variables for each month (as its.vars in 2_time_series_prep.R) #
+def its_design(start_date, intervals):
+    months = pd.Series(layout_months(start_date, intervals))
+    design = pd.DataFrame({"month": months})
+    for name, month in COVID_MONTHS.items():
+        design[name] = (months == month).astype("int64")
+    design["step"] = (months >= COVID_START).astype("int64")
+    design["step2"] = (months >= RECOVERY_START).astype("int64")
+    design["month_dummy"] = months.str[5:7].astype("int64")
+    design["time"] = np.arange(1, len(months) + 1)
+    design["slope"] = np.where(design["step"] == 1, design["time"] - (design["step"] == 0).sum(), 0)
+    design["slope2"] = np.where(design["step2"] == 1, design["time"] - (design["step2"] == 0).sum(), 0)
+    return design.set_index("month")
+
+
+# Columns of the ITS design matrix, named as in R #
+def design_columns(covid_months):
+    columns = ["(Intercept)", "time", "step", "step2", "slope", "slope2"]
+    if covid_months:
+        columns += list(COVID_MONTHS)
+    return columns + [f"as.factor(month_dummy){month}" for month in range(2, 13)]
+
+
+# ITS design matrix, one row per month of the interval layout #
+def design_matrix(start_date, intervals, covid_months):
+    its = its_design(start_date, intervals).assign(**{"(Intercept)": 1})
+    for month in range(2, 13):
+        its[f"as.factor(month_dummy){month}"] = (its["month_dummy"] == month).astype("int64")
+    return its[design_columns(covid_months)].to_numpy(dtype="float64")
+
+
+class DesignStore:
+    """ITS design matrices, keyed by interval layout and whether the
+    Mar/Apr/May 2020 dummies are included, each built once and shared
+    by every model with that layout. Model matrices built from them
+    (rows for some months, plus subgroup terms) are also shared by
+    models with the same rows and subgroups.
+
+    With a directory, design matrices and model matrices (e.g. the
+    subgroup matrices, with rows for every subgroup and month) are
+    saved as .npy files and memory mapped, so worker processes map the
+    same file (they're passed its path rather than a copy) and later
+    runs reuse it. Files are named with a hash of everything they're
+    built from, including the ITS dates and column layout. Without a
+    directory, model matrices are in-memory arrays, copied to workers.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.designs = {}
+        self.matrices = {}
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    # Saved matrices are invalidated if the ITS variables or columns change #
+    @staticmethod
+    def version():
+        content = (COVID_START, RECOVERY_START, COVID_MONTHS, STEP_LABELS,
+                   design_columns(False), design_columns(True))
+        return hashlib.sha256(repr(content).encode()).hexdigest()[:12]
+
+    def path(self, start_date, intervals, covid_months):
+        name = f"its_{start_date}_{intervals}_{'covid' if covid_months else 'base'}_{self.version()}.npy"
+        return os.path.join(self.directory, name)
+
+    # Matrix from build(), saved to path (if not already) and memory
+    #   mapped, or kept in memory without a directory #
+    def load(self, path, build):
+        if self.directory is None:
+            matrix = build()
+            matrix.flags.writeable = False
+            return matrix
+        if not os.path.exists(path):
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, build())
+            os.replace(path + ".tmp", path)
+        return np.load(path, mmap_mode="r")
+
+    def design(self, start_date, intervals, covid_months):
+        key = (start_date, intervals, covid_months)
+        if key not in self.designs:
+            self.designs[key] = self.load(
+                self.directory and self.path(*key), lambda: design_matrix(*key)
+            )
+        return self.designs[key]
+
+    # Model matrix and its column names for rows of the months of a
+    #   time series (and subgroups: the first level is the reference,
+    #   and interactions with the other levels are added for the
+    #   period effects). Rows covering the whole layout, in order, are
+    #   the design matrix itself, not a copy #
+    def model_matrix(self, months, covid_months, groups=None, levels=None,
+                     covid_months_by_group=False, layout=None):
+        start_date, intervals = layout or interval_layout(months)
+        positions = month_positions(months, start_date, intervals)
+        groups = None if groups is None else np.asarray(groups)
+        key = (
+            start_date, intervals, covid_months, positions.tobytes(),
+            None if groups is None else (tuple(levels), groups.astype(str).tobytes(), covid_months_by_group),
+        )
+        if key in self.matrices:
+            return self.matrices[key]
+
+        design = self.design(start_date, intervals, covid_months)
+        columns = design_columns(covid_months)
+        if groups is None and np.array_equal(positions, np.arange(intervals)):
+            self.matrices[key] = (design, columns)
+            return self.matrices[key]
+
+        if groups is not None:
+            interactions = list(STEP_LABELS)
+            if covid_months_by_group:
+                interactions += list(COVID_MONTHS)
+            columns = columns + [f"cat{level}" for level in levels[1:]] + [
+                f"{name}:cat{level}" for name in interactions for level in levels[1:]
+            ]
+
+        def build():
+            X = design[positions]
+            if groups is None:
+                return X
+            indicators = [(groups == level).astype("float64") for level in levels[1:]]
+            base = design_columns(covid_months)
+            extra = indicators + [
+                X[:, base.index(name)] * indicator
+                for name in interactions
+                for indicator in indicators
+            ]
+            return np.column_stack([X] + extra)
+
+        path = None
+        if self.directory is not None:
+            digest = hashlib.sha256(repr((key, columns)).encode()).hexdigest()[:16]
+            path = os.path.join(self.directory, f"model_{digest}_{self.version()}.npy")
+        self.matrices[key] = (self.load(path, build), columns)
+        return self.matrices[key]
+
+
+## Batched negative binomial fitting
+
+# Negative binomial log-likelihood of each model #
+def nb_loglik(y, mu, theta, weights):
+    theta = theta[:, None]
+    ll = (special.gammaln(theta + y) - special.gammaln(theta) - special.gammaln(y + 1)
+          + theta * np.log(theta) + special.xlogy(y, mu) - (theta + y) * np.log(theta + mu))
+    return (weights * ll).sum(axis=1)
+
+
+# Columns of the model matrix that are zero in every row with weight,
+#   for each model (e.g. a dummy for a month whose count is redacted).
+#   Their coefficients can't be estimated, so are fixed at zero and
+#   reported as NA (as glm.nb) #
+def empty_columns(X, weights):
+    if X.ndim == 2:
+        return weights @ np.abs(X) == 0
+    return np.einsum("bn,bnp->bp", weights, np.abs(X)) == 0
+
+
+# Cross-product matrix of each model, with the rows and columns of
+#   empty columns replaced by those of the identity matrix, so it can
+#   be inverted #
+def without_empty(XtWX, empty):
+    fixed = empty[:, :, None] | empty[:, None, :]
+    return np.where(fixed, np.eye(XtWX.shape[-1]), XtWX)
+
+
+# Weighted least squares step of IRLS for each model #
+def irls_step(X, y, offset, weights, eta, theta, empty):
+    mu = np.exp(eta)
+    w = weights * mu / (1 + mu / theta[:, None])
+    z = eta - offset + (y - mu) / mu
+    Xw = X * w[:, :, None]
+    beta = np.linalg.solve(without_empty(Xw.transpose(0, 2, 1) @ X, empty),
+                           np.where(empty, 0, np.einsum("bnp,bn->bp", Xw, z)))
+    return beta, linear_predictor(X, beta) + offset
+
+
+# Linear predictor of each model, for a model matrix of each model or
+#   one shared by all of them #
+def linear_predictor(X, beta):
+    return (X @ beta[:, :, None])[..., 0]
+
+
+# Maximum likelihood estimate of theta given the fitted means (as
+#   MASS::theta.ml), by Newton's method on log(theta) #
+def theta_ml(y, mu, weights, theta=None, iterations=MAX_ITERATIONS):
+    n = weights.sum(axis=1)
+    if theta is None:
+        theta = n / (weights * (y / mu - 1) ** 2).sum(axis=1)
+    for _ in range(iterations):
+        t = theta[:, None]
+        score = (weights * (special.digamma(t + y) - special.digamma(t) + np.log(t) + 1
+                            - np.log(t + mu) - (y + t) / (mu + t))).sum(axis=1)
+        info = (weights * (-special.polygamma(1, t + y) + special.polygamma(1, t) - 1 / t
+                           + 2 / (mu + t) - (y + t) / (mu + t) ** 2)).sum(axis=1)
+        # Score and information with respect to log(theta)
+        step = score * theta / (info * theta ** 2 - score * theta)
+        step = np.clip(np.nan_to_num(step), -5, 5)
+        theta = theta * np.exp(step)
+        if np.all(np.abs(step) < TOLERANCE):
+            break
+    return theta
+
+
+# Coefficients of a batch of negative binomial models with log link
+#   (as MASS::glm.nb), alternating IRLS for the coefficients and ML for
+#   theta, from a Poisson fit or (warm start) given coefficients and
+#   theta. X is the model matrix shared by the models in the batch, or
+#   one for each model; rows with zero weight are ignored #
+def nb_coefficients(X, y, offset, weights, beta=None, theta=None, tolerance=TOLERANCE):
+    empty = empty_columns(X, weights)
+    warm_start = beta is not None
+    if warm_start:
+        beta = np.where(empty, 0, beta)
+        eta = linear_predictor(X, beta) + offset
+    else:
+        # Start from a Poisson fit (theta -> infinity)
+        eta = np.log(y + 0.1)
+        beta = np.zeros((len(y), X.shape[-1]))
+        theta = np.full(len(y), 1e8)
+
+    loglik = np.full(len(y), -np.inf)
+    for iteration in range(MAX_ITERATIONS):
+        for _ in range(MAX_ITERATIONS):
+            beta_new, eta = irls_step(X, y, offset, weights, eta, theta, empty)
+            change = np.abs(beta_new - beta).max(axis=1)
+            beta = beta_new
+            if np.all(change < tolerance * (1 + np.abs(beta).max(axis=1))):
+                break
+        theta = theta_ml(y, np.exp(eta), weights, theta if warm_start or iteration > 0 else None)
+        loglik_new = nb_loglik(y, np.exp(eta), theta, weights)
+        converged = np.abs(loglik_new - loglik) < tolerance * (np.abs(loglik) + 0.1)
+        loglik = loglik_new
+        if converged.all():
+            break
+
+    return {
+        "beta": beta,
+        "theta": theta,
+        "eta": eta,
+        "loglik": loglik,
+        "iterations": np.full(len(y), iteration + 1),
+        "converged": converged,
+        "empty": empty,
+    }
+
+
+# Fit a batch of negative binomial models, with what's needed for
+#   inference and predictions. X is the model matrix shared by the
+#   models (or the path of one saved by DesignStore), or one for each
+#   model; rows with zero weight (missing counts) are ignored #
+def fit_nb_batch(X, y, offset, weights):
+    if isinstance(X, str):
+        X = np.load(X, mmap_mode="r")
+    y = np.where(weights > 0, y, 0)
+    offset = np.where(weights > 0, offset, 0)
+    fit = nb_coefficients(X, y, offset, weights)
+
+    theta = fit["theta"]
+    mu = np.exp(fit["eta"])
+    w = weights * mu / (1 + mu / theta[:, None])
+    Xw = X * w[:, :, None]
+    empty = fit["empty"]
+    bread = np.linalg.inv(without_empty(Xw.transpose(0, 2, 1) @ X, empty))
+    fit["bread"] = np.where(empty[:, :, None] | empty[:, None, :], 0, bread)
+    # Score contributions of each row (as sandwich::estfun)
+    fit["scores"] = X * (weights * (y - mu) / (1 + mu / theta[:, None]))[:, :, None]
+    fit["residuals"] = np.where(weights > 0, (y - mu) / mu, np.nan)
+    fit["n"] = weights.sum(axis=1)
+    return fit
+
+
+# Fit models (dicts with X, y, offset and weights arrays), in batches
+#   of models sharing a model matrix (e.g. outcomes of the same time
+#   series), with batches split across processes. A memory mapped
+#   model matrix is passed to workers by its path #
+def fit_models(models, workers=1, batch_size=BATCH_SIZE):
+    shared = {}
+    for i, model in enumerate(models):
+        shared.setdefault(id(model["X"]), []).append(i)
+
+    batches = []
+    for indices in shared.values():
+        X = models[indices[0]]["X"]
+        for start in range(0, len(indices), batch_size):
+            batch = indices[start:start + batch_size]
+            batches.append((batch, [X.filename if isinstance(X, np.memmap) else X] + [
+                np.stack([models[i][key] for i in batch]).astype("float64")
+                for key in ["y", "offset", "weights"]
+            ]))
+
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            results = list(executor.map(fit_nb_batch, *zip(*[arrays for _, arrays in batches])))
+    else:
+        results = [fit_nb_batch(*arrays) for _, arrays in batches]
+
+    fits = [None] * len(models)
+    for (batch, _), result in zip(batches, results):
+        for j, i in enumerate(batch):
+            fits[i] = {key: value[j] for key, value in result.items()}
+    return fits
+
+
+## Inference
+
+# Heteroskedasticity and autocorrelation consistent covariance of the
+#   coefficients, with Bartlett weights. Scores are summed within
+#   each time period first, so with clusters this is the panel
+#   Newey-West (Driscoll-Kraay) estimator of sandwich::vcovPL #
+def hac_vcov(fit, periods, lag, adjust=False):
+    _, period_index = np.unique(periods, return_inverse=True)
+    scores = np.zeros((period_index.max() + 1, fit["scores"].shape[1]))
+    np.add.at(scores, period_index, fit["scores"])
+
+    meat = scores.T @ scores
+    for l in range(1, lag + 1):
+        gamma = scores[l:].T @ scores[:-l]
+        meat += (1 - l / (lag + 1)) * (gamma + gamma.T)
+
+    vcov = fit["bread"] @ meat @ fit["bread"]
+    if adjust:
+        k = (~fit["empty"]).sum()
+        vcov *= fit["n"] / (fit["n"] - k)
+    return vcov
+
+
+# Estimate of a contrast of the coefficients of each fit, NaN where it
+#   involves a coefficient that couldn't be estimated #
+def contrast_estimates(beta, empty, contrast):
+    estimable = ~(empty & (contrast != 0)).any(axis=-1)
+    return np.where(estimable, beta @ contrast, np.nan)
+
+
+# Lag of sandwich::vcovPL by default (Newey and West, 1987) #
+def panel_lag(periods):
+    return int(np.floor(len(np.unique(periods)) ** 0.25))
+
+
+# Ljung-Box test of autocorrelation of residuals (as Box.test) #
+def ljung_box(residuals, lag=1):
+    residuals = residuals[~np.isnan(residuals)]
+    residuals = residuals - residuals.mean()
+    n = len(residuals)
+    acf = np.array([
+        (residuals[l:] * residuals[:-l]).sum() for l in range(1, lag + 1)
+    ]) / (residuals ** 2).sum()
+    statistic = n * (n + 2) * (acf ** 2 / (n - np.arange(1, lag + 1))).sum()
+    return stats.chi2.sf(statistic, lag)
+
+
+# Predicted rates with 95% CIs, from the linear predictor (without the
+#   population offset) and the model-based covariance (as
+#   predict(se.fit = TRUE)) #
+def predicted_rates(fit, X, per=1000, z=1.96):
+    eta = X @ fit["beta"]
+    se = np.sqrt(np.einsum("np,pq,nq->n", X, fit["bread"], X))
+    return np.exp(eta) * per, np.exp(eta - z * se) * per, np.exp(eta + z * se) * per
+
+
+## Model data
+
+# Observed rates per 1,000 #
+def observed_rates(outcome, population, per=1000):
+    return (outcome.to_numpy(dtype="float64", na_value=np.nan)
+            / population.to_numpy(dtype="float64", na_value=np.nan) * per)
+
+
+def read_timeseries(input_dir, name):
+    data = pd.read_csv(os.path.join(input_dir, f"{name}_rounded.csv"), dtype={"month": str})
+    return data.sort_values("month", kind="stable").reset_index(drop=True)
+
+
+# Arrays for fitting a model, with missing counts given zero weight #
+def model_arrays(X, outcome, population):
+    y = outcome.to_numpy(dtype="float64", na_value=np.nan)
+    pop = population.to_numpy(dtype="float64", na_value=np.nan)
+    missing = np.isnan(y) | np.isnan(pop) | (pop <= 0)
+    return {
+        "X": X,
+        "y": np.where(missing, 0, y),
+        "offset": np.where(missing, 0, np.log(np.where(missing, 1, pop))),
+        "weights": (~missing).astype("float64"),
+    }
+
+
+class SeriesModel:
+    """Model of a single time series, with and without the Mar/Apr/May
+    2020 dummies (the variant in the spec is reported; both are fitted
+    to compare them, as in 4a/4b/4c_*.R).
+    """
+
+    def __init__(self, name, spec, timeseries, store, layout=None):
+        self.name = name
+        self.spec = spec
+        data = timeseries[spec["timeseries"]]
+        for column, value in spec.get("where", {}).items():
+            data = data[data[column] == value]
+        self.data = data.reset_index(drop=True)
+
+        layout = layout or interval_layout(timeseries[spec["timeseries"]]["month"])
+        self.positions = month_positions(self.data["month"], *layout)
+        self.groups = np.zeros(len(self.data), dtype="int64")
+        self.outcome = self.data[f"{spec['outcome']}_round"]
+        self.population = self.data[f"{spec['population']}_round"]
+        self.matrices = {
+            covid_months: store.model_matrix(self.data["month"], covid_months, layout=layout)
+            for covid_months in [False, True]
+        }
+        self.X, self.columns = self.matrices[spec["covid_months"]]
+
+    def arrays(self):
+        return [model_arrays(self.matrices[covid_months][0], self.outcome, self.population)
+                for covid_months in [False, True]]
+
+    def set_fits(self, fits):
+        self.fits = dict(zip([False, True], fits))
+        self.fit = self.fits[self.spec["covid_months"]]
+
+    # Period effects, as contrasts of the coefficients #
+    def effects(self):
+        return [
+            {
+                "model": self.name,
+                "outcome": self.spec["label"],
+                "label": self.spec["var"],
+                "time": time,
+                "contrast": np.eye(len(self.columns))[self.columns.index(name)],
+            }
+            for name, time in STEP_LABELS.items()
+        ]
+
+    # Coefficients as rate ratios, with Newey-West 95% CIs (as coef()
+    #   in custom_functions.R) #
+    def coefficients(self, z=1.96):
+        fit = self.fit
+        vcov = hac_vcov(fit, self.data["month"].to_numpy(), NEWEY_WEST_LAG)
+        se = np.sqrt(np.diag(vcov))
+        beta = np.where(fit["empty"], np.nan, fit["beta"])
+        est = np.exp(beta)
+        lci = np.exp(beta - z * se)
+        uci = np.exp(beta + z * se)
+        coef = pd.DataFrame(
+            {"est": est.round(5), "lci": lci.round(5), "uci": uci.round(5)},
+            index=self.columns,
+        )
+        for column in ["est", "lci", "uci"]:
+            coef[f"pcent_{column}"] = ((coef[column] - 1) * 100).round(2)
+        return coef
+
+    # Observed and predicted rates per 1,000 (as pred.val() in
+    #   custom_functions.R) #
+    def predictions(self):
+        pred, lci, uci = predicted_rates(self.fit, self.X)
+        return pd.DataFrame({
+            "month": self.data["month"],
+            "pred": pred,
+            "obs": observed_rates(self.outcome, self.population),
+            "outcome": self.spec["label"],
+            "var": self.spec["var"],
+            "pred_lci": lci,
+            "pred_uci": uci,
+            "period": self.data["period"],
+        })
+
+    def fit_summary(self):
+        return pd.DataFrame([
+            {
+                "model": self.name,
+                "covid_months": covid_months,
+                "selected": covid_months == self.spec["covid_months"],
+                "n": int(fit["n"]),
+                "theta": fit["theta"],
+                "loglik": fit["loglik"],
+                "aic": -2 * fit["loglik"] + 2 * ((~fit["empty"]).sum() + 1),
+                "ljung_box_p": ljung_box(fit["residuals"]),
+                "iterations": fit["iterations"],
+                "converged": fit["converged"],
+            }
+            for covid_months, fit in self.fits.items()
+        ])
+
+
+class SubgroupModel:
+    """Model of the time series of each subgroup of a variable, for one
+    outcome, with period effects that vary by subgroup. The effects in
+    each subgroup, and 95% CIs clustered by subgroup, are contrasts of
+    a single fit (equivalent to refitting with each subgroup as the
+    reference level, as nb() in custom_functions.R).
+    """
+
+    def __init__(self, var, spec, outcome_type, demo, store, layout=None):
+        self.var = var
+        self.spec = spec
+        self.outcome_type = outcome_type
+        outcome, population = SUBGROUP_OUTCOMES[outcome_type]
+
+        data = demo[demo["var"] == var]
+        if spec["exclude_missing"]:
+            data = data[data["cat"].notna() & (data["cat"] != "Missing")]
+        self.data = data.sort_values(["cat", "month"], kind="stable").reset_index(drop=True)
+
+        present = set(self.data["cat"])
+        self.levels = [level for level in spec["levels"] if level in present]
+        self.levels += sorted(present - set(self.levels))
+
+        layout = layout or interval_layout(demo["month"])
+        self.positions = month_positions(self.data["month"], *layout)
+        self.groups = self.data["cat"].to_numpy()
+        self.X, self.columns = store.model_matrix(
+            self.data["month"], True, self.groups, self.levels,
+            spec["covid_months_by_group"], layout,
+        )
+        self.outcome = self.data[f"{outcome}_round"]
+        self.population = self.data[f"{population}_round"]
+
+    def arrays(self):
+        return [model_arrays(self.X, self.outcome, self.population)]
+
+    def set_fits(self, fits):
+        (self.fit,) = fits
+
+    # Period effects in each subgroup, as contrasts of the coefficients #
+    def effects(self):
+        effects = []
+        for level in self.spec["levels"]:
+            if level not in self.levels:
+                continue
+            for name, time in STEP_LABELS.items():
+                contrast = np.zeros(len(self.columns))
+                contrast[self.columns.index(name)] = 1
+                if level != self.levels[0]:
+                    contrast[self.columns.index(f"{name}:cat{level}")] = 1
+                effects.append({
+                    "model": self.var,
+                    "outcome": self.outcome_type,
+                    "label": level,
+                    "time": time,
+                    "contrast": contrast,
+                })
+        return effects
+
+    def coefficients(self, z=1.96):
+        months = self.data["month"].to_numpy()
+        vcov = hac_vcov(self.fit, months, panel_lag(months), adjust=True)
+
+        rows = []
+        for effect in self.effects():
+            contrast = effect["contrast"]
+            estimate = contrast_estimates(self.fit["beta"], self.fit["empty"], contrast)
+            se = np.sqrt(contrast @ vcov @ contrast)
+            rows.append({
+                "x2_5": np.exp(estimate - z * se),
+                "x97_5": np.exp(estimate + z * se),
+                "coef": np.exp(estimate),
+                "label": effect["label"],
+                "time": effect["time"],
+                "type": self.outcome_type,
+                "var": self.spec["label"],
+            })
+        return pd.DataFrame(rows)
+
+    # Observed and predicted rates per 1,000 (as pred.val.cat() in
+    #   custom_functions.R) #
+    def predictions(self):
+        pred, lci, uci = predicted_rates(self.fit, self.X)
+        return pd.DataFrame({
+            "month": self.data["month"],
+            "pred": pred,
+            "obs": observed_rates(self.outcome, self.population),
+            "pred_lci": lci,
+            "pred_uci": uci,
+            "type": self.outcome_type,
+            "period": self.data["period"],
+            "var": self.var,
+            "cat": self.data["cat"],
+        })
+
+
+# Fit all models in one batch, setting each model's fits #
+def fit_all(models, workers=1):
+    arrays = [model.arrays() for model in models]
+    fits = fit_models([a for model_arrays in arrays for a in model_arrays], workers)
+    start = 0
+    for model, model_arrays in zip(models, arrays):
+        model.set_fits(fits[start:start + len(model_arrays)])
+        start += len(model_arrays)
+
+
+## Block bootstrap inference
+
+# Months of each bootstrap replicate, by moving block bootstrap: blocks
+#   of consecutive months with uniformly drawn starts, concatenated
+#   and truncated to the number of intervals #
+def block_months(rng, intervals, block_length, replicates):
+    blocks = -(-intervals // block_length)
+    starts = rng.integers(0, intervals - block_length + 1, size=(replicates, blocks))
+    return (starts[:, :, None] + np.arange(block_length)).reshape(replicates, -1)[:, :intervals]
+
+
+# Default block length, the cube root of the number of intervals #
+def default_block_length(intervals):
+    return max(1, int(round(intervals ** (1 / 3))))
+
+
+# Bootstrap replicates of a fitted model's counts: the ratios of
+#   observed to fitted counts are resampled in blocks of months (the
+#   same months for every subgroup, so correlation between subgroups
+#   is kept) and applied to the fitted counts. Returns the counts and
+#   weights (zero where the resampled month is missing) #
+def bootstrap_counts(model, arrays, rng, replicates, block_length=None):
+    intervals = int(model.positions.max()) + 1
+    _, groups = np.unique(model.groups.astype(str), return_inverse=True)
+    rows = np.full((groups.max() + 1, intervals), -1)
+    rows[groups, model.positions] = np.arange(len(groups))
+
+    months = block_months(rng, intervals, block_length or default_block_length(intervals), replicates)
+    source = rows[groups[None, :], months[:, model.positions]]
+    weights = arrays["weights"][None, :] * np.where(source >= 0, arrays["weights"][source], 0)
+    source = np.where(source >= 0, source, 0)
+
+    mu = np.exp(model.fit["eta"])
+    ratios = np.where(arrays["weights"] > 0, arrays["y"] / mu, 0)
+    return np.round(mu[None, :] * ratios[source]), weights
+
+
+# Coefficients of a batch of bootstrap replicates, warm started from the
+#   model's fit #
+def fit_bootstrap_batch(X, y, offset, weights, beta, theta):
+    if isinstance(X, str):
+        X = np.load(X, mmap_mode="r")
+    replicates = len(y)
+    fit = nb_coefficients(X, y, np.broadcast_to(offset, y.shape), weights,
+                          np.tile(beta, (replicates, 1)), np.full(replicates, theta),
+                          BOOTSTRAP_TOLERANCE)
+    return fit["beta"], fit["converged"], fit["empty"]
+
+
+# Percentile 95% CIs of the period effects of each model from block
+#   bootstrap replicates. Each model's replicates are drawn from its own
+#   stream of the seed, so results don't depend on the number of
+#   processes or the batch size #
+def bootstrap_effects(models, replicates=BOOTSTRAP_REPLICATES, seed=2024, block_length=None,
+                      workers=1, batch_size=BATCH_SIZE):
+    streams = np.random.SeedSequence(seed).spawn(len(models))
+
+    tasks = []
+    for model, stream in zip(models, streams):
+        arrays = model_arrays(model.X, model.outcome, model.population)
+        y, weights = bootstrap_counts(model, arrays, np.random.default_rng(stream), replicates,
+                                      block_length)
+        X = model.X.filename if isinstance(model.X, np.memmap) else model.X
+        for start in range(0, replicates, batch_size):
+            tasks.append((X, y[start:start + batch_size], arrays["offset"],
+                          weights[start:start + batch_size], model.fit["beta"], model.fit["theta"]))
+
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            results = list(executor.map(fit_bootstrap_batch, *zip(*tasks)))
+    else:
+        results = [fit_bootstrap_batch(*task) for task in tasks]
+
+    rows = []
+    batches = -(-replicates // batch_size)
+    for i, model in enumerate(models):
+        model_results = results[i * batches:(i + 1) * batches]
+        betas = np.concatenate([beta for beta, _, _ in model_results])
+        converged = np.concatenate([converged for _, converged, _ in model_results])
+        empty = np.concatenate([empty for _, _, empty in model_results])
+        effects = model.effects()
+
+        n_converged = int(converged.sum())
+        label = f"{effects[0]['model']} ({effects[0]['outcome']})"
+        if n_converged == 0:
+            warnings.warn(f"No bootstrap replicates of {label} converged; its CIs are NA")
+        elif n_converged < MIN_CONVERGED * replicates:
+            warnings.warn(f"Only {n_converged} of {replicates} bootstrap replicates of {label} converged")
+
+        for effect in effects:
+            # Replicates where the contrast can't be estimated (e.g. a
+            #   resampled month is missing) are left out, as well as
+            #   those that didn't converge
+            estimates = contrast_estimates(betas, empty, effect["contrast"])[converged]
+            estimates = estimates[~np.isnan(estimates)]
+            if len(estimates) == 0:
+                lower, upper = np.nan, np.nan
+            else:
+                lower, upper = np.percentile(estimates, [2.5, 97.5])
+            rows.append({
+                "model": effect["model"],
+                "outcome": effect["outcome"],
+                "label": effect["label"],
+                "time": effect["time"],
+                "coef": np.exp(contrast_estimates(model.fit["beta"], model.fit["empty"],
+                                                  effect["contrast"])),
+                "x2_5": np.exp(lower),
+                "x97_5": np.exp(upper),
+                "replicates": n_converged,
+            })
+    return pd.DataFrame(rows)
+
+
+def write_csv(data, output_dir, name, **kwargs):
+    data.to_csv(os.path.join(output_dir, f"{name}.csv"), na_rep="NA", **kwargs)
+    count_rows_out(len(data))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--input-dir", type=str, default="output/released_outputs/final")
+    parser.add_argument("--output-dir", type=str, default="output/released_outputs/final")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+        help="Number of processes to fit models in")
+    parser.add_argument("--start-date", type=str,
+        help="Start of the interval layout (as the measures); by default, the first month")
+    parser.add_argument("--intervals", type=int,
+        help="Number of monthly intervals (as the measures); by default, up to the last month")
+    parser.add_argument("--design-dir", type=str,
+        help="Directory to save ITS design and model matrices in, memory mapped and reused across runs")
+    parser.add_argument("--bootstrap", type=int, nargs="?", const=BOOTSTRAP_REPLICATES, default=0,
+        help="Also estimate percentile 95%% CIs of the period effects from this many "
+             "block bootstrap replicates")
+    parser.add_argument("--seed", type=int, default=2024)
+    parser.add_argument("--block-length", type=int,
+        help="Months in each bootstrap block; by default, the cube root of the number of months")
+
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    with stage("its_models/read") as s:
+        timeseries = {
+            name: read_timeseries(args.input_dir, name)
+            for name in {spec["timeseries"] for spec in SERIES_MODELS.values()} | {"ts_demo"}
+        }
+        s.rows_in = s.rows_out = sum(len(data) for data in timeseries.values())
+
+    store = DesignStore(args.design_dir)
+    layout = (args.start_date, args.intervals) if args.start_date and args.intervals else None
+
+    series_models = {
+        name: SeriesModel(name, spec, timeseries, store, layout)
+        for name, spec in SERIES_MODELS.items()
+    }
+    subgroup_models = [
+        SubgroupModel(var, spec, outcome_type, timeseries["ts_demo"], store, layout)
+        for var, spec in SUBGROUP_MODELS.items()
+        for outcome_type in SUBGROUP_OUTCOMES
+    ]
+    all_models = list(series_models.values()) + subgroup_models
+    with stage("its_models/fit", models=len(all_models), workers=args.workers) as s:
+        fit_all(all_models, args.workers)
+        s.rows_in = sum(len(model.outcome) for model in all_models)
+
+    with stage("its_models/write"):
+        ## Overall, care home and no cancer models
+        for name, model in series_models.items():
+            write_csv(model.coefficients(), args.output_dir, name, index_label="")
+        for name, models in SERIES_PREDICTIONS.items():
+            predictions = pd.concat([series_models[model].predictions() for model in models])
+            write_csv(predictions, args.output_dir, name, index=False)
+        fit_summary = pd.concat([model.fit_summary() for model in series_models.values()])
+        write_csv(fit_summary, args.output_dir, "ts_model_fits", index=False)
+
+        ## Subgroup models, with coefficients ordered by subgroup then outcome
+        coefficients = []
+        for var, spec in SUBGROUP_MODELS.items():
+            var_coefficients = pd.concat([
+                model.coefficients() for model in subgroup_models if model.var == var
+            ])
+            order = var_coefficients["label"].map({level: i for i, level in enumerate(spec["levels"])})
+            coefficients.append(var_coefficients.iloc[np.argsort(order.to_numpy(), kind="stable")])
+        write_csv(pd.concat(coefficients), args.output_dir, "coefficients_bygroup", index=False)
+        write_csv(pd.concat([model.predictions() for model in subgroup_models]),
+                  args.output_dir, "predicted_vals_bygroup", index=False)
+
+    ## Block bootstrap CIs of the period effects
+    if args.bootstrap:
+        with stage("its_models/bootstrap", replicates=args.bootstrap, workers=args.workers):
+            bootstrap = bootstrap_effects(
+                all_models, args.bootstrap, args.seed, args.block_length, args.workers,
+            )
+            write_csv(bootstrap, args.output_dir, "ts_coef_bootstrap", index=False)
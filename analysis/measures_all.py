@@ -0,0 +1,56 @@
+#################################################################
+# This script creates monthly counts/rates of opioid
+# prescribing for all measures files (overall, demographics,
+# opioid type, care home, age/sex) in a single extraction, so the
+# medications and registrations tables are only scanned once.
+# Measure names are prefixed with the name of the file they
+# belong to (e.g. "carehome__opioid_any") and split back
+# into the separate files by split_measures.py
+#
+# Author: Andrea Schaffer 
+#   Bennett Institute for Applied Data Science
+#   University of Oxford, 2024
+#####################################################################
+
+from ehrql import months, INTERVAL, Measures
+
+from dataset_definition import make_dataset_opioids
+from measures_definitions import (
+    MEASURES_FILES,
+    MeasureSelection,
+    parse_measure_names)
+
+##########
+
+from argparse import ArgumentParser
+
+parser = ArgumentParser()
+parser.add_argument("--start-date", type=str)
+parser.add_argument("--intervals", type=int)
+parser.add_argument("--measures", type=str,
+    help="Comma-separated names of the measures to define (default all)")
+
+args = parser.parse_args()
+
+start_date = args.start_date
+intervals = args.intervals
+
+##########
+
+index_date = INTERVAL.start_date
+
+dataset = make_dataset_opioids(index_date=index_date, end_date=INTERVAL.end_date)
+
+##########
+
+measures = Measures()
+measures.configure_disclosure_control(enabled=False)
+
+measures.define_defaults(intervals=months(intervals).starting_on(start_date))
+
+measures.configure_dummy_data(population_size=5000)
+
+selection = MeasureSelection(measures, parse_measure_names(args.measures))
+
+for name, define_measures in MEASURES_FILES.items():
+    define_measures(selection, dataset, index_date, prefix=f"{name}__")
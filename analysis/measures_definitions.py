@@ -0,0 +1,423 @@
+###################################################
+# This script defines functions that add the monthly
+#   opioid prescribing measures to a Measures object,
+#   one function per measures output file, so that
+#   they can be generated separately or all together
+#
+# Author: Andrea Schaffer
+#   Bennett Institute for Applied Data Science
+#   University of Oxford, 2024
+#####################################################################
+
+
+from ehrql import case, when
+from ehrql.tables.tpp import (
+    patients,
+    addresses,
+    practice_registrations,
+    clinical_events)
+
+import codelists
+from carehome import make_carehome
+from cohort import make_denominator
+
+
+# Age group #
+def make_age_group(index_date):
+    age = patients.age_on(index_date)
+    return case(
+        when(age < 30).then("18-29"),
+        when(age < 40).then("30-39"),
+        when(age < 50).then("40-49"),
+        when(age < 60).then("50-59"),
+        when(age < 70).then("60-69"),
+        when(age < 80).then("70-79"),
+        when(age < 90).then("80-89"),
+        when(age >= 90).then("90+"),
+        otherwise="missing",
+    )
+
+
+# Age band for standardisation, matching ONS-data/ons_pop_stand.csv #
+def make_age_stand(index_date):
+    age = patients.age_on(index_date)
+    return case(
+        when(age < 25).then("18-24"),
+        when(age < 30).then("25-29"),
+        when(age < 35).then("30-34"),
+        when(age < 40).then("35-39"),
+        when(age < 45).then("40-44"),
+        when(age < 50).then("45-49"),
+        when(age < 55).then("50-54"),
+        when(age < 60).then("55-59"),
+        when(age < 65).then("60-64"),
+        when(age < 70).then("65-69"),
+        when(age < 75).then("70-74"),
+        when(age < 80).then("75-79"),
+        when(age < 85).then("80-84"),
+        when(age < 90).then("85-89"),
+        when(age >= 90).then("90+"),
+        otherwise="missing",
+    )
+
+
+# Static covariates - do not depend on index date, so the same
+#   expressions are used in every interval. ehrQL still evaluates
+#   each interval as a separate query, so they are re-computed for
+#   every interval; defining them once only avoids rebuilding them #
+def make_static_covariates():
+
+    ethnicity = clinical_events.where(
+            clinical_events.snomedct_code.is_in(codelists.ethnicity_codes_6)
+        ).sort_by(
+            clinical_events.date
+        ).last_for_patient().snomedct_code.to_category(codelists.ethnicity_codes_6)
+
+    ethnicity6 = case(
+        when(ethnicity == "1").then("White"),
+        when(ethnicity == "2").then("Mixed"),
+        when(ethnicity == "3").then("South Asian"),
+        when(ethnicity == "4").then("Black"),
+        when(ethnicity == "5").then("Other"),
+        when(ethnicity == "6").then("Not stated"),
+        otherwise="Unknown"
+    )
+
+    return {
+        "sex": patients.sex,
+        "ethnicity6": ethnicity6,
+    }
+
+
+static_covariates = make_static_covariates()
+
+
+# Interval covariates - depend on index date #
+def make_interval_covariates(index_date):
+
+    imd = addresses.for_patient_on(index_date).imd_rounded
+    imd10 = case(
+        when((imd >= 0) & (imd < int(32844 * 1 / 10))).then("1 (most deprived)"),
+        when(imd < int(32844 * 2 / 10)).then("2"),
+        when(imd < int(32844 * 3 / 10)).then("3"),
+        when(imd < int(32844 * 4 / 10)).then("4"),
+        when(imd < int(32844 * 5 / 10)).then("5"),
+        when(imd < int(32844 * 6 / 10)).then("6"),
+        when(imd < int(32844 * 7 / 10)).then("7"),
+        when(imd < int(32844 * 8 / 10)).then("8"),
+        when(imd < int(32844 * 9 / 10)).then("9"),
+        when(imd >= int(32844 * 9 / 10)).then("10 (least deprived)"),
+        otherwise="unknown"
+    )
+
+    region = practice_registrations.for_patient_on(index_date).practice_nuts1_region_name
+
+    return {
+        "age_group": make_age_group(index_date),
+        "region": region,
+        "imd": imd10,
+    }
+
+
+# Demographic categories for stratified measures #
+def make_demographics(index_date):
+    interval_covariates = make_interval_covariates(index_date)
+
+    # Order matches the group columns in measures_demo_*.csv
+    return {
+        "age_group": interval_covariates["age_group"],
+        "sex": static_covariates["sex"],
+        "region": interval_covariates["region"],
+        "imd": interval_covariates["imd"],
+        "ethnicity6": static_covariates["ethnicity6"],
+    }
+
+
+# Wraps a Measures object so that only the named measures are
+#   defined (all measures if names is None), e.g. to only compute
+#   the measures that are not in the cache (cached_measures.py) #
+class MeasureSelection:
+
+    def __init__(self, measures, names=None):
+        self.measures = measures
+        self.names = None if names is None else set(names)
+
+    def define_measure(self, name, **kwargs):
+        if self.names is None or name in self.names:
+            self.measures.define_measure(name=name, **kwargs)
+
+
+# Measure names from a comma-separated --measures argument #
+def parse_measure_names(value):
+    return value.split(",") if value else None
+
+
+## Measures - prevalent and new prescribing - overall
+def define_measures_overall(measures, dataset, index_date, prefix=""):
+
+    denominator = make_denominator(index_date)
+
+    ## In full population
+    measures.define_measure(
+        name=prefix + "opioid_any",
+        numerator=dataset.opioid_any,
+        denominator=denominator,
+        )
+
+    measures.define_measure(
+        name=prefix + "opioid_new",
+        numerator=dataset.opioid_new,
+        denominator=denominator & dataset.opioid_naive,
+        )
+
+    measures.define_measure(
+        name=prefix + "hi_opioid_any",
+        numerator=dataset.hi_opioid_any,
+        denominator=denominator,
+        )
+
+    ## People without cancer
+    measures.define_measure(
+        name=prefix + "opioid_any_nocancer",
+        numerator=dataset.opioid_any,
+        denominator=denominator & ~dataset.cancer,
+        )
+
+    measures.define_measure(
+        name=prefix + "opioid_new_nocancer",
+        numerator=dataset.opioid_new,
+        denominator=denominator & dataset.opioid_naive & ~dataset.cancer,
+        )
+
+    measures.define_measure(
+        name=prefix + "hi_opioid_any_nocancer",
+        numerator=dataset.hi_opioid_any,
+        denominator=denominator & ~dataset.cancer,
+        )
+
+
+## Measures - prevalent prescribing - by opioid type
+def define_measures_type(measures, dataset, index_date, prefix=""):
+
+    denominator = make_denominator(index_date)
+
+    measures.define_measure(
+        name=prefix + "oral_opioid",
+        numerator=dataset.oral_opioid_any,
+        denominator=denominator
+        )
+
+    measures.define_measure(
+        name=prefix + "trans_opioid",
+        numerator=dataset.trans_opioid_any,
+        denominator=denominator
+        )
+
+    measures.define_measure(
+        name=prefix + "par_opioid",
+        numerator=dataset.par_opioid_any,
+        denominator=denominator
+        )
+
+    measures.define_measure(
+        name=prefix + "oth_opioid",
+        numerator=dataset.oth_opioid_any,
+        denominator=denominator
+        )
+
+
+## Measures - prevalent prescribing - by demographic categories
+def define_measures_demo_prev(measures, dataset, index_date, prefix=""):
+
+    denominator = make_denominator(index_date)
+    demographics = make_demographics(index_date)
+
+    measures.define_measure(
+        name=prefix + "opioid_any_age",
+        numerator=dataset.opioid_any,
+        denominator=denominator,
+        group_by={"age_group": demographics["age_group"]}
+        )
+
+    measures.define_measure(
+        name=prefix + "opioid_any_sex",
+        numerator=dataset.opioid_any,
+        denominator=denominator,
+        group_by={"sex": demographics["sex"]}
+        )
+
+    measures.define_measure(
+        name=prefix + "opioid_any_region",
+        numerator=dataset.opioid_any,
+        denominator=denominator,
+        group_by={"region": demographics["region"]}
+        )
+
+    measures.define_measure(
+        name=prefix + "opioid_any_imd",
+        numerator=dataset.opioid_any,
+        denominator=denominator,
+        group_by={"imd": demographics["imd"]}
+        )
+
+    measures.define_measure(
+        name=prefix + "opioid_any_eth6",
+        numerator=dataset.opioid_any,
+        denominator=denominator,
+        group_by={"ethnicity6": demographics["ethnicity6"]}
+        )
+
+
+## Measures - new prescribing - by demographic categories
+def define_measures_demo_new(measures, dataset, index_date, prefix=""):
+
+    denominator_naive = make_denominator(index_date) & dataset.opioid_naive
+    demographics = make_demographics(index_date)
+
+    measures.define_measure(
+        name=prefix + "opioid_new_age",
+        numerator=dataset.opioid_new,
+        denominator=denominator_naive,
+        group_by={"age_group": demographics["age_group"]}
+        )
+
+    measures.define_measure(
+        name=prefix + "opioid_new_sex",
+        numerator=dataset.opioid_new,
+        denominator=denominator_naive,
+        group_by={"sex": demographics["sex"]}
+        )
+
+    measures.define_measure(
+        name=prefix + "opioid_new_region",
+        numerator=dataset.opioid_new,
+        denominator=denominator_naive,
+        group_by={"region": demographics["region"]}
+        )
+
+    measures.define_measure(
+        name=prefix + "opioid_new_imd",
+        numerator=dataset.opioid_new,
+        denominator=denominator_naive,
+        group_by={"imd": demographics["imd"]}
+        )
+
+    measures.define_measure(
+        name=prefix + "opioid_new_eth6",
+        numerator=dataset.opioid_new,
+        denominator=denominator_naive,
+        group_by={"ethnicity6": demographics["ethnicity6"]}
+        )
+
+
+## Measures - prevalent and new prescribing - in people in care home
+def define_measures_carehome(measures, dataset, index_date, prefix=""):
+
+    carehome = make_carehome(index_date)
+
+    # Total denominator - people in care home
+    denominator = make_denominator(index_date) & carehome
+
+    measures.define_measure(
+        name=prefix + "opioid_any",
+        numerator=dataset.opioid_any,
+        denominator=denominator,
+        )
+
+    measures.define_measure(
+        name=prefix + "hi_opioid_any",
+        numerator=dataset.hi_opioid_any,
+        denominator=denominator,
+        )
+
+    measures.define_measure(
+        name=prefix + "opioid_new",
+        numerator=dataset.opioid_new,
+        denominator=denominator & dataset.opioid_naive,
+        )
+
+    # By admin route
+    measures.define_measure(
+        name=prefix + "oral_opioid",
+        numerator=dataset.oral_opioid_any,
+        denominator=denominator,
+        )
+
+    measures.define_measure(
+        name=prefix + "trans_opioid",
+        numerator=dataset.trans_opioid_any,
+        denominator=denominator,
+        )
+
+    measures.define_measure(
+        name=prefix + "par_opioid",
+        numerator=dataset.par_opioid_any,
+        denominator=denominator,
+        )
+
+    ## Sensitivity analysis by care home residence
+    # Total denominator - restrict to >=60 years
+    denominator_sens = make_denominator(index_date, min_age=60)
+
+    measures.define_measure(
+        name=prefix + "opioid_any_carehome_age",
+        numerator=dataset.opioid_any,
+        denominator=denominator_sens,
+        group_by={
+            "age_group": make_age_group(index_date),
+            "carehome": carehome}
+        )
+
+
+## Measures - prevalent and new prescribing - by age band and sex,
+## for standardisation (standardise.py)
+def define_measures_stand(measures, dataset, index_date, prefix=""):
+
+    denominator = make_denominator(index_date)
+
+    group_by = {
+        "age_stand": make_age_stand(index_date),
+        "sex": static_covariates["sex"],
+    }
+
+    measures.define_measure(
+        name=prefix + "opioid_any_stand",
+        numerator=dataset.opioid_any,
+        denominator=denominator,
+        group_by=group_by
+        )
+
+    measures.define_measure(
+        name=prefix + "opioid_new_stand",
+        numerator=dataset.opioid_new,
+        denominator=denominator & dataset.opioid_naive,
+        group_by=group_by
+        )
+
+    ## People without cancer
+    measures.define_measure(
+        name=prefix + "opioid_any_nocancer_stand",
+        numerator=dataset.opioid_any,
+        denominator=denominator & ~dataset.cancer,
+        group_by=group_by
+        )
+
+    measures.define_measure(
+        name=prefix + "opioid_new_nocancer_stand",
+        numerator=dataset.opioid_new,
+        denominator=denominator & dataset.opioid_naive & ~dataset.cancer,
+        group_by=group_by
+        )
+
+
+# Measures output files and the function defining each one #
+MEASURES_FILES = {
+    "overall": define_measures_overall,
+    "demo_prev": define_measures_demo_prev,
+    "demo_new": define_measures_demo_new,
+    "type": define_measures_type,
+    "carehome": define_measures_carehome,
+    "stand": define_measures_stand,
+}
+
+##############################################
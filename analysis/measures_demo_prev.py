@@ -7,17 +7,10 @@
 #   University of Oxford, 2024
 #####################################################################
 
-
-from ehrql import case, when, months, INTERVAL, Measures
-from ehrql.tables.tpp import (
-    patients, 
-    addresses,
-    practice_registrations,
-    clinical_events)
-
-import codelists
+from ehrql import months, INTERVAL, Measures
 
 from dataset_definition import make_dataset_opioids
+from measures_definitions import define_measures_demo_prev, MeasureSelection, parse_measure_names
 
 ##########
 
@@ -26,6 +19,8 @@ from argparse import ArgumentParser
 parser = ArgumentParser()
 parser.add_argument("--start-date", type=str)
 parser.add_argument("--intervals", type=int)
+parser.add_argument("--measures", type=str,
+    help="Comma-separated names of the measures to define (default all)")
 
 args = parser.parse_args()
 
@@ -40,110 +35,11 @@ dataset = make_dataset_opioids(index_date=index_date, end_date=INTERVAL.end_date
 
 ##########
 
-## Define demographic variables
-
-age = patients.age_on(index_date)
-age_group = case(
-        when(age < 30).then("18-29"),
-        when(age < 40).then("30-39"),
-        when(age < 50).then("40-49"),
-        when(age < 60).then("50-59"),
-        when(age < 70).then("60-69"),
-        when(age < 80).then("70-79"),
-        when(age < 90).then("80-89"),
-        when(age >= 90).then("90+"),
-        otherwise="missing",
-)
-
-sex = patients.sex
-
-imd = addresses.for_patient_on(index_date).imd_rounded
-imd10 = case(
-        when((imd >= 0) & (imd < int(32844 * 1 / 10))).then("1 (most deprived)"),
-        when(imd < int(32844 * 2 / 10)).then("2"),
-        when(imd < int(32844 * 3 / 10)).then("3"),
-        when(imd < int(32844 * 4 / 10)).then("4"),
-        when(imd < int(32844 * 5 / 10)).then("5"),
-        when(imd < int(32844 * 6 / 10)).then("6"),
-        when(imd < int(32844 * 7 / 10)).then("7"),
-        when(imd < int(32844 * 8 / 10)).then("8"),
-        when(imd < int(32844 * 9 / 10)).then("9"),
-        when(imd >= int(32844 * 9 / 10)).then("10 (least deprived)"),
-        otherwise="unknown"
-)
-
-ethnicity = clinical_events.where(
-        clinical_events.snomedct_code.is_in(codelists.ethnicity_codes_6)
-    ).sort_by(
-        clinical_events.date
-    ).last_for_patient().snomedct_code.to_category(codelists.ethnicity_codes_6)
-
-ethnicity6 = case(
-    when(ethnicity == "1").then("White"),
-    when(ethnicity == "2").then("Mixed"),
-    when(ethnicity == "3").then("South Asian"),
-    when(ethnicity == "4").then("Black"),
-    when(ethnicity == "5").then("Other"),
-    when(ethnicity == "6").then("Not stated"),
-    otherwise="Unknown"
-)
-
-region = practice_registrations.for_patient_on(index_date).practice_nuts1_region_name
-
-
-#########################
-
 measures = Measures()
 measures.configure_disclosure_control(enabled=False)
 
 measures.define_defaults(intervals=months(intervals).starting_on(start_date))
 
-# Total denominator
-denominator = (
-        (patients.age_on(index_date) >= 18) 
-        & (patients.age_on(index_date) < 110)
-        & ((patients.sex == "male") | (patients.sex == "female"))
-        & (patients.date_of_death.is_after(index_date) | patients.date_of_death.is_null())
-        & (practice_registrations.for_patient_on(index_date).exists_for_patient())
-    )
-
-#########################
-
-## Overall 
-# By demographics - any prescribing
-measures.define_measure(
-    name="opioid_any_age", 
-    numerator=dataset.opioid_any,
-    denominator=denominator,
-    group_by={"age_group": age_group}
-    )
-
-measures.define_measure(
-    name="opioid_any_sex", 
-    numerator=dataset.opioid_any,
-    denominator=denominator,
-    group_by={"sex": sex}
-    )
-
-measures.define_measure(
-    name="opioid_any_region", 
-    numerator=dataset.opioid_any,
-    denominator=denominator,
-    group_by={"region": region}
-    )
-
-measures.define_measure(
-    name="opioid_any_imd", 
-    numerator=dataset.opioid_any,
-    denominator=denominator,
-    group_by={"imd": imd10}
-    )
-
-measures.define_measure(
-    name="opioid_any_eth6",
-    numerator=dataset.opioid_any,
-    denominator=denominator, 
-    group_by={"ethnicity6": ethnicity6}
-    )
-
+selection = MeasureSelection(measures, parse_measure_names(args.measures))
 
+define_measures_demo_prev(selection, dataset, index_date)
@@ -9,14 +9,9 @@
 #####################################################################
 
 from ehrql import months, INTERVAL, Measures
-from ehrql.tables.tpp import (
-    patients, 
-    practice_registrations)
-
-import codelists
 
 from dataset_definition import make_dataset_opioids
-
+from measures_definitions import define_measures_overall, MeasureSelection, parse_measure_names
 
 ##########
 
@@ -25,6 +20,8 @@ from argparse import ArgumentParser
 parser = ArgumentParser()
 parser.add_argument("--start-date", type=str)
 parser.add_argument("--intervals", type=int)
+parser.add_argument("--measures", type=str,
+    help="Comma-separated names of the measures to define (default all)")
 
 args = parser.parse_args()
 
@@ -46,48 +43,6 @@ measures.define_defaults(intervals=months(intervals).starting_on(start_date))
 
 measures.configure_dummy_data(population_size=5000)
 
-## In full population
-denominator = (
-        (patients.age_on(index_date) >= 18) 
-        & (patients.age_on(index_date) < 110)
-        & ((patients.sex == "male") | (patients.sex == "female"))
-        & (patients.date_of_death.is_after(index_date) | patients.date_of_death.is_null())
-        & (practice_registrations.for_patient_on(index_date).exists_for_patient())
-    )
-
-measures.define_measure(
-    name="opioid_any",
-    numerator=dataset.opioid_any,
-    denominator=denominator,
-    )
-
-measures.define_measure(
-    name="opioid_new",
-    numerator=dataset.opioid_new,
-    denominator=denominator & dataset.opioid_naive,
-    )
-
-measures.define_measure(
-    name="hi_opioid_any",
-    numerator=dataset.hi_opioid_any,
-    denominator=denominator,
-    )
-
-## People without cancer
-measures.define_measure(
-    name="opioid_any_nocancer",
-    numerator=dataset.opioid_any,
-    denominator=denominator & ~dataset.cancer,
-    )
-
-measures.define_measure(
-    name="opioid_new_nocancer",
-    numerator=dataset.opioid_new,
-    denominator=denominator & dataset.opioid_naive & ~dataset.cancer,
-    )
-
-measures.define_measure(
-    name="hi_opioid_any_nocancer",
-    numerator=dataset.hi_opioid_any,
-    denominator=denominator & ~dataset.cancer,
-    )
+selection = MeasureSelection(measures, parse_measure_names(args.measures))
+
+define_measures_overall(selection, dataset, index_date)
@@ -0,0 +1,46 @@
+###################################################
+# This script creates monthly counts of any and new opioid
+# prescribing by age band and sex, for age/sex standardisation
+# of the monthly rates (standardise.py)
+#
+# Author: Andrea Schaffer 
+#   Bennett Institute for Applied Data Science
+#   University of Oxford, 2024
+#####################################################################
+
+from ehrql import months, INTERVAL, Measures
+
+from dataset_definition import make_dataset_opioids
+from measures_definitions import define_measures_stand, MeasureSelection, parse_measure_names
+
+##########
+
+from argparse import ArgumentParser
+
+parser = ArgumentParser()
+parser.add_argument("--start-date", type=str)
+parser.add_argument("--intervals", type=int)
+parser.add_argument("--measures", type=str,
+    help="Comma-separated names of the measures to define (default all)")
+
+args = parser.parse_args()
+
+start_date = args.start_date
+intervals = args.intervals
+
+##########
+
+index_date = INTERVAL.start_date
+
+dataset = make_dataset_opioids(index_date=index_date, end_date=INTERVAL.end_date)
+
+##########
+
+measures = Measures()
+measures.configure_disclosure_control(enabled=False)
+
+measures.define_defaults(intervals=months(intervals).starting_on(start_date))
+
+selection = MeasureSelection(measures, parse_measure_names(args.measures))
+
+define_measures_stand(selection, dataset, index_date)
@@ -8,14 +8,10 @@
 #   University of Oxford, 2024
 #####################################################################
 
-from ehrql import  months, INTERVAL, Measures
-from ehrql.tables.tpp import (
-    patients, 
-    practice_registrations)
-
-import codelists
+from ehrql import months, INTERVAL, Measures
 
 from dataset_definition import make_dataset_opioids
+from measures_definitions import define_measures_type, MeasureSelection, parse_measure_names
 
 ##########
 
@@ -24,6 +20,8 @@ from argparse import ArgumentParser
 parser = ArgumentParser()
 parser.add_argument("--start-date", type=str)
 parser.add_argument("--intervals", type=int)
+parser.add_argument("--measures", type=str,
+    help="Comma-separated names of the measures to define (default all)")
 
 args = parser.parse_args()
 
@@ -43,37 +41,6 @@ measures.configure_disclosure_control(enabled=False)
 
 measures.define_defaults(intervals=months(intervals).starting_on(start_date))
 
-denominator = (
-        (patients.age_on(index_date) >= 18) 
-        & (patients.age_on(index_date) < 110)
-        & ((patients.sex == "male") | (patients.sex == "female"))
-        & (patients.date_of_death.is_after(index_date) | patients.date_of_death.is_null())
-        & (practice_registrations.for_patient_on(index_date).exists_for_patient())
-    )
-
-#########################
-
-## Overall
-measures.define_measure(
-    name="oral_opioid", 
-    numerator=dataset.oral_opioid_any,
-    denominator=denominator
-    )
-
-measures.define_measure(
-    name="trans_opioid", 
-    numerator=dataset.trans_opioid_any,
-    denominator=denominator
-    )
-
-measures.define_measure(
-    name="par_opioid", 
-    numerator=dataset.par_opioid_any,
-    denominator=denominator
-    )
+selection = MeasureSelection(measures, parse_measure_names(args.measures))
 
-measures.define_measure(
-    name="oth_opioid", 
-    numerator=dataset.oth_opioid_any,
-    denominator=denominator
-    )
+define_measures_type(selection, dataset, index_date)
@@ -0,0 +1,371 @@
+####################################################################
+# This script runs measures definitions locally in batches of
+#   intervals rather than all intervals in one ehrQL job, so that
+#   memory is bounded by the batch size and a failed job only
+#   loses the batch that failed. Batches (of one or more
+#   definitions) can be run in parallel with --workers, each
+#   worker process running one ehrQL job at a time. --max-memory-mb
+#   limits the address space of each job, so needs a locally
+#   installed ehrQL (--ehrql ehrql)
+#
+# Each batch's output is checkpointed in
+#   output/measures/batches/<definition>/<hash>/, where <hash>
+#   changes with the definition code and codelists. Re-running
+#   only runs the batches without a checkpoint, then combines all
+#   batches into the usual output/measures/<definition>.csv
+#
+# Usage (from the project root):
+#   python analysis/run_measures.py analysis/measures_all.py \
+#     --start-date 2018-01-01 --intervals 54 --batch-size 6
+#   python analysis/run_measures.py analysis/measures_overall.py \
+#     analysis/measures_type.py --batch-size 3 --workers 16 --ehrql ehrql \
+#     --max-memory-mb 8000
+#
+# With --incremental, an existing output is brought up to date by
+#   only running intervals after the last interval present for all
+#   measures, plus the latest --trailing-intervals intervals (which
+#   are re-run to pick up late-arriving prescriptions), e.g.
+#   python analysis/run_measures.py analysis/measures_all.py \
+#     --intervals 55 --incremental --trailing-intervals 1
+#   Each output's definition hash is saved alongside it (in
+#   <output>.hash), and all intervals are run instead if the
+#   definition or codelists have changed or measures were added
+#
+# Author: Andrea Schaffer
+#   Bennett Institute for Applied Data Science
+#   University of Oxford, 2024
+#####################################################################
+
+
+import csv
+import os
+import shlex
+import sys
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+
+from ehrql_local import (
+    DEFAULT_EHRQL,
+    add_months,
+    definition_hash,
+    ehrql_command,
+    format_usage,
+    months_between,
+    run_command,
+    uses_docker)
+from instrumentation import record_run, stage
+
+
+CHECKPOINT_DIR = "output/measures/batches"
+
+
+# Batches of intervals as (start date, no. intervals) #
+def plan_batches(start_date, intervals, batch_size):
+    return [
+        (add_months(start_date, offset), min(batch_size, intervals - offset))
+        for offset in range(0, intervals, batch_size)
+    ]
+
+
+def checkpoint_dir(definition, checkpoint_root=CHECKPOINT_DIR):
+    name = os.path.basename(definition)[:-3]
+    return os.path.join(checkpoint_root, name, definition_hash(definition)[:16])
+
+
+# Definition hash of the code and codelists an output was written with #
+def output_hash_path(output):
+    return output + ".hash"
+
+
+def write_output_hash(output, definition):
+    with open(output_hash_path(output), "w") as f:
+        f.write(definition_hash(definition) + "\n")
+
+
+def read_output_hash(output):
+    path = output_hash_path(output)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return f.read().strip()
+
+
+def batch_path(directory, batch_start, batch_intervals):
+    return os.path.join(directory, f"{batch_start}_{batch_intervals}.csv")
+
+
+# Run one batch, only keeping its output if ehrQL succeeds #
+def run_batch(definition, batch_start, batch_intervals, path, ehrql, dummy_tables=None,
+              max_memory_mb=None):
+    partial_path = path + ".partial"
+    command = ehrql_command(
+        ehrql,
+        definition,
+        output=partial_path,
+        dummy_tables=dummy_tables,
+        user_args=["--start-date", batch_start, "--intervals", str(batch_intervals)],
+    )
+    result = run_command(command, log_path=path[:-4] + ".log", max_memory_mb=max_memory_mb)
+    record_run(
+        f"run_measures/batch/{os.path.basename(definition)[:-3]}", result,
+        batch_start=batch_start, intervals=batch_intervals,
+    )
+    if result.returncode == 0:
+        os.replace(partial_path, path)
+    return result
+
+
+def read_csv(path):
+    with open(path, newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        return header, list(reader)
+
+
+# Write a CSV via a temporary file, so the output is never left
+#   partially written #
+def write_csv_atomic(path, header, rows):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    partial_path = path + ".partial"
+    with open(partial_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+    os.replace(partial_path, path)
+
+
+# Sort measures rows by measure (in the order they are defined) and
+#   then interval, as in the output of a single ehrQL job. The sort is
+#   stable, so rows within a measure and interval keep their order #
+def sort_measures_rows(header, rows):
+    measure = header.index("measure")
+    interval_start = header.index("interval_start")
+
+    measure_order = {}
+    for row in rows:
+        measure_order.setdefault(row[measure], len(measure_order))
+
+    return sorted(rows, key=lambda row: (measure_order[row[measure]], row[interval_start]))
+
+
+# Combine batch outputs into a single measures file #
+def merge_batches(paths, output):
+    header = None
+    rows = []
+    for path in paths:
+        batch_header, batch_rows = read_csv(path)
+        if header is None:
+            header = batch_header
+        elif batch_header != header:
+            raise ValueError(f"{path} has different columns to the other batches")
+        rows.extend(batch_rows)
+
+    write_csv_atomic(output, header, sort_measures_rows(header, rows))
+    return len(rows)
+
+
+# Run the batches of one or more measures definitions across a pool of
+#   worker processes, each running one ehrQL job at a time, then merge each
+#   definition's batches into its output. Returns {output: no. rows}.
+#   With rerun=True, batches are re-run even if already checkpointed #
+def run_measures(definitions, start_date, intervals, outputs=None, batch_size=12, workers=1,
+                 max_memory_mb=None, ehrql=DEFAULT_EHRQL, dummy_tables=None,
+                 checkpoint_root=CHECKPOINT_DIR, rerun=False):
+    outputs = outputs or [default_output(definition) for definition in definitions]
+    batches = plan_batches(start_date, intervals, batch_size)
+
+    paths = {}
+    to_run = []
+    for definition in definitions:
+        directory = checkpoint_dir(definition, checkpoint_root)
+        os.makedirs(directory, exist_ok=True)
+        paths[definition] = []
+        for batch_start, batch_intervals in batches:
+            path = batch_path(directory, batch_start, batch_intervals)
+            paths[definition].append(path)
+            if rerun and os.path.exists(path):
+                os.remove(path)
+            if os.path.exists(path):
+                print(f"{definition} {batch_start} ({batch_intervals} intervals): already run")
+            else:
+                to_run.append((definition, batch_start, batch_intervals, path))
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                run_batch, definition, batch_start, batch_intervals, path,
+                ehrql, dummy_tables, max_memory_mb,
+            ): (definition, batch_start, batch_intervals, path)
+            for definition, batch_start, batch_intervals, path in to_run
+        }
+        for future in as_completed(futures):
+            definition, batch_start, batch_intervals, path = futures[future]
+            result = future.result()
+            status = "done" if result.returncode == 0 else "FAILED"
+            print(
+                f"{definition} {batch_start} ({batch_intervals} intervals): {status} in "
+                f"{format_usage(result)}"
+            )
+            if result.returncode != 0:
+                failed.append(path)
+
+    if failed:
+        logs = ", ".join(path[:-4] + ".log" for path in sorted(failed))
+        raise RuntimeError(f"{len(failed)} batch(es) failed; re-run to retry them (see {logs})")
+
+    # Batches are merged in interval order whatever order they finished in
+    n_rows = {}
+    for definition, output in zip(definitions, outputs):
+        with stage(f"run_measures/merge/{os.path.basename(definition)[:-3]}") as s:
+            n_rows[output] = merge_batches(paths[definition], output)
+            s.rows_in = s.rows_out = n_rows[output]
+        write_output_hash(output, definition)
+    return n_rows
+
+
+# Last interval present for every measure in an existing output #
+def last_complete_interval(output):
+    header, rows = read_csv(output)
+    measure = header.index("measure")
+    interval_start = header.index("interval_start")
+
+    last = {}
+    for row in rows:
+        last[row[measure]] = max(last.get(row[measure], ""), row[interval_start])
+    return min(last.values()) if last else None
+
+
+# Intervals to (re-)run to bring an existing output up to date: those
+#   after the last complete interval, plus a trailing window of
+#   complete intervals to pick up late-arriving data. Returns
+#   (start date, no. intervals), or None to run all intervals #
+def incremental_window(output, start_date, intervals, trailing_intervals=0):
+    if not os.path.exists(output):
+        return None
+    last = last_complete_interval(output)
+    if last is None or last < start_date:
+        return None
+
+    end_date = add_months(start_date, intervals)
+    window_start = max(add_months(last, 1 - trailing_intervals), start_date)
+    return window_start, max(months_between(window_start, end_date), 0)
+
+
+# Update existing measures outputs with only the new intervals (plus
+#   trailing window), replacing those intervals' rows #
+def run_incremental(definitions, start_date, intervals, trailing_intervals=0, outputs=None,
+                    checkpoint_root=CHECKPOINT_DIR, **kwargs):
+    outputs = outputs or [default_output(definition) for definition in definitions]
+
+    def run_all(definition, output, reason):
+        print(f"{definition}: {reason}, running all intervals")
+        n_rows.update(run_measures(
+            [definition], start_date, intervals, outputs=[output],
+            checkpoint_root=checkpoint_root, **kwargs,
+        ))
+
+    n_rows = {}
+    for definition, output in zip(definitions, outputs):
+        window = incremental_window(output, start_date, intervals, trailing_intervals)
+        if window is None:
+            run_all(definition, output, "no existing output")
+            continue
+
+        # The existing rows can only be kept if they were written by the
+        #   same definition code and codelists
+        if read_output_hash(output) != definition_hash(definition):
+            run_all(definition, output, f"definition has changed since {output} was written")
+            continue
+
+        window_start, window_intervals = window
+        if window_intervals == 0:
+            print(f"{definition}: up to date")
+            continue
+
+        print(f"{definition}: running {window_intervals} intervals from {window_start}")
+        new_output = output + ".new"
+        run_measures(
+            [definition], window_start, window_intervals, outputs=[new_output],
+            checkpoint_root=checkpoint_root, rerun=True, **kwargs,
+        )
+
+        header, rows = read_csv(output)
+        new_header, new_rows = read_csv(new_output)
+        os.remove(new_output)
+        os.remove(output_hash_path(new_output))
+        if new_header != header:
+            raise RuntimeError(f"{output} has different columns to the new intervals; run all intervals")
+
+        measure = header.index("measure")
+        if {row[measure] for row in new_rows} - {row[measure] for row in rows}:
+            run_all(definition, output, "measures have been added")
+            continue
+
+        interval_start = header.index("interval_start")
+        rows = [row for row in rows if row[interval_start] < window_start] + new_rows
+        write_csv_atomic(output, header, sort_measures_rows(header, rows))
+        n_rows[output] = len(rows)
+
+    return n_rows
+
+
+def default_output(definition):
+    return os.path.join("output", "measures", os.path.basename(definition)[:-3] + ".csv")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("definitions", nargs="+", type=str)
+    parser.add_argument("--start-date", type=str, default="2018-01-01")
+    parser.add_argument("--intervals", type=int, default=54)
+    parser.add_argument("--batch-size", type=int, default=12,
+        help="No. intervals in each ehrQL job")
+    parser.add_argument("--workers", type=int, default=1,
+        help="No. ehrQL jobs to run at the same time")
+    parser.add_argument("--max-memory-mb", type=int,
+        help="Address space limit for each ehrQL job (needs a locally installed "
+             "ehrQL, e.g. --ehrql ehrql)")
+    parser.add_argument("--output", type=str, nargs="+",
+        help="One per definition; default output/measures/<definition>.csv")
+    parser.add_argument("--ehrql", type=str, default=DEFAULT_EHRQL)
+    parser.add_argument("--dummy-tables", type=str)
+    parser.add_argument("--checkpoint-dir", type=str, default=CHECKPOINT_DIR)
+    parser.add_argument("--incremental", action="store_true",
+        help="Only run intervals after the last complete interval in the existing output")
+    parser.add_argument("--trailing-intervals", type=int, default=0,
+        help="With --incremental, also re-run this many of the latest complete intervals")
+
+    args = parser.parse_args()
+
+    if args.output and len(args.output) != len(args.definitions):
+        parser.error("--output needs one path per definition")
+    if args.max_memory_mb and uses_docker(shlex.split(args.ehrql)):
+        parser.error("--max-memory-mb needs a locally installed ehrQL (e.g. --ehrql ehrql)")
+
+    if args.incremental:
+        run = partial(run_incremental, trailing_intervals=args.trailing_intervals)
+    else:
+        run = run_measures
+
+    try:
+        with stage("run_measures", definitions=args.definitions) as s:
+            n_rows = run(
+                args.definitions,
+                args.start_date,
+                args.intervals,
+                outputs=args.output,
+                batch_size=args.batch_size,
+                workers=args.workers,
+                max_memory_mb=args.max_memory_mb,
+                ehrql=args.ehrql,
+                dummy_tables=args.dummy_tables,
+                checkpoint_root=args.checkpoint_dir,
+            )
+            s.rows_out = sum(n_rows.values())
+    except RuntimeError as e:
+        sys.exit(str(e))
+
+    for output, n in n_rows.items():
+        print(f"Wrote {n} rows to {output}")
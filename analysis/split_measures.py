@@ -0,0 +1,159 @@
+#################################################################
+# This script splits the combined measures file created by
+# measures_all.py into the separate measures files
+# (output/measures/measures_<name>.csv) read by
+# build_timeseries.py and standardise.py. With --parquet, each
+# file is also written as typed Parquet (in batches, as the rows
+# are split), with the measure and categorical group-by columns
+# dictionary encoded, which build_timeseries.py --parquet reads
+# instead of the CSVs
+#
+# Author: Andrea Schaffer 
+#   Bennett Institute for Applied Data Science
+#   University of Oxford, 2024
+#####################################################################
+
+import csv
+import os
+from argparse import ArgumentParser
+
+from instrumentation import stage
+
+
+# Columns common to all measures files
+BASE_COLUMNS = ["measure", "interval_start", "interval_end", "ratio", "numerator", "denominator"]
+
+# Group-by columns in each measures file (see measures_definitions.py)
+GROUP_COLUMNS = {
+    "overall": [],
+    "demo_prev": ["age_group", "sex", "region", "imd", "ethnicity6"],
+    "demo_new": ["age_group", "sex", "region", "imd", "ethnicity6"],
+    "type": [],
+    "carehome": ["age_group", "carehome"],
+    "stand": ["age_stand", "sex"],
+}
+
+# Types of the group-by columns in the Parquet files; all others are
+#   dictionary-encoded strings
+GROUP_COLUMN_TYPES = {
+    "carehome": "bool",
+}
+
+# No. rows in each Parquet row group
+BATCH_SIZE = 500_000
+
+
+def parquet_schema(group_columns):
+    import pyarrow as pa
+
+    category = pa.dictionary(pa.int32(), pa.string())
+    return pa.schema(
+        [
+            ("measure", category),
+            ("interval_start", pa.date32()),
+            ("interval_end", pa.date32()),
+            ("ratio", pa.float64()),
+            ("numerator", pa.int64()),
+            ("denominator", pa.int64()),
+        ]
+        + [
+            (column, pa.bool_() if GROUP_COLUMN_TYPES.get(column) == "bool" else category)
+            for column in group_columns
+        ]
+    )
+
+
+# Typed record batch from columns of values as read from the CSV #
+def record_batch(columns, schema):
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    arrays = []
+    for field in schema:
+        # ehrQL writes missing values as empty and booleans as T/F
+        values = pa.array([value or None for value in columns[field.name]], pa.string())
+        if pa.types.is_boolean(field.type):
+            values = pc.equal(values, "T")
+        elif pa.types.is_dictionary(field.type):
+            values = values.dictionary_encode()
+        else:
+            values = values.cast(field.type)
+        arrays.append(values)
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+# Writes rows to a Parquet file in batches of typed columns #
+class ParquetBatchWriter:
+
+    def __init__(self, path, group_columns):
+        import pyarrow.parquet
+
+        self.schema = parquet_schema(group_columns)
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        self.columns = {column: [] for column in self.schema.names}
+        self.n_rows = 0
+
+    def writerow(self, row):
+        for column, values in self.columns.items():
+            values.append(row[column])
+        if len(self.columns["measure"]) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.columns["measure"]:
+            batch = record_batch(self.columns, self.schema)
+            self.writer.write_batch(batch)
+            self.n_rows += batch.num_rows
+            self.columns = {column: [] for column in self.schema.names}
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def split_measures(input_path, output_dir, parquet=False):
+    os.makedirs(output_dir, exist_ok=True)
+
+    files = {}
+    writers = {}
+    parquet_writers = {}
+    try:
+        for name, group_columns in GROUP_COLUMNS.items():
+            path = os.path.join(output_dir, f"measures_{name}")
+            files[name] = open(path + ".csv", "w", newline="")
+            writers[name] = csv.DictWriter(
+                files[name],
+                fieldnames=BASE_COLUMNS + group_columns,
+                extrasaction="ignore",
+            )
+            writers[name].writeheader()
+            if parquet:
+                parquet_writers[name] = ParquetBatchWriter(path + ".parquet", group_columns)
+
+        with stage("split_measures") as s, open(input_path, newline="") as f:
+            n_rows = 0
+            for row in csv.DictReader(f):
+                name, _, measure = row["measure"].partition("__")
+                row["measure"] = measure
+                writers[name].writerow(row)
+                if parquet:
+                    parquet_writers[name].writerow(row)
+                n_rows += 1
+            s.rows_in = s.rows_out = n_rows
+    finally:
+        for f in files.values():
+            f.close()
+        for writer in parquet_writers.values():
+            writer.close()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--input", type=str, default="output/measures/measures_all.csv")
+    parser.add_argument("--output-dir", type=str, default="output/measures")
+    parser.add_argument("--parquet", action="store_true",
+        help="Also write each measures file as Parquet")
+
+    args = parser.parse_args()
+
+    split_measures(args.input, args.output_dir, parquet=args.parquet)
@@ -0,0 +1,179 @@
+#################################################################
+# This script calculates directly age/sex standardised rates
+# (to the UK population in ONS-data/ons_pop_stand.csv) from
+# counts by age_stand and sex strata, e.g. monthly measures of
+# opioid prescribing for every subgroup
+#
+# Standardised rates are the sum of stratum-specific rates
+# weighted by the standard population, with 95% CIs by
+# Dobson's method (using Byar's approximation to the Poisson
+# limits of the total count). Rates are per 1,000 people
+#
+# With --round-strata, the standardised rates and CIs are calculated
+# from stratum counts rounded and redacted as in disclosure_control.py
+# (with redacted counts as zero), so the exact total count can't be
+# recovered from the CI (whose width depends on the count)
+#
+# Usage (from the project root):
+#   python analysis/standardise.py --input output/measures/measures_stand.csv \
+#     --output output/timeseries/ts_stand.csv --keys measure interval_start \
+#     --round-strata
+#
+# Author: Andrea Schaffer
+#   Bennett Institute for Applied Data Science
+#   University of Oxford, 2024
+#####################################################################
+
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas as pd
+
+from disclosure_control import disclosure_control
+from instrumentation import stage
+
+
+STANDARD_POPULATION_PATH = "ONS-data/ons_pop_stand.csv"
+
+STRATA = ["age_stand", "sex"]
+
+
+# Standard population, with labels matching those in the ehrQL
+#   definitions (e.g. "18-24" rather than "18-24 y", "female"
+#   rather than "Female"); totals are labelled "Total" #
+def read_standard_population(path=STANDARD_POPULATION_PATH):
+    population = pd.read_csv(path, dtype={"age_stand": str, "sex": str})
+    return population.assign(
+        age_stand=population["age_stand"].str.replace(" y", "", regex=False),
+        sex=population["sex"].where(population["sex"] == "Total", population["sex"].str.lower()),
+    )
+
+
+class StrataIndex:
+    """Standardisation strata and their weights in the standard
+    population, built once and used to look up the stratum of each row
+    of counts. Strata are age_stand and sex by default; standardising
+    by age_stand only (e.g. for rates by sex) uses the total population
+    of each age band.
+    """
+
+    def __init__(self, standard_population=None, strata=STRATA):
+        population = standard_population
+        if population is None:
+            population = read_standard_population()
+
+        for column in STRATA:
+            if column in strata:
+                population = population[population[column] != "Total"]
+            else:
+                population = population[population[column] == "Total"]
+
+        self.strata = list(strata)
+        self.index = pd.MultiIndex.from_frame(population[self.strata])
+        self.weights = population["uk_pop"].to_numpy(dtype="float64")
+
+    def __len__(self):
+        return len(self.weights)
+
+    # Position of each row's stratum, or -1 if not in the standard
+    #   population (e.g. missing age) #
+    def positions(self, data):
+        return self.index.get_indexer(pd.MultiIndex.from_frame(data[self.strata]))
+
+
+# Byar's approximation to the exact Poisson CI of a count #
+def poisson_limits(count, z=1.96):
+    count = np.asarray(count, dtype="float64")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        lower = count * (1 - 1 / (9 * count) - z / (3 * np.sqrt(count))) ** 3
+        upper = (count + 1) * (1 - 1 / (9 * (count + 1)) + z / (3 * np.sqrt(count + 1))) ** 3
+    return np.where(count > 0, lower, 0), upper
+
+
+# Directly standardised rates, with CIs, for each combination of the key
+#   columns (e.g. measure, interval_start and subgroup), from rows of
+#   numerators and denominators by stratum. With round_strata=True, the
+#   standardised rates and CIs are from rounded stratum counts #
+def standardise(data, strata_index, keys, numerator="numerator", denominator="denominator",
+                per=1000, z=1.96, round_strata=False):
+    key_codes = data.groupby(keys, sort=False, dropna=False).ngroup().to_numpy()
+    key_values = data[keys].drop_duplicates().reset_index(drop=True)
+    n_keys, n_strata = len(key_values), len(strata_index)
+
+    numerators = data[numerator].to_numpy(dtype="float64")
+    denominators = data[denominator].to_numpy(dtype="float64")
+
+    # Counts as (key, stratum) arrays, summing over any rows in the same
+    #   stratum (e.g. both sexes when standardising by age only)
+    positions = strata_index.positions(data)
+    in_strata = positions >= 0
+    cells = key_codes[in_strata] * n_strata + positions[in_strata]
+    size = n_keys * n_strata
+    stratum_numerators = np.bincount(cells, numerators[in_strata], size).reshape(n_keys, n_strata)
+    stratum_denominators = np.bincount(cells, denominators[in_strata], size).reshape(n_keys, n_strata)
+
+    # Redacted counts are zero, so strata with a redacted denominator are
+    #   treated as having no population
+    if round_strata:
+        rounded = disclosure_control(
+            pd.DataFrame({"numerator": stratum_numerators.ravel(),
+                          "denominator": stratum_denominators.ravel()}),
+            [("numerator", "denominator")],
+        )
+        stratum_numerators = np.nan_to_num(rounded["numerator"]).reshape(n_keys, n_strata)
+        stratum_denominators = np.nan_to_num(rounded["denominator"]).reshape(n_keys, n_strata)
+
+    # Strata with no population don't contribute to the rate or the weights
+    present = stratum_denominators > 0
+    weights = np.where(present, strata_index.weights, 0)
+    total_weights = weights.sum(axis=1)
+    rates = np.divide(stratum_numerators, stratum_denominators,
+                      out=np.zeros_like(stratum_numerators), where=present)
+    variances = np.divide(stratum_numerators, stratum_denominators ** 2,
+                          out=np.zeros_like(stratum_numerators), where=present)
+
+    count = stratum_numerators.sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        std_rate = (rates * weights).sum(axis=1) / total_weights
+        std_var = (weights ** 2 * variances).sum(axis=1) / total_weights ** 2
+        lower, upper = poisson_limits(count, z)
+        scale = np.sqrt(std_var / count)
+        std_lci = np.where(count > 0, std_rate + scale * (lower - count), 0)
+        std_uci = np.where(count > 0, std_rate + scale * (upper - count), np.nan)
+
+    # Crude rates include rows not in a stratum (e.g. missing age)
+    total_numerators = np.bincount(key_codes, numerators, n_keys)
+    total_denominators = np.bincount(key_codes, denominators, n_keys)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        crude_rate = total_numerators / total_denominators * per
+
+    return key_values.assign(
+        numerator=total_numerators.astype("int64"),
+        denominator=total_denominators.astype("int64"),
+        crude_rate=crude_rate,
+        std_rate=std_rate * per,
+        std_lci=std_lci * per,
+        std_uci=std_uci * per,
+    )
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--input", type=str, required=True,
+        help="CSV of numerators and denominators by the key columns and strata")
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("--keys", nargs="+", required=True,
+        help="Columns to calculate standardised rates for each combination of")
+    parser.add_argument("--strata", nargs="+", choices=STRATA, default=STRATA)
+    parser.add_argument("--standard-population", type=str, default=STANDARD_POPULATION_PATH)
+    parser.add_argument("--round-strata", action="store_true",
+        help="Calculate standardised rates and CIs from rounded and redacted stratum counts")
+
+    args = parser.parse_args()
+
+    with stage("standardise", input=args.input) as s:
+        strata_index = StrataIndex(read_standard_population(args.standard_population), args.strata)
+        data = pd.read_csv(args.input, dtype={column: str for column in args.keys + STRATA})
+        rates = standardise(data, strata_index, args.keys, round_strata=args.round_strata)
+        rates.to_csv(args.output, index=False, na_rep="NA")
+        s.rows_in, s.rows_out = len(data), len(rates)
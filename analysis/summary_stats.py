@@ -0,0 +1,187 @@
+#################################################################
+# This script calculates summary statistics (25th, 50th and 75th
+# percentiles) for all time series variables, by subgroup,
+# both overall and by time period (pre-COVID, lockdown, recovery),
+# creating output/released_outputs/final/summary_stats.csv
+#
+# Values of every variable are held as one array, sorted within each
+# subgroup and period, so all percentiles come from a single sort of
+# each variable. With --state, the sorted values are saved, and later
+# runs only read months after those already included, merging them in
+#
+# Author: Andrea Schaffer
+#   Bennett Institute for Applied Data Science
+#   University of Oxford, 2024
+#####################################################################
+
+import os
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import stage
+
+
+PROBABILITIES = {"p25": 0.25, "p50": 0.5, "p75": 0.75}
+
+GROUP_COLUMNS = ["cat", "var", "period"]
+
+# Time series summarised, with their subgroup (cat) and variable (var)
+#   labels: a fixed label, or the column to take them from
+SUMMARY_TIMESERIES = {
+    "ts_overall_its": {"cat": "Overall", "var": "Overall"},
+    "ts_overall_nocancer_its": {"cat": "No cancer", "var": "Overall"},
+    "ts_demo_its": {},
+    "ts_type_its": {"cat": {"column": "measure"}, "var": "Admin route"},
+    "ts_carehome_its": {"cat": "Care home", "var": "Care home"},
+}
+
+
+# Time series rows after the given month, labelled by subgroup and
+#   variable #
+def read_timeseries(input_dir, name, after=None):
+    spec = SUMMARY_TIMESERIES[name]
+    data = pd.read_csv(os.path.join(input_dir, f"{name}.csv"),
+                       dtype={"month": str, "cat": str, "var": str, "measure": str})
+    if after is not None:
+        data = data[data["month"] > after]
+
+    for column in ["cat", "var"]:
+        label = spec.get(column)
+        if isinstance(label, dict):
+            data[column] = data.pop(label["column"])
+        elif label is not None:
+            data[column] = label
+    data["cat"] = data["cat"].fillna("Missing")
+    return data
+
+
+class PeriodQuantiles:
+    """Values of each variable by subgroup and period, sorted within
+    each one. Each row counts towards its period and the "Overall"
+    period. Values are held as a (rows, variables) array, with rows in
+    blocks by group and each variable sorted within each block (missing
+    values last), so percentiles of every variable and group are read
+    off by position.
+    """
+
+    def __init__(self):
+        self.columns = []
+        self.groups = pd.DataFrame(columns=GROUP_COLUMNS)
+        self.codes = np.empty(0, dtype="int64")
+        self.values = np.empty((0, 0))
+        self.last_month = {}
+
+    # Add rows (with the group columns and a month) from a time series #
+    def update(self, name, data):
+        if data.empty:
+            return
+        self.last_month[name] = max(self.last_month.get(name, ""), data["month"].max())
+
+        data = pd.concat([data, data.assign(period="Overall")], ignore_index=True)
+        columns = [
+            column for column in data.select_dtypes("number").columns
+            if column not in GROUP_COLUMNS
+        ]
+        new_columns = [column for column in columns if column not in self.columns]
+        if new_columns:
+            self.columns += new_columns
+            self.values = np.hstack([self.values, np.full((len(self.values), len(new_columns)), np.nan)])
+
+        # Group codes, adding any new groups
+        keys = data[GROUP_COLUMNS].fillna("NA")
+        groups = keys.drop_duplicates()
+        known = pd.MultiIndex.from_frame(self.groups)
+        new_groups = groups[~pd.MultiIndex.from_frame(groups).isin(known)]
+        self.groups = pd.concat([self.groups, new_groups], ignore_index=True)
+        codes = pd.MultiIndex.from_frame(self.groups).get_indexer(pd.MultiIndex.from_frame(keys))
+
+        values = data.reindex(columns=self.columns).to_numpy(dtype="float64", na_value=np.nan)
+        self.codes, self.values = self.sort(
+            np.concatenate([self.codes, codes]), np.vstack([self.values, values])
+        )
+
+    # Rows in blocks by group, with each variable sorted within each
+    #   block (stable, so already sorted values are merged) #
+    @staticmethod
+    def sort(codes, values):
+        order = np.argsort(codes, kind="stable")
+        codes = codes[order]
+        values = values[order]
+        for i in range(values.shape[1]):
+            values[:, i] = values[np.lexsort((values[:, i], codes)), i]
+        return codes, values
+
+    # Percentiles of each variable by group (as R's quantile(), type 7,
+    #   with missing values removed) #
+    def quantiles(self, probabilities=PROBABILITIES):
+        n_groups = len(self.groups)
+        starts = np.searchsorted(self.codes, np.arange(n_groups))
+        # Non-missing values of each variable in each group
+        counts = np.zeros((n_groups, len(self.columns)), dtype="int64")
+        np.add.at(counts, self.codes, ~np.isnan(self.values))
+
+        result = self.groups.replace("NA", np.nan).reset_index(drop=True)
+        last = np.maximum(counts - 1, 0)
+        columns = np.arange(len(self.columns))
+        for label, probability in probabilities.items():
+            h = last * probability
+            lower = np.floor(h).astype("int64")
+            upper = np.minimum(lower + 1, last)
+            low = self.values[starts[:, None] + lower, columns]
+            high = self.values[starts[:, None] + upper, columns]
+            quantile = np.where(counts > 0, low + (h - lower) * (high - low), np.nan)
+            for i, column in enumerate(self.columns):
+                result[f"{column}_{label}"] = quantile[:, i]
+        return result
+
+    def save(self, path):
+        np.savez(
+            path,
+            columns=np.array(self.columns, dtype=str),
+            groups=self.groups.to_numpy(dtype=str),
+            codes=self.codes,
+            values=self.values,
+            last_month=np.array(list(self.last_month.items()), dtype=str).reshape(-1, 2),
+        )
+
+    @classmethod
+    def load(cls, path):
+        quantiles = cls()
+        with np.load(path) as state:
+            quantiles.columns = list(state["columns"])
+            quantiles.groups = pd.DataFrame(state["groups"], columns=GROUP_COLUMNS)
+            quantiles.codes = state["codes"]
+            quantiles.values = state["values"]
+            quantiles.last_month = dict(state["last_month"])
+        return quantiles
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--input-dir", type=str, default="output/released_outputs/final")
+    parser.add_argument("--output", type=str, default="output/released_outputs/final/summary_stats.csv")
+    parser.add_argument("--state", type=str,
+        help="File (.npz) of sorted values to update with new months, created if it doesn't exist")
+
+    args = parser.parse_args()
+
+    if args.state and os.path.exists(args.state):
+        quantiles = PeriodQuantiles.load(args.state)
+    else:
+        quantiles = PeriodQuantiles()
+
+    for name in SUMMARY_TIMESERIES:
+        with stage(f"summary_stats/update/{name}") as s:
+            data = read_timeseries(args.input_dir, name, quantiles.last_month.get(name))
+            quantiles.update(name, data)
+            s.rows_in = len(data)
+
+    if args.state:
+        quantiles.save(args.state)
+
+    with stage("summary_stats/quantiles", rows_in=len(quantiles.codes)) as s:
+        stats = quantiles.quantiles().sort_values(["var", "period", "cat"], kind="stable")
+        stats.to_csv(args.output, index=False, na_rep="NA")
+        s.rows_out = len(stats)
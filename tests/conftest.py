@@ -0,0 +1,15 @@
+#################################################################
+# The analysis scripts import each other as top-level modules
+# (they are run as python analysis/<script>.py), so tests import
+# them the same way
+#
+# Author: Andrea Schaffer
+#   Bennett Institute for Applied Data Science
+#   University of Oxford, 2024
+#####################################################################
+
+import os
+import sys
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "analysis"))
@@ -0,0 +1,175 @@
+#################################################################
+# Property tests of the rounding and redaction in
+# disclosure_control.py (and of standardised rates calculated
+# from rounded stratum counts in standardise.py)
+#
+# Usage (from the project root):
+#   pip install -r requirements.dev.txt
+#   python -m pytest tests
+#
+# Author: Andrea Schaffer
+#   Bennett Institute for Applied Data Science
+#   University of Oxford, 2024
+#####################################################################
+
+import numpy as np
+import pandas as pd
+import pytest
+from hypothesis import example, given
+from hypothesis import strategies as st
+
+from disclosure_control import (
+    REDACTION_THRESHOLD,
+    ROUNDING_BASE,
+    disclosure_control,
+    round_counts,
+    round_timeseries,
+)
+from standardise import StrataIndex, standardise
+
+
+# Counts, often around the redaction threshold
+count = st.one_of(st.none(), st.integers(0, 30), st.integers(0, 10_000_000))
+counts = st.lists(count, max_size=50)
+
+
+# Pairs of counts, with the numerator no more than the denominator #
+@st.composite
+def count_pairs(draw):
+    denominator = draw(count)
+    if denominator is None:
+        return draw(st.one_of(st.none(), st.integers(0, 100))), None
+    numerator = st.one_of(st.integers(max(denominator - 30, 0), denominator),
+                          st.integers(0, denominator))
+    return draw(st.one_of(st.none(), numerator)), denominator
+
+
+def as_array(values):
+    return np.array([np.nan if value is None else value for value in values], dtype="float64")
+
+
+def rounded_pairs(pairs):
+    data = pd.DataFrame(
+        {"num": pd.array([num for num, _ in pairs], dtype="Int64"),
+         "den": pd.array([den for _, den in pairs], dtype="Int64")}
+    )
+    return data, disclosure_control(data, [("num", "den")])
+
+
+@given(counts)
+def test_rounded_counts_are_multiples_of_base_or_missing(values):
+    rounded = round_counts(as_array(values))
+    kept = rounded[~np.isnan(rounded)]
+    assert np.all(kept % ROUNDING_BASE == 0)
+
+
+@given(counts)
+def test_no_count_at_or_below_threshold_is_kept(values):
+    values = as_array(values)
+    rounded = round_counts(values)
+    kept = ~np.isnan(rounded)
+    assert np.all(values[kept] > REDACTION_THRESHOLD)
+    assert np.all(rounded[kept] > REDACTION_THRESHOLD)
+    # Missing counts stay missing
+    assert np.all(np.isnan(rounded[np.isnan(values)]))
+
+
+@given(st.lists(count_pairs(), max_size=50))
+def test_released_pairs_have_no_count_at_or_below_threshold(pairs):
+    data, rounded = rounded_pairs(pairs)
+    for column in ["num", "den"]:
+        values = data[column].to_numpy(dtype="float64", na_value=np.nan)
+        kept = ~np.isnan(rounded[column])
+        assert np.all(values[kept] > REDACTION_THRESHOLD)
+        assert np.all(rounded[column][kept] % ROUNDING_BASE == 0)
+
+
+@given(st.lists(count_pairs(), max_size=50))
+@example([(100, 110), (100, 111), (5, 20)])
+def test_numerator_redacted_with_denominator_or_small_complement(pairs):
+    data, rounded = rounded_pairs(pairs)
+    num = data["num"].to_numpy(dtype="float64", na_value=np.nan)
+    den = data["den"].to_numpy(dtype="float64", na_value=np.nan)
+
+    assert np.all(np.isnan(rounded["num"][np.isnan(rounded["den"])]))
+    assert np.all(np.isnan(rounded["num"][den - num <= REDACTION_THRESHOLD]))
+    # Otherwise, numerators are only redacted if they are small
+    released = ~np.isnan(rounded["den"]) & (den - num > REDACTION_THRESHOLD) & (num > REDACTION_THRESHOLD)
+    assert not np.any(np.isnan(rounded["num"][released]))
+
+
+# Counts exactly half way between multiples of the base round to the
+#   even multiple, as R's round() (e.g. round(2.5) is 2, round(3.5) is 4) #
+def test_rounding_is_half_to_even_as_r():
+    halves = np.array([17.5, 24.5, 31.5, 38.5, 45.5])
+    assert list(round_counts(halves)) == [14, 28, 28, 42, 42]
+
+
+@given(st.integers(2, 1_000_000))
+def test_half_way_counts_round_to_even_multiple(k):
+    expected = ROUNDING_BASE * (k if k % 2 == 0 else k + 1)
+    assert round_counts([ROUNDING_BASE * (k + 0.5)])[0] == expected
+
+
+# Standardised rates can't be recalculated from rounded counts, so are
+#   redacted with their numerator; crude rates are recalculated #
+def test_standardised_rates_redacted_with_numerator(tmp_path):
+    pd.DataFrame({
+        "measure": ["opioid_any_stand"] * 3,
+        "interval_start": ["2020-01-01", "2020-02-01", "2020-03-01"],
+        "numerator": [5, 500, 995],
+        "denominator": [1000, 1000, 1000],
+        "crude_rate": [5.0, 500.0, 995.0],
+        "std_rate": [4.0, 450.0, 990.0],
+        "std_lci": [1.0, 400.0, 980.0],
+        "std_uci": [9.0, 500.0, 999.0],
+    }).to_csv(tmp_path / "ts_stand.csv", index=False)
+
+    round_timeseries(tmp_path, "ts_stand")
+    rounded = pd.read_csv(tmp_path / "ts_stand_rounded.csv")
+
+    assert list(rounded.columns) == [
+        "measure", "interval_start", "numerator_round", "denominator_round",
+        "crude_rate", "std_rate", "std_lci", "std_uci",
+    ]
+    assert rounded["numerator_round"].isna().tolist() == [True, False, True]
+    for column in ["crude_rate", "std_rate", "std_lci", "std_uci"]:
+        assert rounded[column].isna().tolist() == [True, False, True]
+    assert rounded["crude_rate"][1] == pytest.approx(497 / 1001 * 1000)
+
+
+# Stratum numerators (with denominators of 5,000) and the same
+#   numerators moved by up to 3 either way, i.e. to another count that
+#   rounds to the same multiple of the base #
+@st.composite
+def stratum_numerators_in_same_rounding(draw):
+    numerators = draw(st.lists(st.integers(REDACTION_THRESHOLD + 1, 4000), min_size=4, max_size=4))
+    rounded = round_counts(numerators).astype(int)
+    moved = [draw(st.integers(value - 3, value + 3)) for value in rounded]
+    return numerators, moved
+
+
+# Standardised rates and CIs from rounded stratum counts are the same
+#   for any exact counts that round to the same, so the exact count
+#   can't be recovered from them (e.g. from the width of the CI) #
+@given(stratum_numerators_in_same_rounding())
+def test_standardised_rates_dont_reveal_exact_counts(numerators):
+    strata_index = StrataIndex(pd.DataFrame({
+        "age_stand": ["18-29", "18-29", "30+", "30+"],
+        "sex": ["female", "male", "female", "male"],
+        "uk_pop": [1000, 1100, 2000, 1900],
+    }))
+
+    def standardised(stratum_numerators):
+        data = pd.DataFrame({
+            "measure": "opioid_any_stand",
+            "age_stand": ["18-29", "18-29", "30+", "30+"],
+            "sex": ["female", "male", "female", "male"],
+            "numerator": stratum_numerators,
+            "denominator": 5000,
+        })
+        rates = standardise(data, strata_index, ["measure"], round_strata=True)
+        return rates[["std_rate", "std_lci", "std_uci"]].to_numpy()
+
+    exact, moved = numerators
+    assert np.array_equal(standardised(exact), standardised(moved))